@@ -191,7 +191,60 @@ JUDGE_SERVER_HOST = os.getenv('JUDGE_SERVER_HOST')
 
 JUDGE_SERVER_PORT = os.getenv('JUDGE_SERVER_PORT')
 
+# 多台评测机以逗号分隔, 例如 JUDGE_SERVERS=10.0.0.2:12358,10.0.0.3:12358
+# 未设置时只使用 JUDGE_SERVER_HOST:JUDGE_SERVER_PORT
+JUDGE_SERVERS = [address.strip() for address in os.getenv(
+    'JUDGE_SERVERS', f'{JUDGE_SERVER_HOST}:{JUDGE_SERVER_PORT}').split(',') if address.strip()]
+
 JUDGE_SERVER_TEST_CASE_DIR = os.getenv('JUDGE_SERVER_TEST_CASE_DIR')
+# 评测机上存放预编译头文件(如 bits/stdc++.h.gch)的目录, 为空时不使用
+JUDGE_SERVER_PCH_DIR = os.getenv('JUDGE_SERVER_PCH_DIR')
+
+# 提交限流: 每个用户/IP 的令牌桶容量和每秒补充的令牌数
+SUBMISSION_USER_BURST = int(os.getenv('SUBMISSION_USER_BURST', 10))
+SUBMISSION_USER_RATE = float(os.getenv('SUBMISSION_USER_RATE', 0.2))
+SUBMISSION_IP_BURST = int(os.getenv('SUBMISSION_IP_BURST', 60))
+SUBMISSION_IP_RATE = float(os.getenv('SUBMISSION_IP_RATE', 1))
+# web 服务前面的反向代理层数, 用来从 X-Forwarded-For 中取出客户端 IP; 为 0 时使用 REMOTE_ADDR
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', 0))
+
+# 判题队列积压超过该长度时拒绝新的提交, 并让客户端在 JUDGE_QUEUE_RETRY_AFTER 秒后重试
+JUDGE_QUEUE_MAX_DEPTH = int(os.getenv('JUDGE_QUEUE_MAX_DEPTH', 2000))
+JUDGE_QUEUE_RETRY_AFTER = int(os.getenv('JUDGE_QUEUE_RETRY_AFTER', 10))
+# 单位秒, 提交等待测试数据同步到评测机的最长时间, 超过后判为系统错误
+JUDGE_TEST_CASE_WAIT_TIMEOUT = int(os.getenv('JUDGE_TEST_CASE_WAIT_TIMEOUT', 600))
+
+# 相同代码的判题结果缓存时间, 单位秒
+VERDICT_CACHE_TIMEOUT = int(os.getenv('VERDICT_CACHE_TIMEOUT', 7 * 24 * 60 * 60))
+# 编译错误的缓存时间, 单位秒
+COMPILE_ERROR_CACHE_TIMEOUT = int(os.getenv('COMPILE_ERROR_CACHE_TIMEOUT', 30 * 24 * 60 * 60))
+
+# 每个测试点保存的用户输出长度上限
+SUBMISSION_OUTPUT_LIMIT = int(os.getenv('SUBMISSION_OUTPUT_LIMIT', 1024))
+
+# 开启 fail_fast 的 ACM 题目逐批发送测试点的测试数据总字节数上限, 超过时按 test_case_id 一次性判题
+ACM_FAIL_FAST_SIZE_LIMIT = int(os.getenv('ACM_FAIL_FAST_SIZE_LIMIT', 256 * 1024))
+
+# 增量重判时随请求发送的测试数据总字节数上限, 超过时改为完整重判
+INCREMENTAL_REJUDGE_SIZE_LIMIT = int(os.getenv('INCREMENTAL_REJUDGE_SIZE_LIMIT', 8 * 1024 * 1024))
+
+# 自定义输入运行(debug): 输入和输出的字节数上限, 时空限制上限(ms, MB),
+# 查询结果时单次请求最多等待的秒数, 结果保留的秒数(超过该时间仍未开始运行的任务会被丢弃),
+# 以及 debug 队列的最大长度
+DEBUG_INPUT_LIMIT = int(os.getenv('DEBUG_INPUT_LIMIT', 64 * 1024))
+DEBUG_OUTPUT_LIMIT = int(os.getenv('DEBUG_OUTPUT_LIMIT', 64 * 1024))
+DEBUG_MAX_CPU_TIME = int(os.getenv('DEBUG_MAX_CPU_TIME', 2000))
+DEBUG_MAX_MEMORY = int(os.getenv('DEBUG_MAX_MEMORY', 256))
+DEBUG_WAIT_TIMEOUT = int(os.getenv('DEBUG_WAIT_TIMEOUT', 10))
+DEBUG_RESULT_TIMEOUT = int(os.getenv('DEBUG_RESULT_TIMEOUT', 60))
+DEBUG_QUEUE_MAX_DEPTH = int(os.getenv('DEBUG_QUEUE_MAX_DEPTH', 50))
+
+# 解压测试数据时并行解压和计算 md5 的线程数, 默认不并行;
+# 先用 benchmark_test_case_zip 在部署机器上确认多线程确实更快再调大
+TEST_CASE_EXTRACT_WORKERS = int(os.getenv('TEST_CASE_EXTRACT_WORKERS', 1))
+
+# /metrics 的访问令牌, 为空时不校验
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
 
 TEST_CASE_DIR = os.getenv('TEST_CASE_DIR') # Temporary directory for test cases
 
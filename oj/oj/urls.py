@@ -18,11 +18,14 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework.authtoken import views
 
+from utils.metrics import metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('account.urls')),
     path('', include('problem.urls')),
     path('', include('submission.urls')),
     path('', include('remote.urls')),
-    path('api-token-auth', views.obtain_auth_token)
+    path('api-token-auth', views.obtain_auth_token),
+    path('metrics', metrics, name='metrics'),
 ]
@@ -0,0 +1,126 @@
+from contextlib import contextmanager
+
+from django.db.models import F
+from django_redis import get_redis_connection
+
+from .models import Problem
+
+
+class ProblemCounter(object):
+    '''
+        题目提交数/通过数的写缓冲.
+
+        判题路径只在 redis 中原子地累加增量, 由 flush_problem_counters 定期批量写回
+        MySQL, 避免比赛期间 problem 表的同一行成为写热点. 读取时用数据库中的值
+        加上尚未写回的增量.
+    '''
+    key_prefix = "problem:counter:"
+    dirty_key = "problem:counter:dirty"
+    # flush 和 reconcile 互斥, 避免 reconcile 覆盖 flush 刚写回的增量
+    lock_key = "problem:counter:lock"
+    lock_timeout = 600
+
+    def __init__(self, redis=None):
+        self.redis = redis or get_redis_connection("default")
+
+    def _key(self, problem_id):
+        return f"{self.key_prefix}{problem_id}"
+
+    def incr(self, problem_id, total=0, solved=0):
+        pipe = self.redis.pipeline()
+        if total:
+            pipe.hincrby(self._key(problem_id), "total", total)
+        if solved:
+            pipe.hincrby(self._key(problem_id), "solved", solved)
+        pipe.sadd(self.dirty_key, problem_id)
+        pipe.execute()
+
+    def pending(self, problem_ids):
+        '''
+            Returns {problem_id: (total, solved)} of deltas not flushed yet.
+        '''
+        pipe = self.redis.pipeline()
+        for problem_id in problem_ids:
+            pipe.hgetall(self._key(problem_id))
+        ret = {}
+        for problem_id, delta in zip(problem_ids, pipe.execute()):
+            ret[problem_id] = (int(delta.get(b"total", 0)),
+                               int(delta.get(b"solved", 0)))
+        return ret
+
+    def with_pending(self, data):
+        '''
+            Add pending deltas to serialized problem(s).
+        '''
+        items = data if isinstance(data, list) else [data]
+        pending = self.pending([item['id'] for item in items])
+        for item in items:
+            total, solved = pending[item['id']]
+            item['total_submission_number'] += total
+            item['solved_submission_number'] += solved
+        return data
+
+    @contextmanager
+    def lock(self):
+        '''
+            Yields False if another flush or reconcile holds the lock.
+        '''
+        if not self.redis.set(self.lock_key, 1, nx=True, ex=self.lock_timeout):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self.redis.delete(self.lock_key)
+
+    def flush(self, batch_size=500):
+        '''
+            Write pending deltas back to the problem table. Returns the number
+            of problems updated, 0 if a reconcile is running.
+        '''
+        with self.lock() as locked:
+            if not locked:
+                return 0
+            return self._flush(batch_size)
+
+    def _flush(self, batch_size):
+        count = 0
+        while True:
+            problem_ids = self.redis.spop(self.dirty_key, batch_size)
+            if not problem_ids:
+                return count
+            # 取出并删除增量在同一个事务中完成, 不会丢失并发的累加
+            pipe = self.redis.pipeline(transaction=True)
+            for problem_id in problem_ids:
+                pipe.hgetall(self._key(int(problem_id)))
+                pipe.delete(self._key(int(problem_id)))
+            deltas = pipe.execute()[::2]
+            for problem_id, delta in zip(problem_ids, deltas):
+                total = int(delta.get(b"total", 0))
+                solved = int(delta.get(b"solved", 0))
+                if total or solved:
+                    Problem.objects.filter(id=int(problem_id)).update(
+                        total_submission_number=F('total_submission_number') + total,
+                        solved_submission_number=F('solved_submission_number') + solved)
+                    count += 1
+
+    def discard_pending(self):
+        '''
+            Drop every pending delta, used by reconcile_problem_counters under
+            lock() right before recounting from the submission table. Returns
+            the number of problems dropped.
+
+            只删除读到的 key, 并在同一个事务中从 dirty 集合移除; 之后并发的
+            incr 会重新创建 key 并标记为 dirty, 不会丢失.
+        '''
+        problem_ids = [key.decode()[len(self.key_prefix):]
+                       for key in self.redis.scan_iter(f"{self.key_prefix}*")]
+        problem_ids = [problem_id for problem_id in problem_ids if problem_id.isdigit()]
+        if not problem_ids:
+            return 0
+        pipe = self.redis.pipeline(transaction=True)
+        for problem_id in problem_ids:
+            pipe.delete(self._key(problem_id))
+        pipe.srem(self.dirty_key, *problem_ids)
+        pipe.execute()
+        return len(problem_ids)
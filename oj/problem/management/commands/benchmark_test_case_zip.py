@@ -0,0 +1,76 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+import zipfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from problem.utils import TestCaseZipProcessor
+
+
+class Command(BaseCommand):
+    help = ('Benchmark TestCaseZipProcessor.process_zip on a generated archive '
+            'with different numbers of extraction threads.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cases', type=int, default=10000,
+                            help='number of test cases, each is a .in and a .out member')
+        parser.add_argument('--size', type=int, default=16 * 1024,
+                            help='bytes per member')
+        parser.add_argument('--workers', default='1,2,4,8',
+                            help='thread counts to compare, "1,2,4,..."')
+        parser.add_argument('--repeat', type=int, default=1,
+                            help='runs per thread count, the best one is reported')
+
+    def handle(self, *args, **options):
+        try:
+            workers = [int(item) for item in options['workers'].split(',')]
+        except ValueError:
+            raise CommandError('invalid --workers')
+
+        work_dir = tempfile.mkdtemp(prefix='test_case_zip_')
+        try:
+            zip_path = os.path.join(work_dir, 'test_case.zip')
+            start = time.perf_counter()
+            self.generate(zip_path, options['cases'], options['size'])
+            self.stdout.write(f'generated {options["cases"] * 2} members, '
+                              f'{os.path.getsize(zip_path) / 1024 / 1024:.1f}MB compressed, '
+                              f'in {time.perf_counter() - start:.2f}s')
+
+            test_case_dir = os.path.join(work_dir, 'test_case')
+            os.mkdir(test_case_dir)
+            baseline = None
+            with override_settings(TEST_CASE_DIR=test_case_dir):
+                for count in workers:
+                    processor = TestCaseZipProcessor()
+                    processor.workers = count
+                    best = None
+                    for _ in range(options['repeat']):
+                        start = time.perf_counter()
+                        with open(zip_path, 'rb') as f:
+                            processor.process_zip(f)
+                        elapsed = time.perf_counter() - start
+                        # 同时清空 blob, 避免后面的运行因为去重而不用写文件
+                        shutil.rmtree(test_case_dir)
+                        os.mkdir(test_case_dir)
+                        best = elapsed if best is None else min(best, elapsed)
+                    baseline = baseline or best
+                    self.stdout.write(f'workers={count}: {best:.2f}s, '
+                                      f'{options["cases"] / best:.0f} cases/s, '
+                                      f'speedup {baseline / best:.2f}x')
+        finally:
+            shutil.rmtree(work_dir)
+
+    def generate(self, zip_path, cases, size):
+        rand = random.Random(0)
+        # 随机数字组成的数据, 压缩率接近真实的测试数据, 且以 CRLF 结尾
+        line = ' '.join(str(rand.randrange(10 ** 9)) for _ in range(16)).encode() + b'\r\n'
+        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+            for index in range(1, cases + 1):
+                for suffix in ('in', 'out'):
+                    offset = rand.randrange(len(line))
+                    content = (line[offset:] + line * (size // len(line) + 1))[:size]
+                    zip_file.writestr(f'{index}.{suffix}', content)
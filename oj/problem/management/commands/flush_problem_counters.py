@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from problem.counters import ProblemCounter
+
+
+class Command(BaseCommand):
+    help = 'Flush buffered problem submission counters from redis to the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0,
+                            help='keep flushing every INTERVAL seconds')
+
+    def handle(self, *args, **options):
+        counter = ProblemCounter()
+        while True:
+            count = counter.flush()
+            self.stdout.write(f'{count} problems flushed')
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
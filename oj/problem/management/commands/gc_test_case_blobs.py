@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from problem.utils import TestCaseZipProcessor
+
+
+class Command(BaseCommand):
+    help = 'Remove test case blobs that are no longer linked from any test case directory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=60 * 60,
+                            help='keep temporary files of uploads younger than MIN_AGE seconds')
+
+    def handle(self, *args, **options):
+        count = TestCaseZipProcessor().collect_garbage(min_age=options['min_age'])
+        self.stdout.write(f'{count} blobs removed')
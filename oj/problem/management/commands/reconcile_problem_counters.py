@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Q
+
+from problem.counters import ProblemCounter
+from problem.models import Problem
+from submission.models import Submission, JudgeStatus
+
+
+class Command(BaseCommand):
+    help = 'Rebuild problem submission counters from the submission table.'
+
+    def handle(self, *args, **options):
+        counter = ProblemCounter()
+        with counter.lock() as locked:
+            if not locked:
+                raise CommandError('flush_problem_counters or another reconcile is running')
+            # 重新统计后, redis 中尚未写回的增量已经包含在内
+            counter.discard_pending()
+            self.reconcile()
+
+    def reconcile(self):
+        counts = {item['problem_id']: item for item in Submission.objects.values('problem_id').annotate(
+            total=Count('id'), solved=Count('id', filter=Q(result=JudgeStatus.ACCEPTED)))}
+
+        problems = list(Problem.objects.only(
+            'id', 'total_submission_number', 'solved_submission_number'))
+        for problem in problems:
+            item = counts.get(problem.id, {'total': 0, 'solved': 0})
+            problem.total_submission_number = item['total']
+            problem.solved_submission_number = item['solved']
+        Problem.objects.bulk_update(
+            problems, ['total_submission_number', 'solved_submission_number'], batch_size=500)
+        self.stdout.write(f'{len(problems)} problems reconciled')
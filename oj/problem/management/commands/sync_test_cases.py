@@ -0,0 +1,57 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from problem.models import Problem
+from problem.sync import TestCaseSyncer, TestCaseSyncError
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Sync uploaded test cases to all judge servers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='exit when the sync queue is empty')
+        parser.add_argument('--test-case', default=None,
+                            help='sync this test case id now instead of draining the queue')
+        parser.add_argument('--all', action='store_true',
+                            help='sync the test cases of every problem now, e.g. after adding a judge server')
+
+    def handle(self, *args, **options):
+        syncer = TestCaseSyncer()
+        if options['test_case'] or options['all']:
+            if options['test_case']:
+                test_case_ids = [options['test_case']]
+            else:
+                test_case_ids = Problem.objects.exclude(test_case_id__isnull=True).exclude(
+                    test_case_id='').values_list('test_case_id', flat=True).distinct()
+            for test_case_id in test_case_ids:
+                self.report(test_case_id, syncer.sync(test_case_id))
+            return
+
+        self.stdout.write('test case sync worker started')
+        while True:
+            try:
+                ret = syncer.run(timeout=1 if options['once'] else 0)
+            except TestCaseSyncError as e:
+                # 测试数据在本地已被删除
+                self.stderr.write(str(e))
+                continue
+            except Exception as e:
+                # 任务已由 TestCaseSyncer.run 放回队列
+                logger.exception(e)
+                time.sleep(1)
+                continue
+            if ret is None:
+                if options['once']:
+                    return
+                continue
+            self.report(*ret)
+
+    def report(self, test_case_id, status):
+        self.stdout.write(f'{test_case_id}: ' + ', '.join(
+            f'{address} {item}' for address, item in sorted(status.items())))
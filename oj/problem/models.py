@@ -15,6 +15,13 @@ class ProblemDifficulty(object):
     Low = 'Low'
 
 
+class ProblemRuleType(object):
+    # 遇到第一个未通过的测试点即给出结果
+    ACM = 'ACM'
+    # 运行全部测试点, 按通过比例计分
+    OI = 'OI'
+
+
 class Problem(models.Model):
     id = models.AutoField(primary_key=True)
     title = models.CharField(max_length=255)
@@ -45,6 +52,23 @@ class Problem(models.Model):
     # JAVA, python, etc.
     other_time_limit = models.IntegerField(default=2000)
     other_memory_limit = models.IntegerField(default=512)
+    rule_type = models.CharField(max_length=10, default=ProblemRuleType.ACM)
+    # 先用样例判题, 未通过样例时不再运行完整的测试数据
+    sample_preflight = models.BooleanField(default=False)
+    # ACM 题目分批发送测试点, 遇到第一个错误即停止, 只适用于测试数据很小的题目.
+    # 未开启或测试数据超过 ACM_FAIL_FAST_SIZE_LIMIT 时, JudgeServer 仍会运行全部测试点,
+    # 只是结果保留到第一个错误的测试点
+    fail_fast = models.BooleanField(
+        default=False,
+        help_text='ACM only: stop at the first failed test case. Applies only when the test data is at '
+                  'most ACM_FAIL_FAST_SIZE_LIMIT bytes; otherwise every test case still runs on the '
+                  'judge server and only the verdict is cut at the first failure.')
+    # special judge
+    spj = models.BooleanField(default=False)
+    spj_language = models.CharField(max_length=32, null=True)
+    spj_code = models.TextField(null=True)
+    # md5(spj_language + spj_code), 评测机上的 checker 按版本编译一次
+    spj_version = models.CharField(max_length=32, null=True)
 
     def __repr__(self):
         return f"<Problem {self.title}: id={self.id}>"
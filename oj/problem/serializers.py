@@ -5,7 +5,8 @@ from django import forms
 class ProblemSerializer(serializers.ModelSerializer):
     class Meta:
         model = Problem
-        fields = '__all__'
+        # spj 代码不对外公开
+        exclude = ['spj_code']
 
 
 class CreateProblemSerializer(serializers.ModelSerializer):
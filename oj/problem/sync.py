@@ -0,0 +1,253 @@
+import hashlib
+import json
+import logging
+import os
+import shlex
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from utils.judger.pool import get_judge_pool, TestCaseSyncStatus
+
+from .utils import read_test_case_info
+
+
+logger = logging.getLogger(__name__)
+
+
+class TestCaseSyncError(Exception):
+    pass
+
+
+class TestCaseSyncer(object):
+    '''
+        把测试数据同步到所有评测机:
+        >>> TestCaseSyncer().schedule(test_case_id, old_test_case_id)  # 上传接口中
+        >>> TestCaseSyncer().run()  # sync_test_cases worker 中
+
+        每台评测机上已有的文件记录在 judge:server:<address>:blobs 中
+        (sha256 -> "<test_case_id>/<文件名>"). 同步时与新测试数据的 manifest
+        (info 中的 files) 比较, 已有的文件在评测机上直接硬链接, 只用 rsync
+        传输缺少的文件; 然后在评测机上计算 sha256 校验全部文件, 通过后才把
+        该评测机标记为 ready, 此前判题不会使用这台评测机. 旧版本在新版本
+        ready 后删除. 重新同步已经 ready 的测试数据时先在评测机上校验, 文件
+        一致时不传输, 不一致时才标记为 pending, 不会中断这道题的判题.
+
+        多台评测机并行同步, 失败时重试 max_attempts 次, 重试时不再复用已有
+        文件而是完整传输.
+    '''
+    queue_key = "test_case:sync:queue"
+    max_attempts = 3
+    # 同步过程中出现意外错误时放回队列的最大次数
+    max_requeues = 3
+    # 单位秒, 第 n 次重试前等待 retry_delay * 2 ** (n - 1)
+    retry_delay = 2
+
+    def __init__(self, pool=None, redis=None):
+        self.pool = pool or get_judge_pool()
+        self.redis = redis or get_redis_connection("default")
+
+    def _blobs_key(self, server):
+        return f"{self.pool.key_prefix}{server.address}:blobs"
+
+    def schedule(self, test_case_id, old_test_case_id=None):
+        '''
+            Mark the test case pending on every judge server and queue it for
+            the sync worker.
+        '''
+        self.pool.set_test_case_status(test_case_id, TestCaseSyncStatus.PENDING)
+        self.redis.rpush(self.queue_key, json.dumps(
+            {"test_case_id": test_case_id, "old_test_case_id": old_test_case_id}))
+
+    def run(self, timeout=0):
+        '''
+            Sync the next queued test case. Returns (test_case_id, per-server
+            status), or None if the queue stayed empty for `timeout` seconds.
+            The task is queued again if the sync raises an unexpected error.
+        '''
+        item = self.redis.blpop([self.queue_key], timeout=timeout)
+        if item is None:
+            return None
+        task = json.loads(item[1])
+        try:
+            return task["test_case_id"], self.sync(task["test_case_id"], task.get("old_test_case_id"))
+        except TestCaseSyncError:
+            raise
+        except Exception:
+            # 意外错误(例如 redis 连接中断)时放回队列, 多次失败后把仍在等待的评测机标记为 failed
+            task["requeues"] = task.get("requeues", 0) + 1
+            if task["requeues"] <= self.max_requeues:
+                self.redis.rpush(self.queue_key, json.dumps(task))
+            else:
+                self._fail_pending(task["test_case_id"])
+            raise
+
+    def _fail_pending(self, test_case_id):
+        statuses = self.pool.test_case_status(test_case_id)
+        self.pool.set_test_case_status(
+            test_case_id, TestCaseSyncStatus.FAILED,
+            [server for server in self.pool.servers
+             if statuses.get(server.address) == TestCaseSyncStatus.PENDING])
+
+    def manifest(self, test_case_id):
+        '''
+            {file name: sha256} of every file of the test case, "info" included.
+        '''
+        test_case_dir = os.path.join(settings.TEST_CASE_DIR, test_case_id)
+        info = read_test_case_info(test_case_id)
+        if info is None:
+            raise TestCaseSyncError(f"test case {test_case_id} does not exist")
+        # 内容寻址存储之前上传的测试数据没有 files, 直接计算
+        files = dict(info.get("files") or {})
+        names = [name for name in os.listdir(test_case_dir) if name not in files]
+        for name in names:
+            with open(os.path.join(test_case_dir, name), "rb") as f:
+                files[name] = hashlib.file_digest(f, "sha256").hexdigest()
+        return files
+
+    def sync(self, test_case_id, old_test_case_id=None, servers=None):
+        '''
+            Sync the test case to `servers` (all registered judge servers by
+            default) in parallel. Returns {address: TestCaseSyncStatus}.
+        '''
+        servers = self.pool.servers if servers is None else servers
+        try:
+            files = self.manifest(test_case_id)
+        except TestCaseSyncError:
+            # 本地测试数据不存在, 重试也不会成功
+            self._fail_pending(test_case_id)
+            raise
+        statuses = self.pool.test_case_status(test_case_id)
+        ready = {server.address for server in servers
+                 if statuses.get(server.address) == TestCaseSyncStatus.READY}
+        self.pool.set_test_case_status(test_case_id, TestCaseSyncStatus.PENDING,
+                                       [server for server in servers if server.address not in ready])
+        if not servers:
+            return {}
+        with ThreadPoolExecutor(max_workers=len(servers)) as executor:
+            statuses = executor.map(
+                lambda server: self._sync_server(server, test_case_id, files, old_test_case_id,
+                                                 ready=server.address in ready), servers)
+            return {server.address: status for server, status in zip(servers, statuses)}
+
+    def _sync_server(self, server, test_case_id, files, old_test_case_id, ready=False):
+        '''
+            :param ready: the test case is ready on the server, keep judging
+                on it unless its files turn out to differ
+        '''
+        if not (ready and self._matches(server, test_case_id, files)):
+            if ready:
+                self.pool.set_test_case_status(test_case_id, TestCaseSyncStatus.PENDING, [server])
+            if not self._transfer_with_retries(server, test_case_id, files):
+                self.pool.set_test_case_status(test_case_id, TestCaseSyncStatus.FAILED, [server])
+                return TestCaseSyncStatus.FAILED
+
+        self.redis.hset(self._blobs_key(server),
+                        mapping={sha256: f"{test_case_id}/{name}" for name, sha256 in files.items()})
+        self.pool.set_test_case_status(test_case_id, TestCaseSyncStatus.READY, [server])
+        if old_test_case_id and old_test_case_id != test_case_id:
+            self._remove_old(server, old_test_case_id)
+        return TestCaseSyncStatus.READY
+
+    def _matches(self, server, test_case_id, files):
+        try:
+            self._verify(server, test_case_id, files)
+        except TestCaseSyncError as e:
+            logger.warning(f"test case {test_case_id} on {server.address} differs: {e}")
+            return False
+        return True
+
+    def _transfer_with_retries(self, server, test_case_id, files):
+        for attempt in range(self.max_attempts):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                self._transfer(server, test_case_id, files, reuse=not attempt)
+                self._verify(server, test_case_id, files)
+                return True
+            except TestCaseSyncError as e:
+                logger.warning(f"sync test case {test_case_id} to {server.address} failed "
+                               f"(attempt {attempt + 1}/{self.max_attempts}): {e}")
+        return False
+
+    def _transfer(self, server, test_case_id, files, reuse=True):
+        links = {}
+        if reuse:
+            paths = self.redis.hmget(self._blobs_key(server), list(files.values()))
+            links = {name: path.decode() for name, path in zip(files, paths)
+                     if path is not None and not path.decode().startswith(f"{test_case_id}/")}
+        self.link(server, test_case_id, links)
+        self.push(server, test_case_id, [name for name in files if name not in links])
+
+    def _verify(self, server, test_case_id, files):
+        checksums = self.checksums(server, test_case_id, list(files))
+        mismatched = [name for name, sha256 in files.items() if checksums.get(name) != sha256]
+        if mismatched:
+            raise TestCaseSyncError(f"checksum mismatch: {', '.join(sorted(mismatched)[:10])}")
+
+    def _remove_old(self, server, test_case_id):
+        try:
+            self.remove(server, test_case_id)
+        except TestCaseSyncError as e:
+            logger.warning(f"failed to remove test case {test_case_id} on {server.address}: {e}")
+            return
+        self.pool.set_test_case_status(test_case_id, TestCaseSyncStatus.REMOVED, [server])
+        info = read_test_case_info(test_case_id) or {}
+        key = self._blobs_key(server)
+        for name, sha256 in (info.get("files") or {}).items():
+            # 新版本中相同的文件已经指向新目录, 只删除仍指向旧目录的
+            if self.redis.hget(key, sha256) == f"{test_case_id}/{name}".encode():
+                self.redis.hdel(key, sha256)
+
+    # 以下是评测机上的操作, 通过 ssh 和 rsync 完成
+
+    def _run(self, command, input=None):
+        try:
+            result = subprocess.run(command, input=input, check=True,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError) as e:
+            stderr = getattr(e, "stderr", None)
+            raise TestCaseSyncError(stderr.decode() if stderr else str(e))
+        return result.stdout.decode()
+
+    def _remote_dir(self, test_case_id):
+        return f"{settings.JUDGE_SERVER_TEST_CASE_DIR}/{test_case_id}"
+
+    def link(self, server, test_case_id, links):
+        '''
+            Create the test case directory on the server and hardlink
+            {file name: "<test_case_id>/<file name>"} into it.
+        '''
+        root = settings.JUDGE_SERVER_TEST_CASE_DIR
+        dst_dir = self._remote_dir(test_case_id)
+        script = ["set -e", f"mkdir -p {shlex.quote(dst_dir)}"]
+        for name, path in links.items():
+            script.append(f"ln -f {shlex.quote(f'{root}/{path}')} {shlex.quote(f'{dst_dir}/{name}')}")
+        self._run(['ssh', f'root@{server.host}', 'sh', '-s'], input="\n".join(script).encode())
+
+    def push(self, server, test_case_id, names):
+        if not names:
+            return
+        src_dir = os.path.join(settings.TEST_CASE_DIR, test_case_id, "")
+        dst_dir = f'root@{server.host}:{self._remote_dir(test_case_id)}/'
+        self._run(['rsync', '-az', '-e', 'ssh', '--files-from=-', src_dir, dst_dir],
+                  input="\n".join(names).encode())
+
+    def checksums(self, server, test_case_id, names):
+        '''
+            {file name: sha256} of the files on the server. Raises
+            TestCaseSyncError if any of them is missing, as sha256sum fails.
+        '''
+        output = self._run(['ssh', f'root@{server.host}', 'cd', shlex.quote(self._remote_dir(test_case_id)),
+                            '&&', 'xargs', 'sha256sum', '--'], input="\n".join(names).encode())
+        ret = {}
+        for line in output.splitlines():
+            sha256, _, name = line.partition("  ")
+            ret[name] = sha256
+        return ret
+
+    def remove(self, server, test_case_id):
+        self._run(['ssh', f'root@{server.host}', 'rm', '-rf', shlex.quote(self._remote_dir(test_case_id))])
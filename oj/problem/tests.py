@@ -1,15 +1,28 @@
+import hashlib
+import json
 import urllib
 import os
+import shutil
+import tempfile
+import time
+import zipfile
+from unittest import mock
+from django.conf import settings
 from django.test import TestCase
+from django.test.utils import override_settings
+from django_redis import get_redis_connection
 from rest_framework.reverse import reverse
 from django.core.files.uploadedfile import SimpleUploadedFile
 
 from utils.api import APIClient
+from utils.judger.pool import JudgeServerStatus, TestCaseSyncFailed, get_judge_pool
 from account.models import User, Role
 
 from .serializers import TestCaseUploadForm
 from .models import Problem
-from .utils import create_test_case_zip, TestCaseZipProcessor
+from .utils import create_test_case_zip, read_test_case_info, test_case_blob_path, TestCaseZipProcessor
+from .counters import ProblemCounter
+from .sync import TestCaseSyncer, TestCaseSyncError
 
 test_problem = {
     "title": "Hello SWUFE OJ!",
@@ -26,7 +39,7 @@ testcase = [
     {"filename": "1.out", "content": "Hello SWUFE OJ!"}
 ]
 
-encoded_data = urllib.parse.urlencode(test_problem)
+encoded_data = urllib.parse.urlencode({**test_problem, "samples": json.dumps(test_problem["samples"])})
 
 
 class ProblemCreateAPITest(TestCase):
@@ -57,6 +70,19 @@ class ProblemCreateAPITest(TestCase):
         data = response.data['data']
         self.assertEqual(data['title'], test_problem['title'])
         self.assertEqual(data['is_remote'], False)
+        self.assertEqual(data['samples'], test_problem['samples'])
+
+    def test_create_problem_invalid_samples(self):
+        self.url = reverse('create_problem')
+        self.client.token_auth(self.admin_user)
+
+        for samples in ("input: 1", json.dumps("1 2"), json.dumps([{"input": "1 2"}])):
+            response = self.client.post(
+                self.url, urllib.parse.urlencode({**test_problem, "samples": samples}),
+                content_type='application/x-www-form-urlencoded'
+            )
+            self.assertEqual(response.data['error'], 'error')
+        self.assertFalse(Problem.objects.exists())
 
     def test_create_problem_no_permission(self):
         self.url = reverse('create_problem')
@@ -112,6 +138,47 @@ class ProblemListAPITest(TestCase):
         self.assertEqual(data[0]['title'], self.p1.title)
 
 
+class ProblemCounterTest(TestCase):
+    def setUp(self):
+        self.problem = Problem.objects.create(**test_problem)
+        self.counter = ProblemCounter()
+        self.clear_counter()
+
+    def tearDown(self):
+        self.clear_counter()
+
+    def clear_counter(self):
+        # 测试数据库中的题目 id 每次运行都会重复, 清理之前运行遗留在 redis 中的增量
+        self.counter.redis.delete(self.counter._key(self.problem.id))
+        self.counter.redis.srem(self.counter.dirty_key, self.problem.id)
+
+    def test_flush(self):
+        self.counter.incr(self.problem.id, total=1, solved=1)
+        self.counter.incr(self.problem.id, total=1)
+
+        # readers see db value plus pending delta
+        response = APIClient().get(reverse('get_problem', args=[self.problem.id]))
+        self.assertEqual(response.data['data']['total_submission_number'], 2)
+        self.assertEqual(Problem.objects.get(id=self.problem.id).total_submission_number, 0)
+
+        self.counter.flush()
+        problem = Problem.objects.get(id=self.problem.id)
+        self.assertEqual(problem.total_submission_number, 2)
+        self.assertEqual(problem.solved_submission_number, 1)
+        self.assertEqual(self.counter.pending([self.problem.id]), {self.problem.id: (0, 0)})
+
+    def test_reconcile_locked(self):
+        self.counter.incr(self.problem.id, total=1)
+        with self.counter.lock() as locked:
+            self.assertTrue(locked)
+            # reconcile 进行中时 flush 不写回
+            self.assertEqual(ProblemCounter().flush(), 0)
+            self.counter.discard_pending()
+            self.counter.incr(self.problem.id, total=1)
+        self.counter.flush()
+        self.assertEqual(Problem.objects.get(id=self.problem.id).total_submission_number, 1)
+
+
 class TestCaseAPITest(TestCase, TestCaseZipProcessor):
     def setUp(self):
         self.client = APIClient()
@@ -138,3 +205,242 @@ class TestCaseAPITest(TestCase, TestCaseZipProcessor):
 
         self.rsync_test_cases(data['test_case_id'], delete=True)
         os.remove(self.filename)
+
+    def test_extract_test_case(self):
+        content = b"1 2\r\n3 4\r\n  \r\n\t\r\n"
+        create_test_case_zip(self.filename, [{"filename": "1.out", "content": content}])
+        # \r\n 跨越读取块的边界
+        self.chunk_size = 4
+        with zipfile.ZipFile(self.filename) as zip_file:
+            size, md5, sha256 = self.extract_test_case(zip_file, "1.out", "1.out", output=True)
+        with open("1.out", "rb") as f:
+            extracted = f.read()
+        os.remove("1.out")
+        os.remove(self.filename)
+
+        normalized = content.replace(b"\r\n", b"\n")
+        self.assertEqual(extracted, normalized)
+        self.assertEqual(size, len(normalized))
+        self.assertEqual(md5, hashlib.md5(normalized.rstrip()).hexdigest())
+        self.assertEqual(sha256, hashlib.sha256(normalized).hexdigest())
+
+    def test_process_zip_parallel(self):
+        cases = [{"filename": f"{index}.{suffix}", "content": f"{index} {suffix}\r\n" * index}
+                 for index in range(1, 21) for suffix in ("in", "out")]
+        create_test_case_zip(self.filename, cases)
+        self.assertEqual(self.filter_name_list(["2.in", "1.in", "2.out", "1.out", "3.in"], spj=False),
+                         ["1.in", "1.out", "2.in", "2.out"])
+
+        manifests = []
+        for workers in (1, 4):
+            self.workers, self.batch_size = workers, 3
+            with open(self.filename, "rb") as f:
+                info, test_case_id = self.process_zip(f)
+            manifests.append(info)
+            shutil.rmtree(os.path.join(settings.TEST_CASE_DIR, test_case_id))
+        os.remove(self.filename)
+        self.assertEqual(len(manifests[0]), 20)
+        self.assertEqual(manifests[0], manifests[1])
+
+    def test_deduplicate_test_cases(self):
+        cases = [{"filename": f"{index}.{suffix}", "content": f"{index} {suffix}"}
+                 for index in range(1, 4) for suffix in ("in", "out")]
+        test_case_ids = []
+        for content in ("3 out", "changed"):
+            cases[-1]["content"] = content
+            create_test_case_zip(self.filename, cases)
+            with open(self.filename, "rb") as f:
+                test_case_ids.append(self.process_zip(f)[1])
+        os.remove(self.filename)
+
+        old, new = (os.path.join(settings.TEST_CASE_DIR, test_case_id) for test_case_id in test_case_ids)
+        # 未改变的文件是同一个 blob 的硬链接
+        self.assertTrue(os.path.samefile(os.path.join(old, "1.in"), os.path.join(new, "1.in")))
+        self.assertFalse(os.path.samefile(os.path.join(old, "3.out"), os.path.join(new, "3.out")))
+        info = read_test_case_info(test_case_ids[1])
+        self.assertEqual(info["files"]["3.out"], hashlib.sha256(b"changed").hexdigest())
+
+        shutil.rmtree(old)
+        self.assertGreaterEqual(self.collect_garbage(), 1)
+        self.assertFalse(os.path.exists(test_case_blob_path(hashlib.sha256(b"3 out").hexdigest())))
+        self.assertTrue(os.path.exists(test_case_blob_path(info["files"]["1.in"])))
+        shutil.rmtree(new)
+
+    def test_store_test_case_after_blob_removed(self):
+        cases = [{"filename": "1.in", "content": "gc race"}, {"filename": "1.out", "content": "gc race out"}]
+        create_test_case_zip(self.filename, cases)
+        with open(self.filename, "rb") as f:
+            old = self.process_zip(f)[1]
+        shutil.rmtree(os.path.join(settings.TEST_CASE_DIR, old))
+        blob_path = test_case_blob_path(hashlib.sha256(b"gc race").hexdigest())
+        self.assertTrue(os.path.exists(blob_path))
+
+        # collect_garbage 在上传发现 blob 已存在之后、链接之前删除了它
+        link_or_copy = self._link_or_copy
+
+        def collect_then_link(src, dst):
+            if src == blob_path and os.path.exists(blob_path):
+                self.collect_garbage()
+            link_or_copy(src, dst)
+        self._link_or_copy = collect_then_link
+        with open(self.filename, "rb") as f:
+            new = self.process_zip(f)[1]
+        os.remove(self.filename)
+
+        with open(os.path.join(settings.TEST_CASE_DIR, new, "1.in"), "rb") as f:
+            self.assertEqual(f.read(), b"gc race")
+        self.assertTrue(os.path.samefile(blob_path, os.path.join(settings.TEST_CASE_DIR, new, "1.in")))
+        shutil.rmtree(os.path.join(settings.TEST_CASE_DIR, new))
+
+
+class LocalTestCaseSyncer(TestCaseSyncer):
+    '''
+        评测机目录为本地的 JUDGE_SERVER_TEST_CASE_DIR/<address>, 记录传输的文件.
+    '''
+    retry_delay = 0
+
+    def __init__(self, *args, corrupt=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.corrupt = corrupt
+        self.pushed = {}
+
+    def _dir(self, server, test_case_id):
+        return os.path.join(settings.JUDGE_SERVER_TEST_CASE_DIR, server.address, test_case_id)
+
+    def link(self, server, test_case_id, links):
+        os.makedirs(self._dir(server, test_case_id), exist_ok=True)
+        for name, path in links.items():
+            os.link(os.path.join(settings.JUDGE_SERVER_TEST_CASE_DIR, server.address, path),
+                    os.path.join(self._dir(server, test_case_id), name))
+
+    def push(self, server, test_case_id, names):
+        self.pushed.setdefault(server.address, []).extend(names)
+        for name in names:
+            dst = os.path.join(self._dir(server, test_case_id), name)
+            shutil.copyfile(os.path.join(settings.TEST_CASE_DIR, test_case_id, name), dst)
+            if server.address in self.corrupt:
+                with open(dst, "ab") as f:
+                    f.write(b"partial")
+
+    def checksums(self, server, test_case_id, names):
+        ret = {}
+        for name in names:
+            try:
+                with open(os.path.join(self._dir(server, test_case_id), name), "rb") as f:
+                    ret[name] = hashlib.sha256(f.read()).hexdigest()
+            except OSError as e:
+                raise TestCaseSyncError(str(e))
+        return ret
+
+    def remove(self, server, test_case_id):
+        shutil.rmtree(self._dir(server, test_case_id))
+
+
+class TestCaseSyncTest(TestCase, TestCaseZipProcessor):
+    def setUp(self):
+        self.filename = "test_case.zip"
+        self.remote_dir = tempfile.mkdtemp()
+        self.enterContext(override_settings(JUDGE_SERVER_TEST_CASE_DIR=self.remote_dir,
+                                            JUDGE_SERVERS=["10.0.0.2:12358", "10.0.0.3:12358"]))
+        self.pool = get_judge_pool()
+        self.test_case_ids = []
+        # 其他测试上传测试数据时也会加入同步队列
+        self.clear_keys()
+
+    def tearDown(self):
+        shutil.rmtree(self.remote_dir)
+        self.clear_keys()
+        for test_case_id in self.test_case_ids:
+            shutil.rmtree(os.path.join(settings.TEST_CASE_DIR, test_case_id), ignore_errors=True)
+
+    def clear_keys(self):
+        syncer = LocalTestCaseSyncer()
+        keys = [syncer.queue_key, *(self.pool._test_case_key(test_case_id) for test_case_id in self.test_case_ids)]
+        for server in self.pool.servers:
+            keys += [self.pool._key(server), syncer._blobs_key(server)]
+        get_redis_connection("default").delete(*keys)
+
+    def upload(self, content):
+        cases = [{"filename": "1.in", "content": "1"}, {"filename": "1.out", "content": "1"},
+                 {"filename": "2.in", "content": "2"}, {"filename": "2.out", "content": content}]
+        create_test_case_zip(self.filename, cases)
+        with open(self.filename, "rb") as f:
+            test_case_id = self.process_zip(f)[1]
+        os.remove(self.filename)
+        self.test_case_ids.append(test_case_id)
+        return test_case_id
+
+    def test_sync(self):
+        old = self.upload("2")
+        syncer = LocalTestCaseSyncer()
+        syncer.schedule(old)
+        self.assertFalse(self.pool.is_test_case_ready(self.pool.servers[0], old))
+        self.assertEqual(syncer.run(), (old, {"10.0.0.2:12358": "ready", "10.0.0.3:12358": "ready"}))
+        self.assertEqual(len(syncer.pushed["10.0.0.2:12358"]), 5)
+
+        # 只传输改变的文件和 info, 同步完成后删除旧版本
+        new = self.upload("changed")
+        syncer = LocalTestCaseSyncer(corrupt=["10.0.0.3:12358"])
+        syncer.schedule(new, old)
+        syncer.run()
+        self.assertEqual(sorted(syncer.pushed["10.0.0.2:12358"]), ["2.out", "info"])
+        self.assertEqual(self.pool.test_case_status(new),
+                         {"10.0.0.2:12358": "ready", "10.0.0.3:12358": "failed"})
+        self.assertEqual(self.pool.test_case_status(old)["10.0.0.2:12358"], "removed")
+        self.assertFalse(os.path.exists(os.path.join(self.remote_dir, "10.0.0.2:12358", old)))
+        self.assertTrue(os.path.exists(os.path.join(self.remote_dir, "10.0.0.3:12358", old)))
+
+        # 没有同步记录的测试数据可以在任意评测机上判题
+        self.assertTrue(self.pool.is_test_case_ready(self.pool.servers[1], "legacy"))
+        self.assertFalse(self.pool.is_test_case_ready(self.pool.servers[1], new))
+
+    def test_resync_ready(self):
+        test_case_id = self.upload("2")
+        syncer = LocalTestCaseSyncer()
+        syncer.schedule(test_case_id)
+        syncer.run()
+
+        # 文件一致时不传输, 同步过程中保持 ready
+        syncer = LocalTestCaseSyncer()
+        syncer.push = mock.Mock(side_effect=AssertionError("should not transfer"))
+        self.assertEqual(syncer.sync(test_case_id), {"10.0.0.2:12358": "ready", "10.0.0.3:12358": "ready"})
+
+        # 评测机上的文件被修改后只重新传输这一台
+        with open(os.path.join(self.remote_dir, "10.0.0.3:12358", test_case_id, "2.out"), "ab") as f:
+            f.write(b"changed")
+        syncer = LocalTestCaseSyncer()
+        syncer.sync(test_case_id)
+        self.assertEqual(list(syncer.pushed), ["10.0.0.3:12358"])
+        self.assertEqual(set(self.pool.test_case_status(test_case_id).values()), {"ready"})
+
+    def test_sync_missing_test_case(self):
+        syncer = LocalTestCaseSyncer()
+        syncer.schedule("missing")
+        self.test_case_ids.append("missing")
+        with self.assertRaises(TestCaseSyncError):
+            syncer.run()
+        self.assertEqual(set(self.pool.test_case_status("missing").values()), {"failed"})
+
+    def test_sync_failed(self):
+        test_case_id = self.upload("2")
+        syncer = LocalTestCaseSyncer(corrupt=["10.0.0.2:12358", "10.0.0.3:12358"])
+        syncer.schedule(test_case_id)
+        syncer.run()
+        # 在所有评测机上都同步失败时判题直接报错, 不再放回判题队列
+        for server in self.pool.servers:
+            self.pool.redis.hset(self.pool._key(server), mapping={
+                "status": JudgeServerStatus.NORMAL, "last_heartbeat": time.time()})
+        with self.assertRaises(TestCaseSyncFailed):
+            self.pool.choose(test_case_id)
+
+    def test_sync_requeue(self):
+        test_case_id = self.upload("2")
+        syncer = LocalTestCaseSyncer()
+        syncer.manifest = mock.Mock(side_effect=OSError("disk error"))
+        syncer.schedule(test_case_id)
+        for _ in range(syncer.max_requeues + 1):
+            with self.assertRaises(OSError):
+                syncer.run()
+        # 超过重试次数后不再放回队列, 标记为 failed
+        self.assertIsNone(syncer.run(timeout=1))
+        self.assertEqual(set(self.pool.test_case_status(test_case_id).values()), {"failed"})
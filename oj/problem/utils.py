@@ -6,6 +6,10 @@ import subprocess
 import random
 import string
 import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from utils.api import APIError
 from django.conf import settings
@@ -56,7 +60,188 @@ def create_test_case_zip(zip_file_name: str, test_cases: list[dict], export_dir=
         return f.read()
 
 
+def read_test_case_info(test_case_id):
+    '''
+        The `info` manifest written by process_zip, None if it is not on disk.
+    '''
+    try:
+        with open(os.path.join(settings.TEST_CASE_DIR, test_case_id, "info"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def diff_test_cases(old_info, new_info):
+    '''
+        Match the test cases of two manifests by content. Returns
+        {new test case: old test case with the same input and output, or None}.
+        e.g. 在 3 个测试点的题目前面插入一个新测试点:
+        >>> diff_test_cases(old_info, new_info)
+        {'1': None, '2': '1', '3': '2', '4': '3'}
+    '''
+    def fingerprint(item):
+        # 旧的 manifest 没有 input_md5, 无法匹配
+        if "input_md5" not in item:
+            return None
+        return item["input_md5"], item.get("stripped_output_md5")
+
+    old_cases = {}
+    for name, item in old_info["test_cases"].items():
+        key = fingerprint(item)
+        if key is not None:
+            old_cases.setdefault(key, name)
+    return {name: old_cases.get(fingerprint(item))
+            for name, item in new_info["test_cases"].items()}
+
+
+class StrippedMD5(object):
+    '''
+        Incremental md5 of the stream with trailing whitespace stripped, i.e.
+        md5(content.rstrip()). Whitespace is only hashed once some
+        non-whitespace follows; until then it is kept in a spooled temporary
+        file so long whitespace runs don't grow the memory.
+    '''
+
+    def __init__(self, max_size=1024 * 1024):
+        self.md5 = hashlib.md5()
+        self.pending = tempfile.SpooledTemporaryFile(max_size=max_size)
+
+    def update(self, chunk):
+        stripped = chunk.rstrip()
+        if not stripped:
+            self.pending.write(chunk)
+            return
+        if self.pending.tell():
+            self.pending.seek(0)
+            for block in iter(lambda: self.pending.read(1024 * 1024), b""):
+                self.md5.update(block)
+            self.pending.seek(0)
+            self.pending.truncate()
+        self.md5.update(stripped)
+        self.pending.write(chunk[len(stripped):])
+
+    def hexdigest(self):
+        self.pending.close()
+        return self.md5.hexdigest()
+
+
+def test_case_blob_dir():
+    '''
+        测试数据文件按内容的 sha256 保存在 TEST_CASE_DIR/blobs 下, 各个
+        test_case_id 目录中的文件都是指向这里的硬链接.
+    '''
+    return os.path.join(settings.TEST_CASE_DIR, "blobs")
+
+
+def test_case_blob_path(sha256):
+    return os.path.join(test_case_blob_dir(), sha256[:2], sha256)
+
+
 class TestCaseZipProcessor(object):
+    # 解压测试数据时每次读取的字节数
+    chunk_size = 1024 * 1024
+    # 并行解压的线程数, 为空时使用 settings.TEST_CASE_EXTRACT_WORKERS
+    workers = None
+    # 每个线程一次处理的文件数
+    batch_size = 64
+
+    def extract_test_case(self, zip_file, member, path, output=False):
+        '''
+            Stream a zip member to `path` with CRLF turned into LF, in chunks
+            of `chunk_size` bytes. Returns (size, md5, sha256) of the normalized
+            content; for output files the md5 is of the content with trailing
+            whitespace stripped.
+        '''
+        md5 = StrippedMD5() if output else hashlib.md5()
+        sha256 = hashlib.sha256()
+        size = 0
+        carry = b""
+        with zip_file.open(member) as src, open(path, "wb") as dst:
+            while True:
+                chunk = src.read(self.chunk_size)
+                if not chunk:
+                    break
+                chunk = carry + chunk
+                # \r\n 可能被分在两个块中, 末尾的 \r 留到下一块再处理
+                if chunk.endswith(b"\r"):
+                    chunk, carry = chunk[:-1], b"\r"
+                else:
+                    carry = b""
+                chunk = chunk.replace(b"\r\n", b"\n")
+                size += len(chunk)
+                md5.update(chunk)
+                sha256.update(chunk)
+                dst.write(chunk)
+            if carry:
+                size += len(carry)
+                md5.update(carry)
+                sha256.update(carry)
+                dst.write(carry)
+        return size, md5.hexdigest(), sha256.hexdigest()
+
+    def store_test_case(self, zip_file, member, path, output=False):
+        '''
+            Extract a zip member into the blob store and hardlink it to `path`.
+            A member with the same content as an existing blob takes no extra
+            disk space. Returns the same as extract_test_case.
+        '''
+        blob_dir = test_case_blob_dir()
+        os.makedirs(blob_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=blob_dir, prefix=".tmp-")
+        os.close(fd)
+        try:
+            size, md5, sha256 = self.extract_test_case(zip_file, member, tmp_path, output=output)
+            blob_path = test_case_blob_path(sha256)
+            try:
+                self._link_or_copy(blob_path, path)
+            except FileNotFoundError:
+                # 没有相同内容的 blob, 或者 collect_garbage 刚刚删除了它: 用解压的文件作为 blob.
+                # 先链接到 path 再移入 blob 目录, collect_garbage 不会看到只有一个链接的新 blob
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.chmod(tmp_path, 0o640)
+                self._link_or_copy(tmp_path, path)
+                os.replace(tmp_path, blob_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return size, md5, sha256
+
+    def _link_or_copy(self, src, dst):
+        try:
+            os.link(src, dst)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            # 不支持硬链接时(例如不在同一个文件系统)退化为复制
+            shutil.copy2(src, dst)
+
+    def collect_garbage(self, min_age=60 * 60):
+        '''
+            Remove blobs that no test case directory links to any more, and
+            temporary files of interrupted uploads older than `min_age`
+            seconds. Returns the number of files removed.
+        '''
+        blob_dir = test_case_blob_dir()
+        if not os.path.isdir(blob_dir):
+            return 0
+        now = time.time()
+        removed = 0
+        for root, _, files in os.walk(blob_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                    if name.startswith(".tmp-"):
+                        if now - stat.st_mtime < min_age:
+                            continue
+                    elif stat.st_nlink > 1:
+                        continue
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    continue
+        return removed
+
     def process_zip(self, uploaded_zip_file, spj=False, dir=""):
         try:
             zip_file = zipfile.ZipFile(uploaded_zip_file, "r")
@@ -72,23 +257,33 @@ class TestCaseZipProcessor(object):
         os.mkdir(test_case_dir)
         os.chmod(test_case_dir, 0o710)
 
-        size_cache = {}
-        md5_cache = {}
+        def extract(items):
+            return [self.store_test_case(zip_file, f"{dir}{item}", os.path.join(test_case_dir, item),
+                                           output=item.endswith(".out")) for item in items]
 
-        for item in test_case_list:
-            with open(os.path.join(test_case_dir, item), "wb") as f:
-                content = zip_file.read(f"{dir}{item}").replace(b"\r\n", b"\n")
-                size_cache[item] = len(content)
-                if item.endswith(".out"):
-                    md5_cache[item] = hashlib.md5(content.rstrip()).hexdigest()
-                f.write(content)
-        test_case_info = {"spj": spj, "test_cases": {}}
+        # zlib 解压和 md5 计算会释放 GIL, 测试点多时用线程池并行处理
+        workers = min(self.workers or settings.TEST_CASE_EXTRACT_WORKERS, len(test_case_list))
+        if workers > 1:
+            # 按批提交, 减少大量小文件时线程切换的开销
+            batches = [test_case_list[i:i + self.batch_size]
+                       for i in range(0, len(test_case_list), self.batch_size)]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = [result for batch in executor.map(extract, batches) for result in batch]
+        else:
+            results = extract(test_case_list)
+        size_cache = {item: size for item, (size, _, _) in zip(test_case_list, results)}
+        md5_cache = {item: md5 for item, (_, md5, _) in zip(test_case_list, results)}
+
+        # files: 文件名到内容 sha256 的映射, 用于比较两个版本的测试数据
+        test_case_info = {"spj": spj, "test_cases": {},
+                          "files": {item: sha256 for item, (_, _, sha256) in zip(test_case_list, results)}}
 
         info = []
 
         if spj:
             for index, item in enumerate(test_case_list):
-                data = {"input_name": item, "input_size": size_cache[item]}
+                data = {"input_name": item, "input_size": size_cache[item],
+                        "input_md5": md5_cache[item]}
                 info.append(data)
                 test_case_info["test_cases"][str(index + 1)] = data
         else:
@@ -96,6 +291,7 @@ class TestCaseZipProcessor(object):
             test_case_list = zip(*[test_case_list[i::2] for i in range(2)])
             for index, item in enumerate(test_case_list):
                 data = {"stripped_output_md5": md5_cache[item[1]],
+                        "input_md5": md5_cache[item[0]],
                         "input_size": size_cache[item[0]],
                         "output_size": size_cache[item[1]],
                         "input_name": item[0],
@@ -117,48 +313,47 @@ class TestCaseZipProcessor(object):
             >>> processor.filter_name_list(['2.in', '1.in', '2.out', '1.out'], spj=False)
             ['1.in', '1.out', '2.in', '2.out']
         '''
+        # 用集合判断文件是否存在, 避免对 name_list 的线性查找
+        names = set(name_list)
         ret = []
         prefix = 1
-        if spj:
-            while True:
-                in_name = f"{prefix}.in"
-                if f"{dir}{in_name}" in name_list:
-                    ret.append(in_name)
-                    prefix += 1
-                    continue
-                else:
-                    return sorted(ret, key=natural_sort_key)
-        else:
-            while True:
-                in_name = f"{prefix}.in"
-                out_name = f"{prefix}.out"
-                if f"{dir}{in_name}" in name_list and f"{dir}{out_name}" in name_list:
-                    ret.append(in_name)
-                    ret.append(out_name)
-                    prefix += 1
-                    continue
-                else:
-                    return sorted(ret, key=natural_sort_key)
+        while True:
+            in_name = f"{prefix}.in"
+            out_name = f"{prefix}.out"
+            if f"{dir}{in_name}" not in names:
+                break
+            if spj:
+                ret.append(in_name)
+            elif f"{dir}{out_name}" in names:
+                ret.append(in_name)
+                ret.append(out_name)
+            else:
+                break
+            prefix += 1
+        return ret
 
     def rsync_test_cases(self, test_case_id, delete=False):
         if test_case_id is None:
             raise APIError("Testcase id cannot be empty")
 
-        # TODO: if multiple judgers exist, rsync test case to all judgers
         src_dir = f'{settings.TEST_CASE_DIR}/{test_case_id}/'
-        dst_dir = f'root@{settings.JUDGE_SERVER_HOST}:{
-            settings.JUDGE_SERVER_TEST_CASE_DIR}/{test_case_id}/'
+        output = []
+        # 同步到所有评测机
+        for address in settings.JUDGE_SERVERS:
+            host = address.rsplit(':', 1)[0]
+            dst_dir = f'root@{host}:{settings.JUDGE_SERVER_TEST_CASE_DIR}/{test_case_id}/'
 
-        rsync_command = ['rsync', '-avz', '-e', 'ssh', src_dir, dst_dir]
-        # delete test case on judge server
-        unlink_command = ['ssh', f'root@{settings.JUDGE_SERVER_HOST}',
-                          'rm', '-rf', f'{settings.JUDGE_SERVER_TEST_CASE_DIR}/{test_case_id}']
+            rsync_command = ['rsync', '-avz', '-e', 'ssh', src_dir, dst_dir]
+            # delete test case on judge server
+            unlink_command = ['ssh', f'root@{host}',
+                              'rm', '-rf', f'{settings.JUDGE_SERVER_TEST_CASE_DIR}/{test_case_id}']
 
-        command = rsync_command if not delete else unlink_command
+            command = rsync_command if not delete else unlink_command
 
-        try:
-            result = subprocess.run(command, check=True,
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            return result.stdout.decode()
-        except subprocess.CalledProcessError as e:
-            raise Exception(f"rsync failed: {e.stderr.decode()}")
+            try:
+                result = subprocess.run(command, check=True,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                output.append(result.stdout.decode())
+            except subprocess.CalledProcessError as e:
+                raise Exception(f"rsync failed: {e.stderr.decode()}")
+        return "".join(output)
@@ -1,7 +1,12 @@
+import hashlib
+import json
+
 from django.http import HttpResponse
-from .models import Problem, ProblemTag
+from .models import Problem, ProblemTag, ProblemRuleType
 from .serializers import ProblemSerializer, ProblemListSerializer, TestCaseUploadForm
 from .utils import TestCaseZipProcessor, rand_str
+from .counters import ProblemCounter
+from .sync import TestCaseSyncer
 
 from django.shortcuts import get_object_or_404, render
 from django.db.models import Q
@@ -11,6 +16,9 @@ from rest_framework.response import Response
 from utils.templates import markdown_format
 from utils.token import JWTAuthTokenSerializer
 from utils.api import APIView, CSRFExemptAPIView
+from utils.judger.config import SPJ_LANGUAGE_CONFIG
+from submission.cache import VerdictCache
+from submission.models import RejudgeJob, RejudgeScope
 
 
 class ProblemAPI(APIView):
@@ -22,7 +30,7 @@ class ProblemAPI(APIView):
             return self.error(f'Problem with id:{problem_id} does not exist')
 
         serializer = ProblemSerializer(problem)
-        return self.success(serializer.data)
+        return self.success(ProblemCounter().with_pending(serializer.data))
 
 
 class ProblemListAPI(APIView):
@@ -48,7 +56,7 @@ class ProblemListAPI(APIView):
             # or problems = problems.filter(description__icontains=keyword)
 
         serializer = ProblemListSerializer(problems, many=True)
-        return self.success(serializer.data)
+        return self.success(ProblemCounter().with_pending(serializer.data))
 
 
 class TestCaseAPI(CSRFExemptAPIView, TestCaseZipProcessor):
@@ -83,15 +91,26 @@ class TestCaseAPI(CSRFExemptAPIView, TestCaseZipProcessor):
         info, test_case_id = self.process_zip(
             uploaded_zip_file, spj=spj)
         
-        if problem.test_case_id:
-            self.rsync_test_cases(problem.test_case_id, delete=True)
+        old_test_case_id = problem.test_case_id
+        if old_test_case_id:
+            VerdictCache.invalidate(old_test_case_id)
         
         problem.test_case_id = test_case_id
+        problem.spj = spj
         problem.save()
         
-        self.rsync_test_cases(test_case_id)
+        # 由 sync_test_cases worker 同步到评测机, 同步并校验完成前不会在该评测机上判题,
+        # 旧版本在新版本同步完成后删除
+        TestCaseSyncer().schedule(test_case_id, old_test_case_id)
+
+        rejudge_job = None
+        if old_test_case_id:
+            # 测试数据被替换, 已有提交需要重判
+            rejudge_job = RejudgeJob.objects.create(scope=RejudgeScope.PROBLEM, target=problem.id,
+                                                    created_by=user.username).id
         
-        return self.success({'info': info, 'test_case_id': test_case_id, 'spj': spj})
+        return self.success({'info': info, 'test_case_id': test_case_id, 'spj': spj,
+                             'rejudge_job': rejudge_job})
 
 
 class ProblemCreateAPI(APIView):
@@ -106,19 +125,89 @@ class ProblemCreateAPI(APIView):
         if not user.is_admin():
             return self.error('一般用户没有权限创建题目')
 
+        try:
+            samples = json.loads(request.POST.get('samples') or 'null')
+        except ValueError:
+            return self.error('samples must be a JSON list')
+        if samples is not None and not self.valid_samples(samples):
+            return self.error('samples must be a list of {input, output}')
+
         data = {'title': request.POST.get('title'),
                 'description': request.POST.get('description'),
                 'input': request.POST.get('input'),
                 'output': request.POST.get('output'),
-                'samples': request.POST.get('samples'),
+                'samples': samples,
                 'standard_time_limit': request.POST.get('standard_time_limit'),
                 'standard_memory_limit': request.POST.get('standard_memory_limit'),
+                'rule_type': request.POST.get('rule_type', ProblemRuleType.ACM),
+                'sample_preflight': request.POST.get('sample_preflight') == 'true',
+                'fail_fast': request.POST.get('fail_fast') == 'true',
                 'is_remote': False,
                 }
 
+        if data['rule_type'] not in (ProblemRuleType.ACM, ProblemRuleType.OI):
+            return self.error(f"unknown rule_type {data['rule_type']}")
+
         problem = Problem.objects.create(**data)
         return self.success(ProblemSerializer(problem).data)
 
+    @staticmethod
+    def valid_samples(samples):
+        '''
+            [{"input": "1 2", "output": "3"}, ...], input may be null for
+            problems without input.
+        '''
+        return isinstance(samples, list) and all(
+            isinstance(sample, dict) and set(sample) == {'input', 'output'}
+            and isinstance(sample['input'], (str, type(None)))
+            and isinstance(sample['output'], str)
+            for sample in samples)
+
+
+class ProblemSPJAPI(APIView):
+
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthTokenSerializer]
+
+    def post(self, request):
+        '''
+            Set the special judge checker of a problem. The checker is compiled
+            on each judge server the first time it judges the problem.
+        '''
+        if not request.user.is_admin():
+            return self.error('一般用户没有权限修改题目')
+
+        problem_id = request.POST.get('problem_id')
+        if not problem_id:
+            return self.error('problem_id is required')
+        try:
+            problem = Problem.objects.get(id=problem_id)
+        except Problem.DoesNotExist:
+            return self.error(f'Problem with id:{problem_id} does not exist')
+
+        spj_language = request.POST.get('spj_language')
+        spj_code = request.POST.get('spj_code')
+        if spj_language not in SPJ_LANGUAGE_CONFIG:
+            return self.error(f'spj language {spj_language} is not supported')
+        if not spj_code:
+            return self.error('spj_code cannot be empty')
+
+        old_spj_version = problem.spj_version
+        problem.spj_language = spj_language
+        problem.spj_code = spj_code
+        problem.spj_version = hashlib.md5(
+            f'{spj_language}:{spj_code}'.encode('utf-8')).hexdigest()
+        problem.save(update_fields=['spj_language', 'spj_code', 'spj_version'])
+
+        rejudge_job = None
+        if problem.test_case_id and old_spj_version != problem.spj_version:
+            VerdictCache.invalidate(problem.test_case_id)
+            if problem.spj and old_spj_version:
+                # spj 被替换, 已有提交需要重判
+                rejudge_job = RejudgeJob.objects.create(scope=RejudgeScope.PROBLEM, target=problem.id,
+                                                        created_by=request.user.username).id
+        return self.success({'spj_version': problem.spj_version, 'rejudge_job': rejudge_job})
+
 
 def problem_display(request, id):
     problem = Problem.objects.get(id=id)
@@ -0,0 +1,81 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import JudgeStatus
+
+
+class VerdictCache(object):
+    '''
+        以 (代码哈希, 语言, 时空限制, 判题规则, spj 版本, test_case_id) 的哈希为键
+        缓存判题结果, 重复提交完全相同的代码时直接返回缓存的结果而不再判题.
+
+        键以 test_case_id 为前缀, 更换测试数据或 spj 时用 invalidate 整体删除.
+        缓存中记录判出该结果的提交, 命中时从它复制每个测试点的输出.
+    '''
+    key_prefix = "verdict"
+    # 超时和系统错误受评测机负载影响, 同样的代码重新判题可能得到不同结果, 不缓存
+    uncached_results = (JudgeStatus.CPU_TIME_LIMIT_EXCEEDED,
+                        JudgeStatus.REAL_TIME_LIMIT_EXCEEDED,
+                        JudgeStatus.SYSTEM_ERROR)
+
+    @classmethod
+    def key(cls, problem, code_hash, language, max_cpu_time, max_memory):
+        '''
+            :param code_hash: sha256 of the source, i.e. CodeBlob.hash
+        '''
+        spj_version = problem.spj_version if problem.spj else None
+        digest = hashlib.sha256(json.dumps(
+            [code_hash, language, max_cpu_time, max_memory,
+             problem.rule_type, spj_version]).encode("utf-8")).hexdigest()
+        return f"{cls.key_prefix}:{problem.test_case_id}:{digest}"
+
+    @classmethod
+    def get(cls, key):
+        return cache.get(key)
+
+    @classmethod
+    def set(cls, key, result, info, statistic_info, submission_id=None):
+        if result in cls.uncached_results:
+            return
+        # OI 模式下部分测试点超时的结果同样不缓存
+        if isinstance(info, list) and any(item.get('result') in cls.uncached_results for item in info):
+            return
+        cache.set(key, {"result": result, "info": info, "statistic_info": statistic_info,
+                        "submission_id": submission_id},
+                  timeout=settings.VERDICT_CACHE_TIMEOUT)
+
+    @classmethod
+    def invalidate(cls, test_case_id):
+        cache.delete_pattern(f"{cls.key_prefix}:{test_case_id}:*")
+
+
+class CompileErrorCache(object):
+    '''
+        以 (源代码哈希, 编译命令) 缓存编译错误信息. 编译结果与测试数据和时空限制
+        无关, 重复提交编译不通过的代码时不再请求评测机.
+    '''
+    key_prefix = "compile_error"
+
+    @classmethod
+    def key(cls, code_hash, language_config):
+        '''
+            None for languages without a compile step.
+        '''
+        compile_config = language_config.get("compile")
+        if not compile_config:
+            return None
+        digest = hashlib.sha256(json.dumps(
+            [code_hash, compile_config["compile_command"]]).encode("utf-8")).hexdigest()
+        return f"{cls.key_prefix}:{digest}"
+
+    @classmethod
+    def get(cls, key):
+        return cache.get(key) if key else None
+
+    @classmethod
+    def set(cls, key, message):
+        if key:
+            cache.set(key, message, timeout=settings.COMPILE_ERROR_CACHE_TIMEOUT)
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import logging
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from utils.judger.client import JudgeServerClientError
+from utils.judger.config import LANGUAGE_CONFIG
+from utils.judger.pool import get_judge_pool
+
+from .models import JudgeStatus
+from .cache import CompileErrorCache
+
+
+logger = logging.getLogger(__name__)
+
+
+def debug_result_key(debug_id):
+    return f"debug:{debug_id}:result"
+
+
+def save_debug_result(debug_id, result):
+    '''
+        Store the result of a debug run for DEBUG_RESULT_TIMEOUT seconds,
+        `{"finished": False}` while it is waiting in the queue.
+    '''
+    get_redis_connection("default").set(debug_result_key(debug_id), json.dumps(result),
+                                        ex=settings.DEBUG_RESULT_TIMEOUT)
+
+
+def debug_result(data):
+    '''
+        Turn the JudgeServer response of a single inline test case into the
+        debug result returned to the user.
+    '''
+    if data['err']:
+        result = JudgeStatus.COMPILE_ERROR if data['err'] == 'CompileError' \
+            else JudgeStatus.SYSTEM_ERROR
+        return {"finished": True, "result": result, "stdout": "", "stderr": data['data'],
+                "cpu_time": 0, "memory": 0, "exit_code": 0, "signal": 0}
+
+    item = data['data'][0]
+    result = item['result']
+    # 没有期望输出, 只要有输出就会判为答案错误, 实际是正常结束
+    if result == JudgeStatus.WRONG_ANSWER:
+        result = JudgeStatus.ACCEPTED
+    # JudgeServer 不返回标准错误, 只有编译错误信息
+    return {"finished": True,
+            "result": result,
+            "stdout": (item.get('output') or '')[:settings.DEBUG_OUTPUT_LIMIT],
+            "stderr": "",
+            "cpu_time": item['cpu_time'],
+            "memory": item['memory'],
+            "exit_code": item.get('exit_code', 0),
+            "signal": item['signal']}
+
+
+def run_debug(task):
+    '''
+        Run a debug task popped from the debug lane by the judge worker and
+        store the result for the client polling debug_submission_result.
+    '''
+    # 结果已过期, 客户端不会再来查询
+    if time.time() - task['enqueue_time'] > settings.DEBUG_RESULT_TIMEOUT:
+        return
+
+    try:
+        data = _judge_debug(task)
+    except Exception as e:
+        logger.exception(e)
+        data = {"err": "SystemError", "data": str(e)}
+    save_debug_result(task['debug_id'], debug_result(data))
+
+
+def _judge_debug(task):
+    language_config = LANGUAGE_CONFIG[task['language']]
+    compile_error_key = CompileErrorCache.key(
+        hashlib.sha256(task['code'].encode('utf-8')).hexdigest(), language_config)
+    message = CompileErrorCache.get(compile_error_key)
+    if message is not None:
+        return {"err": "CompileError", "data": message}
+
+    try:
+        with get_judge_pool().acquire() as server:
+            data = server.client.judge(src=task['code'],
+                                       language_config=language_config,
+                                       max_cpu_time=task['max_cpu_time'],
+                                       max_memory=task['max_memory'],
+                                       test_case=[{"input": task['input'], "output": ""}],
+                                       output=True)
+    except JudgeServerClientError as e:
+        data = {"err": "SystemError", "data": str(e)}
+    if data['err'] == 'CompileError':
+        CompileErrorCache.set(compile_error_key, data['data'])
+    return data
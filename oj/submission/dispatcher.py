@@ -0,0 +1,371 @@
+import os
+
+from django.conf import settings
+
+from utils.judger.config import LANGUAGE_CONFIG, SPJ_LANGUAGE_CONFIG
+from utils.judger.pool import get_judge_pool
+from utils.metrics import JUDGE_CASE_REAL_TIME_SECONDS, JUDGE_TOTAL_SECONDS, SUBMISSION_DB_WRITE_SECONDS
+
+from problem.models import ProblemRuleType
+from problem.counters import ProblemCounter
+from problem.utils import diff_test_cases, natural_sort_key, read_test_case_info
+
+from .models import Submission, SubmissionOutput, JudgeStatus
+from .cache import CompileErrorCache, VerdictCache
+from .events import publish_event
+
+
+def judge_limits(problem, language):
+    '''
+        Returns (max_cpu_time in ms, max_memory in Byte) of the problem for the language.
+    '''
+    if language in ('C++', 'C'):
+        time_limit = problem.standard_time_limit
+        memory_limit = problem.standard_memory_limit
+    else:
+        time_limit = problem.other_time_limit
+        memory_limit = problem.other_memory_limit
+    # JudgeServer uses memory limit in Byte
+    return time_limit, memory_limit * 1024 * 1024
+
+
+class JudgeDispatcher(object):
+    '''
+        Judge a local submission on JudgeServer and write the verdict back to
+        `Submission.result`, `info` and `statistic_info`.
+
+        Called by the judge worker for every submission popped from JudgeQueue.
+        The judge server is picked from JudgePool; if none is available or the
+        chosen one fails, JudgeServerClientError is raised and the worker puts
+        the submission back to the queue.
+    '''
+
+    # info 中只保留每个测试点的摘要, 输出内容存入 SubmissionOutput
+    info_fields = ('test_case', 'result', 'cpu_time', 'memory', 'signal')
+
+    def __init__(self, submission_id):
+        self.submission = Submission.objects.select_related(
+            'problem', 'code_blob').get(id=submission_id)
+        self.problem = self.submission.problem
+        self.max_cpu_time, self.max_memory = judge_limits(
+            self.problem, self.submission.language)
+
+    def _finish(self, result, info, statistic_info):
+        self.submission.result = result
+        self.submission.info = info
+        self.submission.statistic_info = statistic_info
+        self.submission.test_case_id = self.problem.test_case_id
+        with SUBMISSION_DB_WRITE_SECONDS.time(stage="finish"):
+            self.submission.save(
+                update_fields=['result', 'info', 'statistic_info', 'test_case_id'])
+        publish_event(self.submission.id, result, statistic_info)
+        if result == JudgeStatus.ACCEPTED:
+            ProblemCounter().incr(self.problem.id, solved=1)
+        VerdictCache.set(VerdictCache.key(self.problem, self.submission.code_blob_id,
+                                          self.submission.language,
+                                          self.max_cpu_time, self.max_memory),
+                         result, info, statistic_info, self.submission.id)
+
+    def judge(self):
+        Submission.objects.filter(id=self.submission.id).update(
+            result=JudgeStatus.JUDGING)
+        publish_event(self.submission.id, JudgeStatus.JUDGING)
+        with JUDGE_TOTAL_SECONDS.time(language=self.submission.language):
+            self._finish(*self.run())
+
+    def _judge(self, **kwargs):
+        language_config = LANGUAGE_CONFIG[self.submission.language]
+        compile_error_key = CompileErrorCache.key(self.submission.code_blob_id, language_config)
+        message = CompileErrorCache.get(compile_error_key)
+        if message is not None:
+            return {"err": "CompileError", "data": message}
+
+        pool = get_judge_pool()
+        # 按 test_case_id 判题时只使用测试数据已同步完成的评测机
+        with pool.acquire(test_case_id=kwargs.get('test_case_id')) as server:
+            if self.problem.spj:
+                data = self._judge_spj(pool, server, language_config, **kwargs)
+            else:
+                data = server.client.judge(src=self.submission.code, language_config=language_config,
+                                           max_cpu_time=self.max_cpu_time, max_memory=self.max_memory,
+                                           output=True, **kwargs)
+        if data['err'] == 'CompileError':
+            CompileErrorCache.set(compile_error_key, data['data'])
+        elif not data['err']:
+            JUDGE_CASE_REAL_TIME_SECONDS.observe_many(
+                [item['real_time'] / 1000 for item in data['data'] if 'real_time' in item],
+                language=self.submission.language, server=server.address)
+        return data
+
+    def _judge_spj(self, pool, server, language_config, **kwargs):
+        '''
+            Judge with the problem's checker, compiled first on servers that
+            don't hold its spj_version yet. The judge request only carries the
+            version, never the checker source.
+        '''
+        version = self.problem.spj_version
+        if not version:
+            return {"err": "SPJError", "data": "special judge checker is not set"}
+        spj_language_config = SPJ_LANGUAGE_CONFIG[self.problem.spj_language]
+
+        compiled = False
+        while True:
+            if not pool.has_spj(server, version):
+                data = server.client.compile_spj(self.problem.spj_code, version,
+                                                 spj_language_config["compile"])
+                if data['err']:
+                    return {"err": "SPJCompileError", "data": data['data']}
+                pool.add_spj(server, version)
+                compiled = True
+            data = server.client.judge(src=self.submission.code, language_config=language_config,
+                                       max_cpu_time=self.max_cpu_time, max_memory=self.max_memory,
+                                       output=True, spj_version=version,
+                                       spj_config=spj_language_config["config"],
+                                       spj_compile_config=spj_language_config["compile"], **kwargs)
+            if not data['err'] or data['err'] == 'CompileError' or compiled:
+                return data
+            # 评测机上的 checker 可能已被清理, 重新编译后再试一次
+            pool.discard_spj(server, version)
+
+    def run(self, incremental=False):
+        '''
+            Judge the submission without touching the submission row.
+            Returns (result, info, statistic_info); the outputs are saved.
+
+            :param incremental: reuse the per-case verdicts of test cases that
+                did not change since the submission was last judged, see
+                _incremental_plan
+        '''
+        plan = self._incremental_plan() if incremental else None
+        if plan is not None:
+            return self._run_incremental(*plan)
+
+        verdict = self._sample_preflight()
+        if verdict is not None:
+            return verdict
+
+        verdict = self._run_fail_fast()
+        if verdict is not None:
+            return verdict
+
+        data = self._judge(test_case_id=self.problem.test_case_id)
+        if data['err']:
+            return self._error(data)
+        return self._verdict(data['data'])
+
+    def _error(self, data):
+        result = JudgeStatus.COMPILE_ERROR if data['err'] == 'CompileError' \
+            else JudgeStatus.SYSTEM_ERROR
+        return result, {"err": data['err'], "data": data['data']}, {"err_info": data['data']}
+
+    def _verdict(self, test_case_results):
+        status, test_case_results, statistic_info = self._aggregate(test_case_results)
+        SubmissionOutput.save_outputs(self.submission, test_case_results)
+        info = [{field: item[field] for field in self.info_fields}
+                for item in test_case_results]
+        return status, info, statistic_info
+
+    def _sample_preflight(self):
+        '''
+            Run the problem's samples inline before the full test suite.
+            Returns the verdict if the submission does not compile or fails
+            a sample, None to go on with the full run.
+
+            Only for ACM problems with sample_preflight on: an OI score needs
+            every test case, and special judge samples can't be compared.
+        '''
+        if not self.problem.sample_preflight or self.problem.rule_type != ProblemRuleType.ACM:
+            return None
+        # 早期题目的 samples 可能是原样保存的字符串, 跳过格式不对的样例
+        samples = self.problem.samples if isinstance(self.problem.samples, list) else []
+        samples = [sample for sample in samples if isinstance(sample, dict)]
+        if not samples:
+            return None
+        manifest = read_test_case_info(self.problem.test_case_id)
+        if manifest is None or manifest["spj"]:
+            return None
+
+        data = self._judge(test_case=[{"input": sample.get("input") or "",
+                                       "output": sample.get("output") or ""}
+                                      for sample in samples])
+        if data['err']:
+            # 系统错误时交给完整判题处理
+            return self._error(data) if data['err'] == 'CompileError' else None
+
+        results = sorted(data['data'], key=lambda item: int(item['test_case']))
+        failed = [item for item in results if item['result'] != JudgeStatus.ACCEPTED]
+        if not failed:
+            return None
+        results = [{**item, 'test_case': f"sample-{item['test_case']}"}
+                   for item in results[:results.index(failed[0]) + 1]]
+        SubmissionOutput.save_outputs(self.submission, results)
+        statistic_info = {
+            "time_cost": max(item['cpu_time'] for item in results),
+            "memory_cost": max(item['memory'] for item in results),
+            "err_info": f"Failed on sample {failed[0]['test_case']}",
+            "score": 0,
+        }
+        info = [{field: item[field] for field in self.info_fields} for item in results]
+        return failed[0]['result'], info, statistic_info
+
+    def _incremental_plan(self):
+        '''
+            Diff the manifest the submission was judged against with the
+            current one. Returns (reused, to_run, test_case): the old per-case
+            verdicts of unchanged test cases keyed by the new test case, the
+            new test cases to run and their data to send inline. None when a
+            full rejudge is needed.
+        '''
+        old_id, new_id = self.submission.test_case_id, self.problem.test_case_id
+        # 编译错误等情况 info 不是测试点列表
+        if not old_id or old_id == new_id or not isinstance(self.submission.info, list):
+            return None
+        old_info, new_info = read_test_case_info(old_id), read_test_case_info(new_id)
+        if old_info is None or new_info is None or new_info["spj"]:
+            return None
+
+        known = {item['test_case']: item for item in self.submission.info}
+        reused, to_run = {}, []
+        for name, old_name in sorted(diff_test_cases(old_info, new_info).items(),
+                                     key=lambda item: natural_sort_key(item[0])):
+            item = known.get(old_name)
+            if item is None:
+                # ACM 模式 info 只保留到第一个错误的测试点, 之后的需要重新运行
+                to_run.append(name)
+                continue
+            reused[name] = {**item, 'test_case': name, 'old_test_case': old_name}
+            if self.problem.rule_type != ProblemRuleType.OI and item['result'] != JudgeStatus.ACCEPTED:
+                # 之后的测试点不影响 ACM 模式的结果
+                break
+
+        if not reused:
+            return None
+        size = sum(new_info["test_cases"][name]["input_size"] + new_info["test_cases"][name]["output_size"]
+                   for name in to_run)
+        if size > settings.INCREMENTAL_REJUDGE_SIZE_LIMIT:
+            return None
+        try:
+            test_case = self._read_test_cases(to_run)
+        except (OSError, UnicodeDecodeError):
+            # 二进制或非 UTF-8 的测试数据无法随请求发送
+            return None
+        return reused, to_run, test_case
+
+    def _run_incremental(self, reused, to_run, test_case):
+        test_case_results = []
+        if to_run:
+            data = self._judge(test_case=test_case)
+            if data['err']:
+                return self._error(data)
+            # 随请求发送的测试点从 1 开始编号, 换回题目中的编号
+            for item in data['data']:
+                test_case_results.append(
+                    {**item, 'test_case': to_run[int(item['test_case']) - 1]})
+
+        old = SubmissionOutput.objects.filter(submission=self.submission).first()
+        old_outputs = old.outputs if old else {}
+        for item in reused.values():
+            item['output'] = old_outputs.get(item.pop('old_test_case'))
+            test_case_results.append(item)
+        return self._verdict(test_case_results)
+
+    def _read_test_cases(self, names):
+        '''
+            Input and expected output of the problem's test cases `names`, to
+            be sent inline. Raises UnicodeDecodeError if the data is not text.
+        '''
+        test_case_dir = os.path.join(settings.TEST_CASE_DIR, self.problem.test_case_id)
+        manifest = read_test_case_info(self.problem.test_case_id)["test_cases"]
+        test_case = []
+        for name in names:
+            with open(os.path.join(test_case_dir, manifest[name]["input_name"]), encoding="utf-8") as f:
+                input_data = f.read()
+            with open(os.path.join(test_case_dir, manifest[name]["output_name"]), encoding="utf-8") as f:
+                output_data = f.read()
+            test_case.append({"input": input_data, "output": output_data})
+        return test_case
+
+    def _run_fail_fast(self):
+        '''
+            ACM 题目只需要第一个错误的测试点, 按顺序分批发送测试点, 遇到错误后
+            不再运行之后的测试点. 批大小从 1 开始每次翻倍, 多运行的测试点不超过
+            已通过的测试点数; 代价是每批都要重新编译并随请求发送测试数据, 所以
+            只对开启了 fail_fast 且测试数据很小的题目使用.
+
+            Returns None for a full run by test_case_id: problems without
+            fail_fast, OI and special judge problems, test data larger than
+            ACM_FAIL_FAST_SIZE_LIMIT or not text.
+        '''
+        if not self.problem.fail_fast or self.problem.rule_type != ProblemRuleType.ACM:
+            return None
+        manifest = read_test_case_info(self.problem.test_case_id)
+        if manifest is None or manifest["spj"]:
+            return None
+        cases = manifest["test_cases"]
+        if sum(item["input_size"] + item["output_size"] for item in cases.values()) \
+                > settings.ACM_FAIL_FAST_SIZE_LIMIT:
+            return None
+        names = sorted(cases, key=natural_sort_key)
+        try:
+            test_case = self._read_test_cases(names)
+        except (OSError, UnicodeDecodeError):
+            return None
+
+        test_case_results = []
+        start, batch_size = 0, 1
+        while start < len(names):
+            batch = names[start:start + batch_size]
+            data = self._judge(test_case=test_case[start:start + batch_size])
+            if data['err']:
+                return self._error(data)
+            results = [{**item, 'test_case': batch[int(item['test_case']) - 1]} for item in data['data']]
+            test_case_results.extend(results)
+            if any(item['result'] != JudgeStatus.ACCEPTED for item in results):
+                break
+            start += batch_size
+            batch_size *= 2
+        return self._verdict(test_case_results)
+
+    def _aggregate(self, test_case_results):
+        '''
+            Turn per-test-case results into (result, info, statistic_info)
+            according to the problem's rule type.
+
+            ACM: the verdict is the first failing test case, results after it
+            are dropped from info. OI: every test case is kept, score is the
+            percentage of passed test cases.
+        '''
+        test_case_results = sorted(
+            test_case_results, key=lambda item: int(item['test_case']))
+        failed = [item for item in test_case_results
+                  if item['result'] != JudgeStatus.ACCEPTED]
+
+        if self.problem.rule_type == ProblemRuleType.OI:
+            passed = len(test_case_results) - len(failed)
+            score = passed * 100 // len(test_case_results)
+            if not failed:
+                status = JudgeStatus.ACCEPTED
+            elif passed:
+                status = JudgeStatus.PARTIALLY_ACCEPTED
+            else:
+                status = failed[0]['result']
+            error_info = f'Failed on {len(failed)} of {len(test_case_results)} tests' \
+                if failed else ""
+        else:
+            if failed:
+                status = failed[0]['result']
+                error_info = f'Failed on test {failed[0]['test_case']}'
+                test_case_results = test_case_results[:test_case_results.index(
+                    failed[0]) + 1]
+            else:
+                status = JudgeStatus.ACCEPTED
+                error_info = ""
+            score = 100 if status == JudgeStatus.ACCEPTED else 0
+
+        statistic_info = {
+            "time_cost": max(item['cpu_time'] for item in test_case_results),
+            "memory_cost": max(item['memory'] for item in test_case_results),
+            "err_info": error_info,
+            "score": score,
+        }
+        return status, test_case_results, statistic_info
@@ -0,0 +1,242 @@
+import asyncio
+import json
+import logging
+import weakref
+
+import redis.asyncio as aioredis
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from .models import Submission, JudgeStatus
+
+logger = logging.getLogger(__name__)
+
+
+class SubmissionEvent(object):
+    QUEUED = 'queued'
+    JUDGING = 'judging'
+    FINISHED = 'finished'
+
+
+def is_finished(result):
+    return result not in (JudgeStatus.PENDING, JudgeStatus.JUDGING)
+
+
+def event_of(result):
+    if result == JudgeStatus.PENDING:
+        return SubmissionEvent.QUEUED
+    if result == JudgeStatus.JUDGING:
+        return SubmissionEvent.JUDGING
+    return SubmissionEvent.FINISHED
+
+
+def submission_channel(submission_id):
+    return f"submission:{submission_id}:events"
+
+
+def status_key(submission_id):
+    return f"submission:{submission_id}:status"
+
+
+# 状态缓存的过期时间, 单位秒
+STATUS_TIMEOUT = 24 * 60 * 60
+STATUS_FIELDS = ("result", "time_cost", "memory_cost", "score")
+
+
+def status_of(result, statistic_info):
+    '''
+        The compact status kept in the redis hash: result, time, memory and score.
+    '''
+    return {"result": result,
+            "time_cost": statistic_info.get("time_cost", -1),
+            "memory_cost": statistic_info.get("memory_cost", -1),
+            "score": statistic_info.get("score", -1)}
+
+
+def status_etag(status):
+    return '"' + ":".join(str(status[field]) for field in STATUS_FIELDS) + '"'
+
+
+def publish_event(submission_id, result, statistic_info=None):
+    '''
+        Write the status of a submission to its redis hash and publish the
+        change over redis pub/sub.
+    '''
+    status = status_of(result, statistic_info or {})
+    message = {"id": submission_id, "event": event_of(result), **status}
+    pipe = get_redis_connection("default").pipeline()
+    pipe.hset(status_key(submission_id), mapping=status)
+    pipe.expire(status_key(submission_id), STATUS_TIMEOUT)
+    pipe.publish(submission_channel(submission_id), json.dumps(message))
+    pipe.execute()
+
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_redis():
+    '''
+        asyncio redis client of the running event loop.
+    '''
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        config = settings.CACHES["default"]
+        _clients[loop] = aioredis.Redis.from_url(config["LOCATION"],
+                                                 password=config["OPTIONS"].get("PASSWORD"))
+    return _clients[loop]
+
+
+async def get_status(submission_id):
+    '''
+        Status of a submission from its redis hash, loaded from db (and
+        cached) only when the hash is missing. None if no such submission.
+    '''
+    client = get_async_redis()
+    status = await client.hgetall(status_key(submission_id))
+    if status:
+        return {field: int(status[field.encode()]) for field in STATUS_FIELDS}
+
+    submission = await Submission.objects.filter(id=submission_id).values(
+        'result', 'statistic_info').afirst()
+    if submission is None:
+        return None
+    status = status_of(submission['result'], submission['statistic_info'])
+    await client.hset(status_key(submission_id), mapping=status)
+    await client.expire(status_key(submission_id), STATUS_TIMEOUT)
+    return status
+
+
+class SubscriptionClosed(Exception):
+    '''
+        The pub/sub connection was lost, messages may have been missed.
+    '''
+
+
+class EventHub(object):
+    '''
+        每个进程(event loop)只用一个 redis pub/sub 连接接收所有提交的状态消息,
+        再分发给本进程内的监听者, 大量 SSE 连接不会带来额外的 redis 连接.
+
+        读取连接断开时结束所有已有的订阅(SubscriptionClosed), 订阅者重新读取
+        状态后再订阅, 新的订阅会重新建立连接.
+    '''
+    pattern = "submission:*:events"
+    # 放入监听队列, 表示订阅已失效
+    closed = object()
+
+    def __init__(self):
+        self.listeners = {}
+        self.reader = None
+        self.subscribed = asyncio.Event()
+
+    async def _read(self):
+        pubsub = get_async_redis().pubsub()
+        try:
+            await pubsub.psubscribe(self.pattern)
+            self.subscribed.set()
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True,
+                                                   timeout=1.0)
+                if message is None:
+                    continue
+                channel = message["channel"].decode()
+                for queue in self.listeners.get(channel, ()):
+                    queue.put_nowait(json.loads(message["data"]))
+        except Exception as e:
+            logger.warning(f'submission event reader failed: {e}')
+            for queues in self.listeners.values():
+                for queue in queues:
+                    queue.put_nowait(self.closed)
+        finally:
+            self.subscribed.clear()
+            await pubsub.aclose()
+
+    async def listen(self, submission_id):
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.create_task(self._read())
+        await asyncio.wait_for(self.subscribed.wait(), timeout=5)
+        queue = asyncio.Queue()
+        self.listeners.setdefault(
+            submission_channel(submission_id), set()).add(queue)
+        return queue
+
+    def unlisten(self, submission_id, queue):
+        channel = submission_channel(submission_id)
+        self.listeners[channel].discard(queue)
+        if not self.listeners[channel]:
+            del self.listeners[channel]
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_event_hub():
+    loop = asyncio.get_running_loop()
+    if loop not in _hubs:
+        _hubs[loop] = EventHub()
+    return _hubs[loop]
+
+
+class EventSubscription(object):
+    '''
+        Subscription to the status changes of a submission published by publish_event:
+        >>> async with EventSubscription(submission_id) as subscription:
+        ...     message = await subscription.get(timeout=15)
+    '''
+
+    def __init__(self, submission_id):
+        self.submission_id = submission_id
+
+    async def __aenter__(self):
+        self.hub = get_event_hub()
+        self.queue = await self.hub.listen(self.submission_id)
+        return self
+
+    async def __aexit__(self, *args):
+        self.hub.unlisten(self.submission_id, self.queue)
+
+    async def get(self, timeout):
+        '''
+            Wait up to `timeout` seconds for the next message, None on timeout.
+            Raises SubscriptionClosed if the pub/sub connection was lost.
+        '''
+        try:
+            message = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if message is EventHub.closed:
+            raise SubscriptionClosed
+        return message
+
+
+async def submission_event_stream(submission_id, current_status, keepalive=15, max_duration=600):
+    '''
+        Server-Sent Events body for a submission: the current status first,
+        then every published change until the verdict is final.
+
+        :param current_status: coroutine function returning the status from db
+    '''
+    def sse(data):
+        return f"event: status\ndata: {json.dumps(data)}\n\n"
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_duration
+    # 先订阅再读取当前状态, 避免错过两者之间发布的消息
+    async with EventSubscription(submission_id) as subscription:
+        status = await current_status()
+        yield sse(status)
+        if is_finished(status["result"]):
+            return
+        while loop.time() < deadline:
+            try:
+                message = await subscription.get(timeout=keepalive)
+            except SubscriptionClosed:
+                # 结束事件流, 浏览器的 EventSource 会自动重连并重新读取状态
+                return
+            if message is None:
+                # SSE 注释行, 保持连接不被代理断开
+                yield ": keep-alive\n\n"
+                continue
+            yield sse(message)
+            if is_finished(message["result"]):
+                return
@@ -0,0 +1,154 @@
+import statistics
+import threading
+import time
+import urllib.parse
+from io import StringIO
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.runner import DiscoverRunner
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment
+from django.urls import reverse
+from django_redis import get_redis_connection
+
+from account.models import User
+from problem.models import Problem
+from utils.api import APIClient
+from utils.judger.fake_server import FakeJudgeServer
+from submission.models import Submission, JudgeStatus
+
+
+code_template = r'''#include <bits/stdc++.h>
+using namespace std;
+// user {user} submission {index}
+int main() {{
+    cout << "Hello SWUFE OJ!\n";
+    return 0;
+}}
+'''
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class Command(BaseCommand):
+    help = ('End-to-end load benchmark of MakeSubmissionAPI against a FakeJudgeServer. '
+            'Runs on a throwaway test database and a separate redis db.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10,
+                            help='number of concurrent users')
+        parser.add_argument('--submissions', type=int, default=20,
+                            help='submissions per user')
+        parser.add_argument('--workers', type=int, default=2,
+                            help='judge worker threads draining the queue after the submit phase')
+        parser.add_argument('--latency', default='20,100',
+                            help='judge latency range in ms, "min,max"')
+        parser.add_argument('--verdicts', default='0:7,-1:2,1:1',
+                            help='verdict weights of the fake judge, "result:weight,..."')
+        parser.add_argument('--redis-db', type=int, default=15,
+                            help='redis db used during the benchmark, flushed before and after')
+
+    def handle(self, *args, **options):
+        try:
+            low, high = (int(item) for item in options['latency'].split(','))
+            verdicts = {int(result): float(weight) for result, weight in
+                        (item.split(':') for item in options['verdicts'].split(','))}
+        except ValueError:
+            raise CommandError('invalid --latency or --verdicts')
+
+        # 使用独立的 redis db, 避免压测数据混入正在使用的队列和缓存
+        location = urlparse(settings.CACHES['default']['LOCATION'])
+        caches = {'default': {**settings.CACHES['default'],
+                              'LOCATION': location._replace(path=f"/{options['redis_db']}").geturl()}}
+
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        server = FakeJudgeServer('benchmark', latency=(low, high), verdicts=verdicts).start()
+        try:
+            with override_settings(CACHES=caches, JUDGE_SERVERS=[server.address],
+                                   JUDGE_SERVER_TOKEN='benchmark',
+                                   SUBMISSION_USER_BURST=10 ** 9, SUBMISSION_IP_BURST=10 ** 9,
+                                   JUDGE_QUEUE_MAX_DEPTH=10 ** 9):
+                get_redis_connection("default").flushdb()
+                try:
+                    self.benchmark(server, options)
+                finally:
+                    get_redis_connection("default").flushdb()
+        finally:
+            server.stop()
+            runner.teardown_databases(old_config)
+
+    def benchmark(self, server, options):
+        problem = Problem.objects.create(title='benchmark', description='', input='', output='',
+                                         samples=[], test_case_id='benchmark')
+        users = [User.objects.create(username=f'benchmark{i}') for i in range(options['users'])]
+        url = reverse('submit')
+        latencies, queries, errors = [], [], []
+        lock = threading.Lock()
+
+        def submit(user):
+            client = APIClient()
+            client.token_auth(user)
+            try:
+                for index in range(options['submissions']):
+                    body = urllib.parse.urlencode({'problem_id': problem.id, 'language': 'C++',
+                                                   'code': code_template.format(user=user.id, index=index)})
+                    with CaptureQueriesContext(connection) as context:
+                        start = time.perf_counter()
+                        response = client.post(url, body, content_type='application/x-www-form-urlencoded')
+                        elapsed = time.perf_counter() - start
+                    with lock:
+                        latencies.append(elapsed * 1000)
+                        queries.append(len(context.captured_queries))
+                        if response.data.get('error'):
+                            errors.append(response.data['data'])
+            finally:
+                connections.close_all()
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=submit, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        submit_time = time.perf_counter() - start
+
+        total = len(latencies)
+        self.stdout.write(f'submit: {total} submissions by {len(users)} users in {submit_time:.2f}s, '
+                          f'{total / submit_time:.1f} req/s, {len(errors)} errors')
+        self.stdout.write(f'latency(ms): p50={percentile(latencies, 50):.1f} '
+                          f'p95={percentile(latencies, 95):.1f} p99={percentile(latencies, 99):.1f} '
+                          f'max={max(latencies):.1f}')
+        self.stdout.write(f'db queries per submission: {statistics.mean(queries):.1f}')
+        if errors:
+            self.stdout.write(f'first error: {errors[0]}')
+
+        if not options['workers']:
+            return
+
+        def work():
+            try:
+                call_command('judge_worker', '--once', stdout=StringIO())
+            finally:
+                connections.close_all()
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=work) for _ in range(options['workers'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # judge_worker --once 在队列空闲 1 秒后退出
+        judge_time = max(time.perf_counter() - start - 1, 1e-6)
+
+        judged = Submission.objects.exclude(
+            result__in=[JudgeStatus.PENDING, JudgeStatus.JUDGING]).count()
+        self.stdout.write(f'judge: {judged} submissions by {options["workers"]} workers in {judge_time:.2f}s, '
+                          f'{judged / judge_time:.1f} verdicts/s, {server.judge_count} judge requests')
@@ -0,0 +1,135 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from utils.judger.client import JudgeServerClientError
+from utils.judger.pool import NoJudgeServerAvailable, TestCaseNotReady, TestCaseSyncFailed
+from utils.judger.queue import JudgeQueue
+from utils.metrics import JUDGE_QUEUE_WAIT_SECONDS
+from submission.dispatcher import JudgeDispatcher
+from submission.models import Submission, JudgeStatus
+from submission.events import publish_event
+from submission.rejudge import report_result
+from submission.debug import run_debug
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Drain the judge queue and judge submissions on JudgeServer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='exit when the queue is empty')
+        parser.add_argument('--lanes', default=None,
+                            help='comma separated priority lanes to serve, all lanes by default')
+
+    # 单位秒, 检查崩溃的 worker 遗留任务的间隔
+    reap_interval = 60
+    # 评测机故障或判题超时时放回队列的最大次数, 之后判为系统错误
+    max_requeues = 3
+    # 单位秒, 放回队列的任务第 n 次等待 retry_delay * 2 ** (n - 1), 最多 max_retry_delay
+    retry_delay = 1
+    max_retry_delay = 30
+
+    def handle(self, *args, **options):
+        lanes = options['lanes'].split(',') if options['lanes'] else None
+        queue = JudgeQueue(lanes=lanes, worker_id=f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}')
+        self.stdout.write('judge worker started')
+        last_reap = 0
+        while True:
+            if time.time() - last_reap > self.reap_interval:
+                self.reap(queue)
+                last_reap = time.time()
+            task = queue.pop(timeout=1 if options['once'] else 0)
+            if task is None:
+                if options['once']:
+                    return
+                continue
+            try:
+                # 判题可能超过 worker_timeout, 期间持续续期心跳, 避免任务被 reap 后重复判题
+                with queue.keep_alive():
+                    self.process(queue, task)
+            finally:
+                # 判题结果已写回或任务已重新入队, 从处理中列表删除
+                queue.ack(task)
+
+    def reap(self, queue):
+        for task in queue.reap():
+            logger.warning(f'task of a dead worker requeued: {task}')
+            if task.get('submission_id') and not task.get('rejudge_job'):
+                Submission.objects.filter(id=task['submission_id'], result=JudgeStatus.JUDGING).update(
+                    result=JudgeStatus.PENDING)
+                publish_event(task['submission_id'], JudgeStatus.PENDING)
+
+    def process(self, queue, task):
+        JUDGE_QUEUE_WAIT_SECONDS.observe(time.time() - task['enqueue_time'],
+                                         lane=task['priority'])
+        if task.get('debug_id'):
+            try:
+                run_debug(task)
+            except Exception as e:
+                logger.exception(e)
+            return
+        submission_id = task['submission_id']
+        # 重判任务的结果交给 RejudgeRunner 批量写回, 不直接修改提交
+        job_id = task.get('rejudge_job')
+        try:
+            if job_id:
+                dispatcher = JudgeDispatcher(submission_id)
+                report_result(job_id, submission_id, *dispatcher.run(incremental=True),
+                              test_case_id=dispatcher.problem.test_case_id)
+            else:
+                JudgeDispatcher(submission_id).judge()
+        except JudgeServerClientError as e:
+            # 没有可用评测机或评测机故障, 延迟后放回队列重试, worker 继续处理其它任务.
+            # 所有评测机宕机时一直等待; 测试数据超过 JUDGE_TEST_CASE_WAIT_TIMEOUT 秒
+            # 仍未同步, 或评测机故障/判题超时超过 max_requeues 次后判为系统错误.
+            # ack 按原始内容删除处理中的任务, 所以不修改 task
+            retry = dict(task)
+            if isinstance(e, TestCaseNotReady):
+                retry.setdefault('wait_since', time.time())
+                if time.time() - retry['wait_since'] > settings.JUDGE_TEST_CASE_WAIT_TIMEOUT:
+                    logger.warning(f'submission {submission_id} failed waiting for test case: {e}')
+                    self.fail(submission_id, job_id, e)
+                    return
+            elif not isinstance(e, NoJudgeServerAvailable):
+                retry['attempts'] = task.get('attempts', 0) + 1
+                if retry['attempts'] > self.max_requeues:
+                    logger.warning(f'submission {submission_id} failed after {self.max_requeues} requeues: {e}')
+                    self.fail(submission_id, job_id, e)
+                    return
+            retry['waits'] = task.get('waits', 0) + 1
+            delay = min(self.retry_delay * 2 ** (retry['waits'] - 1), self.max_retry_delay)
+            logger.warning(f'submission {submission_id} requeued in {delay}s: {e}')
+            if not job_id:
+                Submission.objects.filter(id=submission_id).update(
+                    result=JudgeStatus.PENDING)
+                publish_event(submission_id, JudgeStatus.PENDING)
+            queue.push_delayed(delay, **retry)
+        except Submission.DoesNotExist:
+            logger.warning(f'submission {submission_id} does not exist')
+            if job_id:
+                report_result(job_id, submission_id)
+        except TestCaseSyncFailed as e:
+            # 测试数据重新同步之前无法判题, 不再放回队列
+            logger.warning(f'submission {submission_id} failed: {e}')
+            self.fail(submission_id, job_id, e)
+        except Exception as e:
+            logger.exception(e)
+            self.fail(submission_id, job_id, e)
+
+    def fail(self, submission_id, job_id, e):
+        if job_id:
+            report_result(job_id, submission_id, JudgeStatus.SYSTEM_ERROR,
+                          {"err": "SystemError", "data": str(e)}, {"err_info": str(e)})
+            return
+        Submission.objects.filter(id=submission_id).update(
+            result=JudgeStatus.SYSTEM_ERROR)
+        publish_event(submission_id, JudgeStatus.SYSTEM_ERROR)
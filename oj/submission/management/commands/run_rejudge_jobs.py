@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from submission.models import RejudgeJob, RejudgeStatus
+from submission.rejudge import RejudgeRunner
+
+
+class Command(BaseCommand):
+    help = 'Run pending rejudge jobs, resuming interrupted ones from their checkpoint.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', type=int, default=None,
+                            help='run only the job with this id')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='keep polling for new jobs every INTERVAL seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            jobs = RejudgeJob.objects.filter(
+                status__in=[RejudgeStatus.PENDING, RejudgeStatus.RUNNING])
+            if options['job']:
+                jobs = jobs.filter(id=options['job'])
+            for job in jobs:
+                if RejudgeRunner(job).run():
+                    self.stdout.write(f'rejudge job {job.id} {job.status}: '
+                                      f'{job.processed}/{job.total}')
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -1,3 +1,8 @@
+import hashlib
+import json
+import zlib
+
+from django.conf import settings
 from django.db import models
 from problem.models import Problem
 
@@ -16,22 +21,60 @@ class JudgeStatus:
     PARTIALLY_ACCEPTED = 8
 
 
+class CodeBlobManager(models.Manager):
+
+    def store(self, code):
+        '''
+            Get or create the blob of the source code, identical sources are stored once.
+        '''
+        data = code.encode('utf-8')
+        blob, _ = self.get_or_create(hash=hashlib.sha256(data).hexdigest(),
+                                     defaults={'data': zlib.compress(data), 'size': len(data)})
+        return blob
+
+
+class CodeBlob(models.Model):
+    '''
+        按内容寻址的源代码存储, 以 sha256 为主键, zlib 压缩.
+    '''
+    hash = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    # 未压缩的字节数
+    size = models.IntegerField()
+
+    objects = CodeBlobManager()
+
+    class Meta:
+        db_table = 'code_blob'
+
+    @property
+    def text(self):
+        return zlib.decompress(self.data).decode('utf-8')
+
+
 class Submission(models.Model):
     id = models.AutoField(primary_key=True)
     problem = models.ForeignKey(Problem, on_delete=models.CASCADE)
     create_time = models.DateTimeField(auto_now_add=True)
-    username = models.TextField()
-    code = models.TextField()
-    result = models.IntegerField(db_index=True, default=JudgeStatus.PENDING)
-    # 从 JudgeServer 返回的判题详情
-    # 或者其它 OJ 爬取的判题信息
+    username = models.CharField(max_length=255)
+    # 代码存放在 code_blob 表中, 提交列表不需要读取代码
+    code_blob = models.ForeignKey(CodeBlob, on_delete=models.PROTECT, db_column='code_hash')
+    result = models.IntegerField(default=JudgeStatus.PENDING)
+    # 每个测试点的判题摘要 [{test_case, result, cpu_time, memory, signal}]
+    # 或者其它 OJ 爬取的判题信息; 输出内容单独存放在 SubmissionOutput
     info = models.JSONField(default=dict)
-    language = models.TextField()
+    language = models.CharField(max_length=32)
     shared = models.BooleanField(default=False)
     # 存储该提交所用时间和内存值，方便提交列表显示
     # {time_cost: "", memory_cost: "", err_info: "", score: 0}
     statistic_info = models.JSONField(default=dict)
     ip = models.TextField(null=True)
+    # 判题时题目的 test_case_id, 增量重判据此找到 info 对应的测试数据
+    test_case_id = models.TextField(null=True)
+
+    @property
+    def code(self):
+        return self.code_blob.text
 
     # 检查用户能否查看此提交
     def check_user_permission(self, user, check_share=True):
@@ -40,7 +83,104 @@ class Submission(models.Model):
 
     class Meta:
         db_table = 'submission'
-        ordering = ('-create_time',)
+        ordering = ('-create_time', '-id')
+        # 提交列表按 (create_time, id) 做 keyset 分页, 各筛选条件都有对应的联合索引
+        indexes = [
+            models.Index(fields=['create_time', 'id']),
+            models.Index(fields=['username', 'create_time', 'id']),
+            models.Index(fields=['problem', 'create_time', 'id']),
+            models.Index(fields=['result', 'create_time', 'id']),
+            models.Index(fields=['language', 'create_time', 'id']),
+        ]
 
     def __str__(self):
         return self.id
+
+
+class SubmissionOutput(models.Model):
+    '''
+        每个测试点的用户输出, 截断到 SUBMISSION_OUTPUT_LIMIT 字节后 zlib 压缩存储,
+        只在查看提交详情时加载.
+    '''
+    submission = models.OneToOneField(
+        Submission, on_delete=models.CASCADE, primary_key=True, related_name='output')
+    # zlib(json({test_case: output}))
+    data = models.BinaryField()
+
+    class Meta:
+        db_table = 'submission_output'
+
+    @classmethod
+    def save_outputs(cls, submission, test_case_results):
+        limit = settings.SUBMISSION_OUTPUT_LIMIT
+        # 按 UTF-8 字节截断, 丢弃被截断的多字节字符
+        outputs = {item['test_case']: (item.get('output') or '').encode('utf-8')[:limit].decode(
+                       'utf-8', errors='ignore')
+                   for item in test_case_results}
+        data = zlib.compress(json.dumps(outputs).encode('utf-8'))
+        cls.objects.update_or_create(submission=submission, defaults={'data': data})
+
+    @classmethod
+    def copy_outputs(cls, source_id, submission):
+        '''
+            Copy the outputs of submission `source_id`, if it has any.
+        '''
+        source = cls.objects.filter(submission_id=source_id).first()
+        if source is not None:
+            cls.objects.update_or_create(submission=submission, defaults={'data': source.data})
+
+    @property
+    def outputs(self):
+        return json.loads(zlib.decompress(self.data))
+
+
+class RejudgeStatus(object):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    CANCELLED = 'cancelled'
+
+
+class RejudgeScope(object):
+    PROBLEM = 'problem'
+    USER = 'user'
+
+
+class RejudgeJob(models.Model):
+    '''
+        批量重判任务, 由 run_rejudge_jobs 按 submission id 升序分批执行.
+        每批完成后记录 checkpoint, 进程崩溃后从 checkpoint 之后继续.
+    '''
+    id = models.AutoField(primary_key=True)
+    # problem / user
+    scope = models.CharField(max_length=10)
+    # problem id 或 username
+    target = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, default=RejudgeStatus.PENDING)
+    created_by = models.CharField(max_length=255)
+    create_time = models.DateTimeField(auto_now_add=True)
+    update_time = models.DateTimeField(auto_now=True)
+    batch_size = models.IntegerField(default=100)
+    # 同时在判题队列中的提交数上限
+    concurrency = models.IntegerField(default=4)
+    total = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    # 已完成批次中最大的 submission id
+    checkpoint = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'rejudge_job'
+        ordering = ('id',)
+
+    def submissions(self):
+        '''
+            Submissions in the scope of the job, in id order.
+        '''
+        submissions = Submission.objects.order_by('id')
+        if self.scope == RejudgeScope.PROBLEM:
+            submissions = submissions.filter(problem_id=self.target)
+        elif self.scope == RejudgeScope.USER:
+            submissions = submissions.filter(username=self.target)
+        else:
+            submissions = submissions.none()
+        return submissions.filter(problem__is_remote=False)
@@ -0,0 +1,148 @@
+import json
+import logging
+import time
+from collections import Counter, deque
+
+from django_redis import get_redis_connection
+
+from utils.judger.queue import JudgeQueue, JudgePriority
+from utils.metrics import SUBMISSION_DB_WRITE_SECONDS
+from problem.counters import ProblemCounter
+
+from .models import Submission, RejudgeJob, RejudgeStatus, JudgeStatus
+from .events import publish_event
+
+
+logger = logging.getLogger(__name__)
+
+
+def results_key(job_id):
+    return f"rejudge:{job_id}:results"
+
+
+def report_result(job_id, submission_id, result=None, info=None, statistic_info=None,
+                  test_case_id=None):
+    '''
+        Called by the judge worker for a rejudge task. `result` is None when
+        the submission no longer exists.
+    '''
+    item = {"submission_id": submission_id, "result": result, "info": info,
+            "statistic_info": statistic_info, "test_case_id": test_case_id}
+    get_redis_connection("default").rpush(results_key(job_id), json.dumps(item))
+
+
+class RejudgeRunner(object):
+    '''
+        执行一个 RejudgeJob:
+
+        1. 从 checkpoint 之后按 id 取一批提交;
+        2. 推入 REJUDGE 队列, 同时最多 concurrency 个, worker 判完后把结果写回
+           rejudge:<id>:results;
+        3. 整批结果到齐后 bulk_update result/info/statistic_info, 再推进 checkpoint.
+
+        崩溃后重新运行会从 checkpoint 重做未完成的那一批, 已写回的批次不会重判.
+    '''
+    # 单位秒, 超过该时间没有收到任何结果时, 把尚未返回的提交重新入队
+    task_timeout = 300
+    lock_timeout = 60
+
+    def __init__(self, job, redis=None, queue=None):
+        self.job = job
+        self.redis = redis or get_redis_connection("default")
+        self.queue = queue or JudgeQueue(redis=self.redis)
+
+    @property
+    def lock_key(self):
+        return f"rejudge:{self.job.id}:lock"
+
+    def _refresh_lock(self):
+        self.redis.expire(self.lock_key, self.lock_timeout)
+
+    def _cancelled(self):
+        status = RejudgeJob.objects.filter(id=self.job.id).values_list(
+            'status', flat=True).first()
+        return status == RejudgeStatus.CANCELLED
+
+    def run(self, poll_timeout=5):
+        '''
+            Returns False if the job is being run by another process.
+        '''
+        if not self.redis.set(self.lock_key, 1, nx=True, ex=self.lock_timeout):
+            return False
+        try:
+            if self.job.status == RejudgeStatus.PENDING:
+                self.job.total = self.job.submissions().count()
+            self.job.status = RejudgeStatus.RUNNING
+            self.job.save(update_fields=['status', 'total', 'update_time'])
+
+            while not self._cancelled():
+                batch = list(self.job.submissions().filter(id__gt=self.job.checkpoint)
+                             .values_list('id', flat=True)[:self.job.batch_size])
+                if not batch:
+                    self.job.status = RejudgeStatus.FINISHED
+                    self.job.save(update_fields=['status', 'update_time'])
+                    self.redis.delete(results_key(self.job.id))
+                    break
+                results = self._judge_batch(batch, poll_timeout)
+                self._apply(results)
+                self.job.checkpoint = batch[-1]
+                self.job.processed += len(batch)
+                self.job.save(update_fields=['checkpoint', 'processed', 'update_time'])
+            return True
+        finally:
+            self.redis.delete(self.lock_key)
+
+    def _judge_batch(self, batch, poll_timeout):
+        pending = deque(batch)
+        in_flight = set()
+        results = {}
+        last_progress = time.time()
+        while pending or in_flight:
+            while pending and len(in_flight) < self.job.concurrency:
+                submission_id = pending.popleft()
+                self.queue.push(submission_id, priority=JudgePriority.REJUDGE,
+                                rejudge_job=self.job.id)
+                in_flight.add(submission_id)
+
+            self._refresh_lock()
+            item = self.redis.blpop([results_key(self.job.id)], timeout=poll_timeout)
+            if item is None:
+                if time.time() - last_progress > self.task_timeout:
+                    # worker 可能在判题过程中退出, 重新入队尚未返回的提交
+                    logger.warning(f'rejudge job {self.job.id}: requeue {sorted(in_flight)}')
+                    pending.extend(in_flight)
+                    in_flight.clear()
+                    last_progress = time.time()
+                continue
+
+            item = json.loads(item[1])
+            # 崩溃前入队的任务也会返回结果, 只接收当前批次的
+            if item['submission_id'] in in_flight:
+                in_flight.discard(item['submission_id'])
+                results[item['submission_id']] = item
+                last_progress = time.time()
+        return results
+
+    def _apply(self, results):
+        submissions = list(Submission.objects.filter(id__in=[
+            submission_id for submission_id, item in results.items()
+            if item['result'] is not None]).only('id', 'problem_id', 'result'))
+        solved = Counter()
+        for submission in submissions:
+            item = results[submission.id]
+            solved[submission.problem_id] += (int(item['result'] == JudgeStatus.ACCEPTED)
+                                              - int(submission.result == JudgeStatus.ACCEPTED))
+            submission.result = item['result']
+            submission.info = item['info']
+            submission.statistic_info = item['statistic_info']
+            submission.test_case_id = item['test_case_id']
+        with SUBMISSION_DB_WRITE_SECONDS.time(stage="rejudge"):
+            Submission.objects.bulk_update(
+                submissions, ['result', 'info', 'statistic_info', 'test_case_id'])
+
+        for submission in submissions:
+            publish_event(submission.id, submission.result, submission.statistic_info)
+        counter = ProblemCounter(redis=self.redis)
+        for problem_id, delta in solved.items():
+            if delta:
+                counter.incr(problem_id, solved=delta)
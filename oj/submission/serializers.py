@@ -1,8 +1,10 @@
 from rest_framework import serializers
-from .models import Submission
+from .models import Submission, RejudgeJob
 
 
 class SubmissionSerializer(serializers.ModelSerializer):
+    code = serializers.CharField(read_only=True)
+
     class Meta:
         model = Submission
         fields = '__all__'
@@ -17,3 +19,10 @@ class SubmissionDisplaySerializer(serializers.ModelSerializer):
         model = Submission
         fields = ['id', 'create_time', 'username',
                   'result', 'language', 'problem_title']
+
+
+class RejudgeJobSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = RejudgeJob
+        fields = '__all__'
@@ -1,13 +1,33 @@
+import base64
+import json
 import os
+import threading
+import time
 import urllib.parse
+from unittest import mock
 from django.test import TestCase
 from rest_framework.reverse import reverse
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from django.test import override_settings
+from django_redis import get_redis_connection
 
 from utils.api import APIClient
-from problem.models import Problem
-from account.models import User
-from .models import Submission, JudgeStatus
+from utils.judger.client import JudgeServerTimeout
+from utils.judger.fake_server import FakeJudgeServer
+from utils.judger.config import LANGUAGE_CONFIG, with_precompiled_headers
+from utils.judger.queue import JudgeQueue, JudgePriority
+from utils.judger.pool import JudgePool, JudgeServerStatus, NoJudgeServerAvailable, TestCaseNotReady, get_judge_pool
+from utils.throttling import TokenBucket
+from problem.models import Problem, ProblemRuleType
+from account.models import User, Role
+from .models import CodeBlob, Submission, SubmissionOutput, JudgeStatus, RejudgeJob, RejudgeScope, RejudgeStatus
+from .dispatcher import JudgeDispatcher
+from .cache import CompileErrorCache, VerdictCache
+from .events import EventSubscription, SubscriptionClosed, publish_event
+from .rejudge import RejudgeRunner, report_result
+from .debug import run_debug
+from .management.commands.judge_worker import Command as JudgeWorkerCommand
 
 from problem.utils import create_test_case_zip, TestCaseZipProcessor
 
@@ -35,7 +55,20 @@ testcase = [
 ]
 
 
-class SubmissionTest(TestCase, TestCaseZipProcessor):
+class FakeJudgeServerMixin(object):
+    '''
+        Judge on a local FakeJudgeServer instead of a real JudgeServer.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.judge_server = FakeJudgeServer('token', test_case_dir=settings.TEST_CASE_DIR).start()
+        cls.addClassCleanup(cls.judge_server.stop)
+        cls.enterClassContext(override_settings(JUDGE_SERVERS=[cls.judge_server.address],
+                                                JUDGE_SERVER_TOKEN='token'))
+
+
+class SubmissionTest(FakeJudgeServerMixin, TestCase, TestCaseZipProcessor):
     def setUp(self):
         # create example problem
         self.filename = 'test.zip'
@@ -45,26 +78,189 @@ class SubmissionTest(TestCase, TestCaseZipProcessor):
         _, test_case_id = self.process_zip(file, spj=False)
         self.problem.test_case_id = test_case_id
         self.problem.save()
-        self.rsync_test_cases(test_case_id)
 
         self.user = User.objects.create(username='test')
         self.client = APIClient()
         self.client.token_auth(self.user)
         self.url = reverse('submit')
 
+        redis = get_redis_connection("default")
+        for key in redis.scan_iter(f"{TokenBucket.key_prefix}*"):
+            redis.delete(key)
+
     def test_submit_cpp_code(self):
         body = {"code": cpp_code, "problem_id": self.problem.id, "language": "C++"}
         url_encoded_data = urllib.parse.urlencode(body)
-        response = self.client.post(
-            self.url, url_encoded_data, content_type='application/x-www-form-urlencoded')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                self.url, url_encoded_data, content_type='application/x-www-form-urlencoded')
 
         self.assertIsNone(response.data['error'])
         data = response.data['data']
         self.assertEqual(data['username'], self.user.username)
-        self.assertEqual(data['result'], JudgeStatus.ACCEPTED)
+        self.assertEqual(data['result'], JudgeStatus.PENDING)
+        self.assertEqual(JudgeQueue().pop(timeout=1)['submission_id'], data['id'])
+
+        JudgeDispatcher(data['id']).judge()
+        submission = Submission.objects.get(id=data['id'])
+        self.assertEqual(submission.result, JudgeStatus.ACCEPTED)
+        self.assertNotIn('output', submission.info[0])
+        self.assertEqual(submission.output.outputs['1'], 'Hello SWUFE OJ!')
+
+        metrics = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('oj_judge_total_seconds_count{language="C++"}', metrics)
+        self.assertIn(f'oj_judge_request_seconds_bucket{{endpoint="judge",server="{self.judge_server.address}",'
+                      f'le="+Inf"}}', metrics)
+        self.assertIn('oj_submission_db_write_seconds_count{stage="create"}', metrics)
+
+    def test_submit_contest_priority(self):
+        body = {"code": cpp_code, "problem_id": self.problem.id, "language": "C++",
+                "priority": JudgePriority.CONTEST}
+        url_encoded_data = urllib.parse.urlencode(body)
+        response = self.client.post(
+            self.url, url_encoded_data, content_type='application/x-www-form-urlencoded')
+        self.assertIsNotNone(response.data['error'])
+
+        self.user.admin_type = Role.ADMIN
+        self.user.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                self.url, url_encoded_data, content_type='application/x-www-form-urlencoded')
+        submission_id = response.data['data']['id']
+        queue = JudgeQueue()
+        self.assertEqual(queue.depth([JudgePriority.CONTEST]), 1)
+        task = queue.pop(timeout=1)
+        self.assertEqual((task['submission_id'], task['priority']), (submission_id, JudgePriority.CONTEST))
+        JudgeWorkerCommand().process(queue, task)
+        self.assertEqual(Submission.objects.get(id=submission_id).result, JudgeStatus.ACCEPTED)
+
+        body['priority'] = JudgePriority.REJUDGE
+        response = self.client.post(
+            self.url, urllib.parse.urlencode(body), content_type='application/x-www-form-urlencoded')
+        self.assertIsNotNone(response.data['error'])
+
+    def test_resubmit_identical_code(self):
+        body = {"code": cpp_code, "problem_id": self.problem.id, "language": "C++"}
+        url_encoded_data = urllib.parse.urlencode(body)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                self.url, url_encoded_data, content_type='application/x-www-form-urlencoded')
+        JudgeDispatcher(JudgeQueue().pop(timeout=1)['submission_id']).judge()
+
+        # identical code is answered from the verdict cache without judging
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                self.url, url_encoded_data, content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.data['data']['result'], JudgeStatus.ACCEPTED)
+        self.assertIsNone(JudgeQueue().pop(timeout=1))
+        # 缓存命中的提交同样有每个测试点的输出
+        self.assertEqual(Submission.objects.get(id=response.data['data']['id']).output.outputs['1'],
+                         'Hello SWUFE OJ!')
+        # identical sources are stored once
+        self.assertEqual(CodeBlob.objects.count(), 1)
+        self.assertEqual(Submission.objects.last().code, cpp_code)
+
+        VerdictCache.invalidate(self.problem.test_case_id)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                self.url, url_encoded_data, content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.data['data']['result'], JudgeStatus.PENDING)
+        JudgeQueue().pop(timeout=1)
+
+    def test_verdict_cache_key(self):
+        key = VerdictCache.key(self.problem, 'hash', 'C++', 1000, 256)
+        self.problem.rule_type = ProblemRuleType.OI
+        self.assertNotEqual(VerdictCache.key(self.problem, 'hash', 'C++', 1000, 256), key)
+        self.problem.rule_type = ProblemRuleType.ACM
+        self.problem.spj, self.problem.spj_version = True, 'v1'
+        self.assertNotEqual(VerdictCache.key(self.problem, 'hash', 'C++', 1000, 256), key)
+
+        # 超时结果与评测机负载有关, 不缓存
+        VerdictCache.set(key, JudgeStatus.CPU_TIME_LIMIT_EXCEEDED, [], {})
+        self.assertIsNone(VerdictCache.get(key))
+        VerdictCache.set(key, JudgeStatus.PARTIALLY_ACCEPTED,
+                         [{"result": JudgeStatus.REAL_TIME_LIMIT_EXCEEDED}], {})
+        self.assertIsNone(VerdictCache.get(key))
+
+    def test_submission_status(self):
+        body = {"code": cpp_code, "problem_id": self.problem.id, "language": "C++"}
+        url_encoded_data = urllib.parse.urlencode(body)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                self.url, url_encoded_data, content_type='application/x-www-form-urlencoded')
+        submission_id = response.data['data']['id']
+        url = reverse('submission_status', args=[submission_id])
+
+        response = self.client.get(url)
+        self.assertEqual(response.data['data']['result'], JudgeStatus.PENDING)
+        etag = response['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        JudgeDispatcher(JudgeQueue().pop(timeout=1)['submission_id']).judge()
+        response = self.client.get(url + '?wait=5', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['data']['result'], JudgeStatus.ACCEPTED)
+
+    @override_settings(SUBMISSION_USER_BURST=2)
+    def test_rate_limit(self):
+        body = {"code": cpp_code, "problem_id": self.problem.id, "language": "C++"}
+        url_encoded_data = urllib.parse.urlencode(body)
+        for _ in range(2):
+            response = self.client.post(
+                self.url, url_encoded_data, content_type='application/x-www-form-urlencoded')
+            self.assertIsNone(response.data['error'])
+
+        response = self.client.post(
+            self.url, url_encoded_data, content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.data['error'], 'too-many-requests')
+        self.assertIn('Retry-After', response)
+
+    @override_settings(SUBMISSION_USER_BURST=2, SUBMISSION_IP_BURST=1, SUBMISSION_IP_RATE=0.001)
+    def test_ip_limit_keeps_user_tokens(self):
+        body = {"code": cpp_code, "problem_id": self.problem.id, "language": "C++"}
+        url_encoded_data = urllib.parse.urlencode(body)
+        response = self.client.post(
+            self.url, url_encoded_data, content_type='application/x-www-form-urlencoded')
+        self.assertIsNone(response.data['error'])
+        response = self.client.post(
+            self.url, url_encoded_data, content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 429)
+
+        # IP 被限流的请求没有消耗用户的令牌, 换一个 IP 仍可提交
+        response = self.client.post(
+            self.url, url_encoded_data, content_type='application/x-www-form-urlencoded', REMOTE_ADDR='10.0.0.9')
+        self.assertIsNone(response.data['error'])
+
+    @override_settings(SUBMISSION_IP_BURST=1, SUBMISSION_IP_RATE=0.001, TRUSTED_PROXY_COUNT=1)
+    def test_ip_limit_behind_proxy(self):
+        body = {"code": cpp_code, "problem_id": self.problem.id, "language": "C++"}
+        url_encoded_data = urllib.parse.urlencode(body)
+        response = self.client.post(
+            self.url, url_encoded_data, content_type='application/x-www-form-urlencoded',
+            HTTP_X_FORWARDED_FOR='1.1.1.1, 10.0.0.1')
+        self.assertIsNone(response.data['error'])
+        # 客户端伪造的 X-Forwarded-For 不影响代理添加的 IP
+        response = self.client.post(
+            self.url, url_encoded_data, content_type='application/x-www-form-urlencoded',
+            HTTP_X_FORWARDED_FOR='2.2.2.2,10.0.0.1 ')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(Submission.objects.get().ip, '10.0.0.1')
 
     def test_compile_error(self):
-        pass
+        code_blob = CodeBlob.objects.store(cpp_code + '// COMPILE_ERROR')
+        submission = Submission.objects.create(
+            problem=self.problem, username=self.user.username, code_blob=code_blob, language='C++')
+        status, info, _ = JudgeDispatcher(submission.id).run()
+        self.assertEqual(status, JudgeStatus.COMPILE_ERROR)
+        # 再次提交相同的代码时直接使用缓存的编译错误
+        key = CompileErrorCache.key(code_blob.hash, LANGUAGE_CONFIG['C++'])
+        self.assertEqual(CompileErrorCache.get(key), info['data'])
+
+    def test_precompiled_headers(self):
+        config = with_precompiled_headers(LANGUAGE_CONFIG['C++'], '/pch')
+        self.assertIn('-I/pch {src_path}', config['compile']['compile_command'])
 
     def test_java_code(self):
         pass
@@ -72,6 +268,427 @@ class SubmissionTest(TestCase, TestCaseZipProcessor):
     def test_python_code(self):
         pass
 
+    def test_rule_type(self):
+        submission = Submission.objects.create(
+            problem=self.problem, username=self.user.username,
+            code_blob=CodeBlob.objects.store(cpp_code), language='C++')
+        results = [{"test_case": str(i), "result": JudgeStatus.ACCEPTED, "cpu_time": 1, "memory": 1}
+                   for i in range(1, 5)]
+        results[2]['result'] = JudgeStatus.WRONG_ANSWER
+        results[3]['result'] = JudgeStatus.CPU_TIME_LIMIT_EXCEEDED
+
+        dispatcher = JudgeDispatcher(submission.id)
+        status, info, statistic_info = dispatcher._aggregate(results)
+        self.assertEqual(status, JudgeStatus.WRONG_ANSWER)
+        self.assertEqual(len(info), 3)
+        self.assertEqual(statistic_info['err_info'], 'Failed on test 3')
+
+        dispatcher.problem.rule_type = ProblemRuleType.OI
+        status, info, statistic_info = dispatcher._aggregate(results)
+        self.assertEqual(status, JudgeStatus.PARTIALLY_ACCEPTED)
+        self.assertEqual(len(info), 4)
+        self.assertEqual(statistic_info['score'], 50)
+
+    def test_acm_fail_fast(self):
+        zip_file = create_test_case_zip(self.filename, [
+            {"filename": f"{i}.{suffix}", "content": str(i)} for i in range(1, 7) for suffix in ("in", "out")])
+        _, self.problem.test_case_id = self.process_zip(SimpleUploadedFile(self.filename, zip_file))
+        # 默认按 test_case_id 一次判完, 只编译一次
+        self.problem.save()
+        submission = Submission.objects.create(
+            problem=self.problem, username=self.user.username,
+            code_blob=CodeBlob.objects.store(cpp_code), language='C++')
+        judge_count = self.judge_server.judge_count
+        status, info, _ = JudgeDispatcher(submission.id).run()
+        self.assertEqual(self.judge_server.judge_count - judge_count, 1)
+        self.assertEqual(status, JudgeStatus.ACCEPTED)
+        self.assertEqual(len(info), 6)
+
+        self.problem.fail_fast = True
+        self.problem.save()
+        submission = Submission.objects.create(
+            problem=self.problem, username=self.user.username,
+            code_blob=CodeBlob.objects.store(cpp_code + '// WRONG'), language='C++')
+
+        # 按 1, 2, 4 个测试点分批, 第 2 批的第 2 个(即测试点 3)答案错误后不再运行测试点 4-6
+        judge_count = self.judge_server.judge_count
+        status, info, statistic_info = JudgeDispatcher(submission.id).run()
+        self.assertEqual(self.judge_server.judge_count - judge_count, 2)
+        self.assertEqual(status, JudgeStatus.WRONG_ANSWER)
+        self.assertEqual([item['test_case'] for item in info], ['1', '2', '3'])
+        self.assertEqual(statistic_info['err_info'], 'Failed on test 3')
+
+    def test_requeue_limit(self):
+        submission = Submission.objects.create(
+            problem=self.problem, username=self.user.username,
+            code_blob=CodeBlob.objects.store(cpp_code), language='C++')
+        queue = JudgeQueue()
+        queue.push(submission.id)
+        worker = JudgeWorkerCommand()
+        worker.retry_delay = 0
+        with mock.patch.object(JudgeDispatcher, 'judge', side_effect=JudgeServerTimeout('read timeout')):
+            for attempts in range(1, worker.max_requeues + 2):
+                task = queue.pop(timeout=1)
+                self.assertEqual(task.get('attempts', 0), attempts - 1)
+                worker.process(queue, task)
+        self.assertIsNone(queue.pop(timeout=1))
+        self.assertEqual(Submission.objects.get(id=submission.id).result, JudgeStatus.SYSTEM_ERROR)
+
+    def test_requeue_delayed(self):
+        submission = Submission.objects.create(
+            problem=self.problem, username=self.user.username,
+            code_blob=CodeBlob.objects.store(cpp_code), language='C++')
+        queue = JudgeQueue()
+        queue.push(submission.id)
+        worker = JudgeWorkerCommand()
+        # 没有可用评测机时不阻塞 worker, 任务延迟后回到队列, 不计入重试次数
+        with mock.patch.object(JudgeDispatcher, 'judge', side_effect=NoJudgeServerAvailable('down')):
+            worker.process(queue, queue.pop(timeout=1))
+        self.assertEqual(queue.redis.zcard(JudgeQueue.delayed_key), 1)
+        task = queue.pop(timeout=3)
+        self.assertEqual((task['submission_id'], task['waits']), (submission.id, 1))
+        self.assertNotIn('attempts', task)
+
+        # 测试数据等待同步超过 JUDGE_TEST_CASE_WAIT_TIMEOUT 后判为系统错误
+        task['wait_since'] = time.time() - settings.JUDGE_TEST_CASE_WAIT_TIMEOUT - 1
+        with mock.patch.object(JudgeDispatcher, 'judge', side_effect=TestCaseNotReady('not synced')):
+            worker.process(queue, task)
+        self.assertEqual(queue.redis.zcard(JudgeQueue.delayed_key), 0)
+        self.assertEqual(Submission.objects.get(id=submission.id).result, JudgeStatus.SYSTEM_ERROR)
+
+    def test_debug_run(self):
+        # 模拟 judge worker 处理 debug 队列
+        worker = threading.Thread(target=lambda: run_debug(
+            JudgeQueue(lanes=[JudgePriority.DEBUG]).pop(timeout=5)))
+        worker.start()
+        body = {"code": cpp_code, "language": "C++", "input": "1 2", "problem_id": self.problem.id}
+        response = self.client.post(reverse('debug_submission'), urllib.parse.urlencode(body),
+                                    content_type='application/x-www-form-urlencoded')
+        self.assertIsNone(response.data['error'])
+        url = reverse('debug_submission_result', args=[response.data['data']['debug_id']])
+        worker.join()
+
+        data = self.client.get(url + '?wait=5').json()['data']
+        self.assertTrue(data['finished'])
+        self.assertEqual(data['result'], JudgeStatus.ACCEPTED)
+        self.assertEqual(data['stdout'], '')
+        self.assertFalse(Submission.objects.exists())
+        self.assertEqual(self.client.get(reverse('debug_submission_result', args=['none'])).status_code, 404)
+
+    def test_spj_compiled_once_per_server(self):
+        self.problem.spj = True
+        self.problem.spj_language = 'C++'
+        self.problem.spj_code = cpp_code
+        self.problem.spj_version = 'v1'
+        self.problem.save()
+        code_blob = CodeBlob.objects.store(cpp_code)
+
+        pool = get_judge_pool()
+        server = pool.servers[0]
+        pool.discard_spj(server, 'v1')
+        pool.discard_spj(server, 'v2')
+        compile_spj_count = self.judge_server.compile_spj_count
+        for _ in range(2):
+            submission = Submission.objects.create(
+                problem=self.problem, username=self.user.username, code_blob=code_blob, language='C++')
+            status, _, _ = JudgeDispatcher(submission.id).run()
+            self.assertEqual(status, JudgeStatus.ACCEPTED)
+        self.assertEqual(self.judge_server.compile_spj_count - compile_spj_count, 1)
+        self.assertTrue(pool.has_spj(server, 'v1'))
+
+        # 新版本的 checker 需要重新编译
+        self.problem.spj_version = 'v2'
+        self.problem.save()
+        submission = Submission.objects.create(
+            problem=self.problem, username=self.user.username, code_blob=code_blob, language='C++')
+        JudgeDispatcher(submission.id).run()
+        self.assertEqual(self.judge_server.compile_spj_count - compile_spj_count, 2)
+
+        # 评测机异常后需要重新编译
+        pool.mark_abnormal(server)
+        self.assertFalse(pool.has_spj(server, 'v1'))
+        pool.ping(server)
+
+    def test_sample_preflight(self):
+        self.problem.sample_preflight = True
+        self.problem.samples = [{"input": None, "output": "Hello SWUFE OJ!"}] * 2
+        self.problem.save()
+        submission = Submission.objects.create(
+            problem=self.problem, username=self.user.username,
+            code_blob=CodeBlob.objects.store(cpp_code + '// WRONG'), language='C++')
+
+        status, info, statistic_info = JudgeDispatcher(submission.id).run()
+        self.assertEqual(status, JudgeStatus.WRONG_ANSWER)
+        self.assertEqual([item['test_case'] for item in info], ['sample-1', 'sample-2'])
+        self.assertEqual(statistic_info['err_info'], 'Failed on sample 2')
+
+    def test_sample_preflight_problem_from_api(self):
+        admin = User.objects.create(username='admin', admin_type=Role.ADMIN)
+        client = APIClient()
+        client.token_auth(admin)
+        body = {**test_problem, "samples": json.dumps([{"input": "", "output": "Hello SWUFE OJ!"}] * 2),
+                "sample_preflight": "true"}
+        response = client.post(reverse('create_problem'), urllib.parse.urlencode(body),
+                               content_type='application/x-www-form-urlencoded')
+        self.assertIsNone(response.data['error'])
+        problem = Problem.objects.get(id=response.data['data']['id'])
+        problem.test_case_id = self.problem.test_case_id
+        problem.save()
+
+        body = {"code": cpp_code + '// WRONG', "problem_id": problem.id, "language": "C++"}
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                self.url, urllib.parse.urlencode(body), content_type='application/x-www-form-urlencoded')
+        JudgeDispatcher(JudgeQueue().pop(timeout=1)['submission_id']).judge()
+        submission = Submission.objects.get(id=response.data['data']['id'])
+        self.assertEqual(submission.result, JudgeStatus.WRONG_ANSWER)
+        self.assertEqual(submission.statistic_info['err_info'], 'Failed on sample 2')
+
+    def test_incremental_rejudge(self):
+        submission = Submission.objects.create(
+            problem=self.problem, username=self.user.username,
+            code_blob=CodeBlob.objects.store(cpp_code), language='C++', result=JudgeStatus.ACCEPTED,
+            info=[{"test_case": "1", "result": JudgeStatus.ACCEPTED, "cpu_time": 1, "memory": 1, "signal": 0}],
+            test_case_id=self.problem.test_case_id)
+        # 在原有测试点之前插入一个新测试点
+        zip_file = create_test_case_zip(self.filename, [
+            {"filename": "1.in", "content": "1 2"}, {"filename": "1.out", "content": "3"},
+            {"filename": "2.in", "content": None}, {"filename": "2.out", "content": "Hello SWUFE OJ!"}])
+        _, self.problem.test_case_id = self.process_zip(SimpleUploadedFile(self.filename, zip_file))
+        self.problem.save()
+
+        dispatcher = JudgeDispatcher(submission.id)
+        reused, to_run, test_case = dispatcher._incremental_plan()
+        self.assertEqual(list(reused), ['2'])
+        self.assertEqual(to_run, ['1'])
+        self.assertEqual(test_case, [{"input": "1 2", "output": "3"}])
+
+        status, info, _ = dispatcher.run(incremental=True)
+        self.assertEqual(status, JudgeStatus.ACCEPTED)
+        self.assertEqual([item['test_case'] for item in info], ['1', '2'])
+
+        # 非 UTF-8 的测试数据改为完整重判
+        path = os.path.join(settings.TEST_CASE_DIR, self.problem.test_case_id, '1.in')
+        # 测试数据文件是 blob 的硬链接, 先删除再写, 不修改 blob
+        os.remove(path)
+        with open(path, 'wb') as f:
+            f.write(b'\xff\xfe')
+        self.assertIsNone(dispatcher._incremental_plan())
+
     def tearDown(self):
         os.remove(self.filename)
-        self.rsync_test_cases(self.problem.test_case_id, delete=True)
+
+
+class SubmissionOutputTest(TestCase):
+    def setUp(self):
+        self.submission = Submission.objects.create(
+            problem=Problem.objects.create(**test_problem), username='test',
+            code_blob=CodeBlob.objects.store(cpp_code), language='C++')
+
+    @override_settings(SUBMISSION_OUTPUT_LIMIT=4)
+    def test_output_limit_in_bytes(self):
+        SubmissionOutput.save_outputs(self.submission, [{"test_case": "1", "output": "你好"}])
+        # 第二个字符只剩 1 个字节, 整个丢弃
+        self.assertEqual(SubmissionOutput.objects.get(submission=self.submission).outputs, {"1": "你"})
+
+
+class SubmissionListAPITest(TestCase):
+    def setUp(self):
+        self.problem = Problem.objects.create(**test_problem)
+        code_blob = CodeBlob.objects.store(cpp_code)
+        for i in range(25):
+            Submission.objects.create(problem=self.problem, username=f'user{i % 2}', code_blob=code_blob,
+                                      language='C++', result=JudgeStatus.ACCEPTED)
+        self.client = APIClient()
+        self.url = reverse('submission_list')
+
+    def test_cursor_pagination(self):
+        ids = []
+        params = {'limit': 10}
+        while True:
+            data = self.client.get(self.url, params).data['data']
+            ids.extend(item['id'] for item in data['results'])
+            if not data['next']:
+                break
+            params['cursor'] = data['next']
+        expected = list(Submission.objects.order_by('-create_time', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_invalid_cursor(self):
+        for values in (["yesterday", 1], ["2024-01-01T00:00:00+00:00", "abc"], [None, 1], [1], {}):
+            cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+            response = self.client.get(self.url, {'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['data'], 'invalid cursor')
+        self.assertEqual(self.client.get(self.url, {'cursor': 'not base64'}).data['data'], 'invalid cursor')
+
+    def test_filter_by_username(self):
+        data = self.client.get(self.url, {'username': 'user0', 'limit': 50}).data['data']
+        self.assertEqual(len(data['results']), 13)
+        self.assertIsNone(data['next'])
+
+
+class JudgeQueueTest(TestCase):
+    def setUp(self):
+        self.queue = JudgeQueue()
+
+    def test_weighted_lanes(self):
+        for i in range(10):
+            self.queue.push(i, priority=JudgePriority.CONTEST)
+            self.queue.push(i, priority=JudgePriority.REJUDGE)
+        lanes = [self.queue.pop(timeout=1)['priority'] for _ in range(7)]
+        self.assertEqual(lanes.count(JudgePriority.CONTEST), 6)
+        self.assertEqual(lanes.count(JudgePriority.REJUDGE), 1)
+
+    def test_starvation(self):
+        self.queue.push(1, priority=JudgePriority.CONTEST)
+        self.queue.push(2, priority=JudgePriority.REJUDGE,
+                        enqueue_time=time.time() - JudgeQueue.max_wait - 1)
+        self.assertEqual(self.queue.pop(timeout=1)['submission_id'], 2)
+
+    def test_reap_dead_worker(self):
+        self.queue.push(1, priority=JudgePriority.PRACTICE)
+        worker = JudgeQueue(worker_id='dead')
+        task = worker.pop(timeout=1)
+        self.assertEqual(worker.redis.lrange(worker.processing_key, 0, -1), [json.dumps(task).encode()])
+        self.assertEqual(self.queue.reap(), [])
+
+        # worker 在判题过程中崩溃, 心跳过期后任务回到队列
+        worker.redis.delete(f'{JudgeQueue.heartbeat_prefix}dead')
+        self.assertEqual(self.queue.reap(), [task])
+        worker = JudgeQueue(worker_id='alive')
+        self.assertEqual(worker.pop(timeout=1), task)
+        worker.ack(task)
+        self.assertEqual(worker.redis.llen(worker.processing_key), 0)
+        worker.redis.delete(f'{JudgeQueue.heartbeat_prefix}alive')
+
+    def test_push_delayed(self):
+        self.queue.push_delayed(0.3, 1, priority=JudgePriority.REJUDGE)
+        self.queue.push(2, priority=JudgePriority.REJUDGE)
+        self.assertEqual(self.queue.pop(timeout=1)['submission_id'], 2)
+        start = time.time()
+        self.assertEqual(self.queue.pop(timeout=2)['submission_id'], 1)
+        self.assertLess(time.time() - start, 1)
+
+    def test_keep_alive_while_processing(self):
+        self.queue.push(1, priority=JudgePriority.PRACTICE)
+        worker = JudgeQueue(worker_id='slow')
+        worker.worker_timeout = 1
+        task = worker.pop(timeout=1)
+        # 判题时间超过 worker_timeout, 期间的 reap 不会把任务放回队列
+        with worker.keep_alive(interval=0.2):
+            time.sleep(1.5)
+            self.assertEqual(self.queue.reap(), [])
+        worker.ack(task)
+        self.assertIsNone(self.queue.pop(timeout=1))
+        worker.redis.delete(f'{JudgeQueue.heartbeat_prefix}slow')
+
+    def tearDown(self):
+        self.queue.redis.delete(JudgeQueue.delayed_key)
+        while self.queue.pop(timeout=1):
+            pass
+
+
+class EventHubTest(TestCase):
+    async def test_reader_failure(self):
+        async with EventSubscription(1) as subscription:
+            # 读取连接断开时结束已有的订阅
+            with mock.patch('redis.asyncio.client.PubSub.get_message',
+                            side_effect=ConnectionError('connection lost')):
+                with self.assertRaises(SubscriptionClosed):
+                    await subscription.get(timeout=5)
+
+        # 新的订阅重新建立连接
+        async with EventSubscription(1) as subscription:
+            publish_event(1, JudgeStatus.JUDGING)
+            message = await subscription.get(timeout=5)
+        self.assertEqual(message['result'], JudgeStatus.JUDGING)
+
+
+class RejudgeTest(TestCase):
+    def setUp(self):
+        self.problem = Problem.objects.create(**test_problem)
+        code_blob = CodeBlob.objects.store(cpp_code)
+        self.submissions = [Submission.objects.create(
+            problem=self.problem, username='test', code_blob=code_blob,
+            language='C++', result=JudgeStatus.ACCEPTED) for _ in range(5)]
+        self.job = RejudgeJob.objects.create(scope=RejudgeScope.PROBLEM, target=self.problem.id,
+                                             created_by='admin', batch_size=2, concurrency=1)
+        self.queue = JudgeQueue()
+
+    def test_resume_from_checkpoint(self):
+        # 模拟崩溃前已完成第一批
+        self.job.status = RejudgeStatus.RUNNING
+        self.job.checkpoint = self.submissions[1].id
+        self.job.processed = 2
+        self.job.total = 5
+        self.job.save()
+        # 判题 worker 写回的结果
+        for submission in self.submissions[2:]:
+            report_result(self.job.id, submission.id, JudgeStatus.WRONG_ANSWER,
+                          [], {"err_info": "Failed on test 1"})
+
+        self.assertTrue(RejudgeRunner(self.job, queue=self.queue).run(poll_timeout=1))
+
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, RejudgeStatus.FINISHED)
+        self.assertEqual(self.job.processed, 5)
+        self.assertEqual(self.job.checkpoint, self.submissions[-1].id)
+        results = {submission.id: submission.result for submission in Submission.objects.all()}
+        self.assertEqual([results[submission.id] for submission in self.submissions],
+                         [JudgeStatus.ACCEPTED] * 2 + [JudgeStatus.WRONG_ANSWER] * 3)
+        task = self.queue.pop(timeout=1)
+        self.assertEqual(task['priority'], JudgePriority.REJUDGE)
+        self.assertEqual(task['rejudge_job'], self.job.id)
+
+    def tearDown(self):
+        while self.queue.pop(timeout=1):
+            pass
+
+
+class JudgePoolTest(FakeJudgeServerMixin, TestCase):
+    def test_dead_server_out_of_rotation(self):
+        pool = JudgePool(['127.0.0.1:1', *settings.JUDGE_SERVERS],
+                         settings.JUDGE_SERVER_TOKEN)
+        for _ in range(3):
+            with pool.acquire() as server:
+                self.assertNotEqual(server.address, '127.0.0.1:1')
+
+    def test_no_server_available(self):
+        pool = JudgePool(['127.0.0.1:1'], settings.JUDGE_SERVER_TOKEN)
+        with self.assertRaises(NoJudgeServerAvailable):
+            pool.choose()
+
+    def test_read_timeout_keeps_server(self):
+        pool = JudgePool(settings.JUDGE_SERVERS, settings.JUDGE_SERVER_TOKEN)
+        pool.servers[0].client.timeout = (3, 0.05)
+        self.judge_server.latency = (200, 200)
+        self.addCleanup(setattr, self.judge_server, 'latency', (0, 0))
+        with self.assertRaises(JudgeServerTimeout):
+            with pool.acquire() as server:
+                server.client.judge(src=cpp_code, language_config=LANGUAGE_CONFIG['C++'], max_cpu_time=1000,
+                                    max_memory=256 * 1024 * 1024, test_case_id='none')
+        # 判题超时不代表评测机故障
+        self.assertEqual(pool.status()[0]['status'], JudgeServerStatus.NORMAL)
+        # 等替身评测机处理完超时的请求, 避免影响之后的测试
+        while self.judge_server.task_number:
+            time.sleep(0.01)
+
+    def test_task_number_reconciled_on_ping(self):
+        pool = get_judge_pool()
+        server = pool.servers[0]
+        # worker 在 acquire 中被杀死, 计数没有减掉
+        pool.redis.hincrby(pool._key(server), 'task_number', 3)
+        pool.ping(server)
+        self.assertEqual(int(pool.redis.hget(pool._key(server), 'task_number')), 0)
+
+    def test_invalid_token(self):
+        pool = JudgePool(settings.JUDGE_SERVERS, 'wrong token')
+        server = pool.servers[0]
+        pool.ping(server)
+        self.assertEqual(pool.redis.hget(pool._key(server), 'status').decode(), JudgeServerStatus.ABNORMAL)
+        with self.assertRaises(NoJudgeServerAvailable):
+            pool.choose()
+        # 状态按地址保存在 redis 中, 用正确的 token 重新 ping, 避免影响其他测试
+        get_judge_pool().ping(get_judge_pool().servers[0])
+        self.assertEqual(pool.redis.hget(pool._key(server), 'status').decode(), JudgeServerStatus.NORMAL)
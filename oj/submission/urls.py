@@ -1,7 +1,16 @@
 from django.urls import path
-from .views import SubmissionAPI, MakeSubmissionAPI
+from .views import (SubmissionAPI, SubmissionListAPI, MakeSubmissionAPI, DebugSubmissionAPI,
+                    RejudgeAPI, RejudgeJobAPI, debug_submission_result, submission_events,
+                    submission_status)
 
 urlpatterns = [
     path("submission/<int:pk>", SubmissionAPI.as_view()),
+    path("submission/<int:pk>/events", submission_events, name='submission_events'),
+    path("submission/<int:pk>/status", submission_status, name='submission_status'),
     path("submission", MakeSubmissionAPI.as_view(), name='submit'),
+    path("submission/debug", DebugSubmissionAPI.as_view(), name='debug_submission'),
+    path("submission/debug/<str:debug_id>", debug_submission_result, name='debug_submission_result'),
+    path("submissions", SubmissionListAPI.as_view(), name='submission_list'),
+    path("rejudge", RejudgeAPI.as_view(), name='rejudge'),
+    path("rejudge/<int:pk>", RejudgeJobAPI.as_view(), name='rejudge_job'),
 ]
@@ -1,26 +1,195 @@
-from .models import Submission, JudgeStatus
-from .serializers import SubmissionSerializer, SubmissionDisplaySerializer
+import asyncio
+import json
+import uuid
+
+from .models import (CodeBlob, Submission, SubmissionOutput, JudgeStatus,
+                     RejudgeJob, RejudgeScope, RejudgeStatus)
+from .serializers import SubmissionSerializer, SubmissionDisplaySerializer, RejudgeJobSerializer
+from .dispatcher import judge_limits
+from .cache import VerdictCache
+from .debug import debug_result_key, save_debug_result
+from .events import (STATUS_FIELDS, EventSubscription, SubscriptionClosed, event_of, get_async_redis,
+                     get_status, publish_event, status_etag, submission_event_stream)
 
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
-
+from django.http import Http404, HttpResponseNotModified, StreamingHttpResponse
 from django.conf import settings
+from django.db import transaction
 
 from problem.models import Problem
+from problem.counters import ProblemCounter
 
 from utils.token import JWTAuthTokenSerializer
-from utils.api import APIView
-from utils.judger.client import JudgeServerClient
+from utils.api import APIView, JSONResponse
 from utils.judger.config import LANGUAGE_CONFIG
+from utils.judger.queue import JudgeQueue, JudgePriority
+from utils.throttling import TokenBucket, client_ip
+from utils.metrics import SUBMISSION_CREATE_SECONDS, SUBMISSION_DB_WRITE_SECONDS
 
 
 class SubmissionAPI(APIView):
 
     def get(self, request, pk):
-        submission = get_object_or_404(Submission, id=pk)
+        submission = get_object_or_404(
+            Submission.objects.select_related('code_blob'), id=pk)
         serializer = SubmissionSerializer(submission)
-        return Response(serializer.data)
+        data = serializer.data
+        output = SubmissionOutput.objects.filter(submission=submission).first()
+        data['outputs'] = output.outputs if output else {}
+        return Response(data)
+
+
+async def submission_events(request, pk):
+    '''
+        Server-Sent Events of a submission's status changes, fed by redis
+        pub/sub. Serve it through oj.asgi so open streams don't hold a thread.
+    '''
+    if await get_status(pk) is None:
+        raise Http404
+
+    async def current_status():
+        status = await get_status(pk)
+        return {"id": pk, "event": event_of(status['result']), **status}
+
+    response = StreamingHttpResponse(submission_event_stream(pk, current_status),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # 禁止 nginx 缓冲事件流
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def submission_status(request, pk):
+    '''
+        Lightweight status of a submission from the redis status hash.
+
+        Supports ETag/If-None-Match; with `?wait=N` and a matching
+        If-None-Match the request is held until the status changes or N
+        seconds (at most 30) pass, then answered with 304 if nothing changed.
+    '''
+    try:
+        wait = min(max(int(request.GET.get('wait', 0)), 0), 30)
+    except ValueError:
+        wait = 0
+
+    status = await get_status(pk)
+    if status is None:
+        raise Http404
+    if_none_match = request.headers.get('If-None-Match')
+
+    if if_none_match == status_etag(status) and wait:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        async with EventSubscription(pk) as subscription:
+            # 订阅之后再读一次, 避免错过两者之间的状态变化
+            status = await get_status(pk)
+            while if_none_match == status_etag(status) and loop.time() < deadline:
+                try:
+                    message = await subscription.get(timeout=deadline - loop.time())
+                except SubscriptionClosed:
+                    # 订阅失效期间可能错过了消息, 直接返回当前状态
+                    status = await get_status(pk)
+                    break
+                if message is not None:
+                    status = {field: message[field] for field in STATUS_FIELDS}
+
+    etag = status_etag(status)
+    if if_none_match == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = JSONResponse.response({"error": None, "data": {"id": pk, **status}})
+    response['ETag'] = etag
+    return response
+
+
+class SubmissionListAPI(APIView):
+
+    def get(self, request):
+        '''
+            Submission list filtered by username, problem_id, result and
+            language, paginated by cursor over (create_time, id).
+        '''
+        submissions = Submission.objects.select_related('problem').only(
+            'id', 'create_time', 'username', 'result', 'language', 'problem__title')
+
+        username = request.GET.get('username')
+        problem_id = request.GET.get('problem_id')
+        result = request.GET.get('result')
+        language = request.GET.get('language')
+
+        if username:
+            submissions = submissions.filter(username=username)
+        if problem_id:
+            submissions = submissions.filter(problem_id=problem_id)
+        if result:
+            submissions = submissions.filter(result=result)
+        if language:
+            submissions = submissions.filter(language=language)
+
+        return self.success(self.keyset_paginate_data(
+            request, submissions, SubmissionDisplaySerializer))
+
+
+class RejudgeAPI(APIView):
+
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthTokenSerializer]
+
+    def post(self, request):
+        '''
+            Create a rejudge job over the submissions of a problem or a user,
+            run by `python manage.py run_rejudge_jobs`.
+        '''
+        if not request.user.is_admin():
+            return self.error('一般用户没有权限重判')
+
+        scope = request.POST.get('scope')
+        target = request.POST.get('target')
+        if not target:
+            return self.error('target is required')
+        if scope == RejudgeScope.PROBLEM:
+            if not Problem.objects.filter(id=target, is_remote=False).exists():
+                return self.error('problem not found')
+        elif scope != RejudgeScope.USER:
+            return self.error(f'unknown scope {scope}')
+
+        try:
+            batch_size = min(max(int(request.POST.get('batch_size', 100)), 1), 1000)
+            concurrency = min(max(int(request.POST.get('concurrency', 4)), 1), 32)
+        except ValueError:
+            return self.error('batch_size and concurrency must be integers')
+
+        job = RejudgeJob.objects.create(scope=scope, target=target,
+                                        created_by=request.user.username,
+                                        batch_size=batch_size, concurrency=concurrency)
+        return self.success(RejudgeJobSerializer(job).data)
+
+
+class RejudgeJobAPI(APIView):
+
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthTokenSerializer]
+
+    def get(self, request, pk):
+        '''
+            Progress of a rejudge job: status, processed and total.
+        '''
+        job = get_object_or_404(RejudgeJob, id=pk)
+        return self.success(RejudgeJobSerializer(job).data)
+
+    def delete(self, request, pk):
+        '''
+            Cancel a rejudge job, the running batch is still written back.
+        '''
+        if not request.user.is_admin():
+            return self.error('一般用户没有权限重判')
+        job = get_object_or_404(RejudgeJob, id=pk)
+        if job.status in (RejudgeStatus.PENDING, RejudgeStatus.RUNNING):
+            job.status = RejudgeStatus.CANCELLED
+            job.save(update_fields=['status', 'update_time'])
+        return self.success(RejudgeJobSerializer(job).data)
 
 
 class DebugSubmissionAPI(APIView):
@@ -29,7 +198,79 @@ class DebugSubmissionAPI(APIView):
     authentication_classes = [JWTAuthTokenSerializer]
 
     def post(self, request):
-        pass
+        '''
+            Queue a run of code on custom input in the debug lane and return
+            its debug_id; the result is polled with debug_submission_result. Nothing is
+            written to the submission table.
+
+            If problem_id is given, the problem's limits are used, capped by
+            DEBUG_MAX_CPU_TIME and DEBUG_MAX_MEMORY.
+        '''
+        code = request.POST.get('code')
+        language = request.POST.get('language')
+        input_data = request.POST.get('input', '')
+        problem_id = request.POST.get('problem_id')
+
+        if not code:
+            return self.error('code cannot be empty')
+        if language not in LANGUAGE_CONFIG:
+            return self.error(f'language {language} is not supported')
+        if len(input_data.encode('utf-8')) > settings.DEBUG_INPUT_LIMIT:
+            return self.error(f'input is larger than {settings.DEBUG_INPUT_LIMIT} bytes')
+
+        max_cpu_time = settings.DEBUG_MAX_CPU_TIME
+        max_memory = settings.DEBUG_MAX_MEMORY * 1024 * 1024
+        if problem_id:
+            try:
+                problem = Problem.objects.get(id=problem_id, is_remote=False)
+            except Problem.DoesNotExist:
+                return self.error('problem not found')
+            time_limit, memory_limit = judge_limits(problem, language)
+            max_cpu_time, max_memory = min(max_cpu_time, time_limit), min(max_memory, memory_limit)
+
+        queue = JudgeQueue()
+        if queue.depth([JudgePriority.DEBUG]) >= settings.DEBUG_QUEUE_MAX_DEPTH:
+            return self.too_many_requests('judge is busy, please retry later',
+                                          settings.JUDGE_QUEUE_RETRY_AFTER)
+        allowed, retry_after = TokenBucket(f'debug:user:{request.user.id}', settings.SUBMISSION_USER_RATE,
+                                           settings.SUBMISSION_USER_BURST).consume()
+        if not allowed:
+            return self.too_many_requests(
+                f'too many runs, please retry after {retry_after}s', retry_after)
+
+        debug_id = uuid.uuid4().hex
+        save_debug_result(debug_id, {"finished": False})
+        # debug 任务没有对应的提交
+        queue.push(None, priority=JudgePriority.DEBUG, debug_id=debug_id, code=code,
+                   language=language, input=input_data,
+                   max_cpu_time=max_cpu_time, max_memory=max_memory)
+        return self.success({"debug_id": debug_id})
+
+
+async def debug_submission_result(request, debug_id):
+    '''
+        Result of a debug run, `{"finished": false}` while it is queued or
+        running. With `?wait=N` the request is held until the run finishes or
+        N seconds (at most DEBUG_WAIT_TIMEOUT) pass, without blocking a worker
+        thread.
+    '''
+    try:
+        wait = min(max(int(request.GET.get('wait', 0)), 0), settings.DEBUG_WAIT_TIMEOUT)
+    except ValueError:
+        wait = 0
+
+    client = get_async_redis()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    while True:
+        data = await client.get(debug_result_key(debug_id))
+        if data is None:
+            raise Http404
+        result = json.loads(data)
+        if result["finished"] or loop.time() >= deadline:
+            break
+        await asyncio.sleep(0.1)
+    return JSONResponse.response({"error": None, "data": {"debug_id": debug_id, **result}})
 
 
 class MakeSubmissionAPI(APIView):
@@ -38,13 +279,21 @@ class MakeSubmissionAPI(APIView):
     authentication_classes = [JWTAuthTokenSerializer]
 
     def post(self, request):
+        language = request.POST.get('language')
+        # 标签只使用支持的语言, 避免任意输入产生大量时间序列
+        with SUBMISSION_CREATE_SECONDS.time(
+                language=language if language in LANGUAGE_CONFIG else 'other'):
+            return self.create_submission(request)
+
+    def create_submission(self, request):
         problem_id = request.POST.get('problem_id')
 
         if not problem_id:
             return self.error('problem_id is required')
 
-        problem = Problem.objects.get(id=problem_id)
-        if not problem:
+        try:
+            problem = Problem.objects.get(id=problem_id)
+        except Problem.DoesNotExist:
             return self.error('problem not found')
 
         user = request.user
@@ -55,50 +304,64 @@ class MakeSubmissionAPI(APIView):
             return self.error('code cannot be empty')
 
         language = request.POST.get('language')
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            ip = x_forwarded_for.split(',')[0]  # 使用代理获取真实的ip
-        else:
-            ip = request.META.get('REMOTE_ADDR')  # 未使用代理获取IP
+        # 比赛提交进入 contest 队列优先判题.
+        # TODO: 比赛模块完成后改为检查用户是否参加了该比赛, 目前只允许管理员使用
+        priority = request.POST.get('priority', JudgePriority.PRACTICE)
+        if priority not in (JudgePriority.PRACTICE, JudgePriority.CONTEST):
+            return self.error(f'unknown priority {priority}')
+        if priority == JudgePriority.CONTEST and not user.is_admin():
+            return self.error('一般用户没有权限提交到比赛队列')
 
+        ip = client_ip(request)
+
+        if not problem.is_remote and language not in LANGUAGE_CONFIG:
+            return self.error(f'language {language} is not supported')
+
+        # 判题积压过多时直接拒绝, 保证判题延迟有上限
+        if not problem.is_remote and JudgeQueue().depth(
+                [JudgePriority.CONTEST, JudgePriority.PRACTICE]) >= settings.JUDGE_QUEUE_MAX_DEPTH:
+            return self.too_many_requests('judge queue is full, please retry later',
+                                          settings.JUDGE_QUEUE_RETRY_AFTER)
+        # 两个桶一起扣减, IP 被限流时不消耗用户自己的令牌
+        allowed, retry_after = TokenBucket.consume_all([
+            TokenBucket(f'submit:user:{user.id}', settings.SUBMISSION_USER_RATE,
+                        settings.SUBMISSION_USER_BURST),
+            TokenBucket(f'submit:ip:{ip}', settings.SUBMISSION_IP_RATE, settings.SUBMISSION_IP_BURST)])
+        if not allowed:
+            return self.too_many_requests(
+                f'too many submissions, please retry after {retry_after}s', retry_after)
+
+        code_blob = CodeBlob.objects.store(code)
+
+        cached = None
         if not problem.is_remote:
-            client = JudgeServerClient(token=settings.JUDGE_SERVER_TOKEN,
-                                       server_base_url=f"http://{settings.JUDGE_SERVER_HOST}:{settings.JUDGE_SERVER_PORT}")
-
-            language_config = LANGUAGE_CONFIG.get(language)
-
-            if language == 'C++' or language == 'C':
-                time_limit = problem.standard_time_limit
-                # JudgeServer uses memory limit in Byte
-                memory_limit = problem.standard_memory_limit * 1024 * 1024
-            else:
-                time_limit = problem.other_time_limit
-                memory_limit = problem.other_memory_limit * 1024 * 1024
-
-            data = client.judge(src=code, language_config=language_config,
-                                max_cpu_time=time_limit, max_memory=memory_limit,
-                                test_case_id=problem.test_case_id, output=True)
-            if data['err'] == 'CompileError':
-                # TODO: handle compile error
-                pass
-
-            test_case_results = data['data']
-
-            status = JudgeStatus.PENDING
-            error_info = ""
-            for result in test_case_results:
-                if result['result'] != JudgeStatus.ACCEPTED:
-                    error_info = f'Failed on test {result['test_case']}'
-                    status = result['result']
-            # if all test cases passed, status is ACCEPTED
-            if status == JudgeStatus.PENDING:
-                status = JudgeStatus.ACCEPTED
-        else:
+            max_cpu_time, max_memory = judge_limits(problem, language)
+            # 完全相同的代码已经判过时直接记录缓存的结果
+            cached = VerdictCache.get(VerdictCache.key(
+                problem, code_blob.hash, language, max_cpu_time, max_memory))
+
+        # 判出缓存结果的提交, 从它复制每个测试点的输出
+        source_id = cached.pop("submission_id", None) if cached else None
+        with SUBMISSION_DB_WRITE_SECONDS.time(stage="create"):
+            submission = Submission.objects.create(
+                problem=problem, username=user.username, code_blob=code_blob,
+                language=language, ip=ip,
+                **({**cached, "test_case_id": problem.test_case_id} if cached else {"result": JudgeStatus.PENDING}))
+            if source_id:
+                SubmissionOutput.copy_outputs(source_id, submission)
+
+        publish_event(submission.id, submission.result,
+                      submission.statistic_info)
+        ProblemCounter().incr(problem.id, total=1,
+                              solved=int(submission.result == JudgeStatus.ACCEPTED))
+
+        if problem.is_remote:
             # TODO: remote judge
             pass
+        elif not cached:
+            # 判题由 judge_worker 进程异步完成, 这里只负责入队
+            transaction.on_commit(lambda: JudgeQueue().push(
+                submission.id, priority=priority))
 
-        submission = Submission.objects.create(
-            problem=problem, username=user.username, code=code,
-            language=language, result=status, info=test_case_results, ip=ip)
         serializer = SubmissionDisplaySerializer(submission)
         return self.success(serializer.data)
@@ -1,8 +1,12 @@
 # ref: https://github.com/QingdaoU/OnlineJudge/blob/master/utils/api/api.py
+import base64
+import datetime
 import functools
 import json
 import logging
 
+from django.core.exceptions import ValidationError
+from django.db.models import Q
 from django.http import HttpResponse, QueryDict
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
@@ -129,6 +133,15 @@ class APIView(APIView):
     def server_error(self):
         return self.error(err="server-error", msg="server error")
 
+    def too_many_requests(self, msg, retry_after) -> HttpResponse:
+        '''
+            返回 429 响应, 客户端应在 retry_after 秒后重试.
+        '''
+        resp = self.error(err="too-many-requests", msg=msg)
+        resp.status_code = 429
+        resp["Retry-After"] = str(retry_after)
+        return resp
+
     def paginate_data(self, request, query_set, object_serializer=None):
         """
         :param request: django 的 request
@@ -158,6 +171,56 @@ class APIView(APIView):
                 "total": count}
         return data
 
+    def keyset_paginate_data(self, request, query_set, object_serializer=None, keys=("create_time", "id")):
+        """
+        keyset(cursor) 分页, 按 keys 降序排列, 翻到任意一页的代价都相同.
+        query_set 上需要有 keys 对应的联合索引.
+
+        :param request: django 的 request, 通过 limit 和 cursor 参数翻页
+        :param query_set: django model 的 query set
+        :param object_serializer: 用来序列化 query set, 如果为 None, 则返回 model 对象
+        :param keys: 唯一确定顺序的字段, 最后一个字段应当唯一
+        :return: {"results": results, "next": 下一页的 cursor, 没有下一页时为 None}
+        """
+        try:
+            limit = int(request.GET.get("limit", "10"))
+        except ValueError:
+            limit = 10
+        if limit <= 0 or limit > 250:
+            limit = 10
+
+        cursor = request.GET.get("cursor")
+        if cursor:
+            try:
+                values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+                if not isinstance(values, list) or len(values) != len(keys) or None in values:
+                    raise ValueError
+                # 按字段类型解析, 例如 create_time 的 isoformat 字符串
+                values = [query_set.model._meta.get_field(key).to_python(value)
+                          for key, value in zip(keys, values)]
+            except (ValueError, TypeError, ValidationError):
+                raise APIError("invalid cursor")
+            # (k1, k2) < (v1, v2) => k1 < v1 or (k1 = v1 and k2 < v2)
+            condition = Q()
+            for index, key in enumerate(keys):
+                condition |= Q(**dict(zip(keys[:index], values)),
+                               **{f"{key}__lt": values[index]})
+            query_set = query_set.filter(condition)
+
+        results = list(query_set.order_by(
+            *[f"-{key}" for key in keys])[:limit + 1])
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            last = [getattr(results[-1], key) for key in keys]
+            last = [value.isoformat() if isinstance(value, datetime.datetime) else value
+                    for value in last]
+            next_cursor = base64.urlsafe_b64encode(
+                json.dumps(last).encode()).decode()
+        if object_serializer:
+            results = object_serializer(results, many=True).data
+        return {"results": results, "next": next_cursor}
+
     def dispatch(self, request, *args, **kwargs):
         if self.request_parsers:
             try:
@@ -1,37 +1,64 @@
 from __future__ import unicode_literals
+import asyncio
 import hashlib
 import json
+import time
+
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+
+from utils.metrics import JUDGE_REQUEST_SECONDS
 
 
 class JudgeServerClientError(Exception):
     pass
 
 
-class JudgeServerClient(object):
-    def __init__(self, token, server_base_url):
+class JudgeServerTimeout(JudgeServerClientError):
+    '''
+        The judge server accepted the request but did not answer within the
+        read timeout, e.g. a long judge on a busy server. The server itself
+        is not known to be down.
+    '''
+    pass
+
+
+class BaseJudgeServerClient(object):
+    '''
+        Shared by the sync and the asyncio client: token hashing, request
+        payloads and retry policy. Build one client per judge server and keep
+        it for the lifetime of the process so the connections are reused.
+
+        :param timeout: (connect timeout, read timeout) in seconds
+        :param max_retries: retries on connection errors, with exponential
+            backoff of `backoff_factor * 2 ** n` seconds between attempts
+    '''
+
+    def __init__(self, token, server_base_url, timeout=(3, 120), max_retries=3,
+                 backoff_factor=0.5, pool_maxsize=10):
         self.token = hashlib.sha256(token.encode("utf-8")).hexdigest()
         self.server_base_url = server_base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.pool_maxsize = pool_maxsize
+        self.headers = {"X-Judge-Server-Token": self.token,
+                        "Content-Type": "application/json"}
 
-    def _request(self, url, data=None):
-        kwargs = {"headers": {"X-Judge-Server-Token": self.token,
-                              "Content-Type": "application/json"}}
-        if data:
-            kwargs["data"] = json.dumps(data)
-        try:
-            return requests.post(url, **kwargs).json()
-        except Exception as e:
-            raise JudgeServerClientError(str(e))
+    def _backoff(self, attempt):
+        return self.backoff_factor * (2 ** attempt)
 
-    def ping(self):
-        return self._request(self.server_base_url + "/ping")
+    def _request_labels(self, url):
+        return {"server": self.server_base_url.split("://", 1)[-1],
+                "endpoint": url.rsplit("/", 1)[-1]}
 
-    def judge(self, src, language_config, max_cpu_time, max_memory, test_case_id=None, test_case=None, spj_version=None, spj_config=None,
-              spj_compile_config=None, spj_src=None, output=False):
+    def _judge_data(self, src, language_config, max_cpu_time, max_memory, test_case_id=None, test_case=None, spj_version=None, spj_config=None,
+                    spj_compile_config=None, spj_src=None, output=False):
         if not (test_case or test_case_id) or (test_case and test_case_id):
             raise ValueError("invalid parameter")
 
-        data = {"language_config": language_config,
+        return {"language_config": language_config,
                 "src": src,
                 "max_cpu_time": max_cpu_time,
                 "max_memory": max_memory,
@@ -42,9 +69,135 @@ class JudgeServerClient(object):
                 "spj_compile_config": spj_compile_config,
                 "spj_src": spj_src,
                 "output": output}
+
+    def _compile_spj_data(self, src, spj_version, spj_compile_config):
+        return {"src": src, "spj_version": spj_version,
+                "spj_compile_config": spj_compile_config}
+
+
+class JudgeServerClient(BaseJudgeServerClient):
+    '''
+        Judge server client over a pooled keep-alive requests.Session.
+    '''
+
+    def __init__(self, token, server_base_url, **kwargs):
+        super().__init__(token, server_base_url, **kwargs)
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _request(self, url, data=None, timeout=None, max_retries=None):
+        kwargs = {"timeout": timeout or self.timeout}
+        if data:
+            kwargs["data"] = json.dumps(data)
+        max_retries = self.max_retries if max_retries is None else max_retries
+        with JUDGE_REQUEST_SECONDS.time(**self._request_labels(url)):
+            for attempt in range(max_retries + 1):
+                try:
+                    return self.session.post(url, **kwargs).json()
+                except requests.ConnectionError as e:
+                    if attempt == max_retries:
+                        raise JudgeServerClientError(str(e))
+                    time.sleep(self._backoff(attempt))
+                except requests.ReadTimeout as e:
+                    # 判题请求不是幂等的, 读超时不重试
+                    raise JudgeServerTimeout(str(e))
+                except Exception as e:
+                    raise JudgeServerClientError(str(e))
+
+    def close(self):
+        self.session.close()
+
+    def ping(self):
+        # 心跳检测要尽快发现宕机的评测机, 不重试
+        connect_timeout = self.timeout[0]
+        return self._request(self.server_base_url + "/ping",
+                             timeout=(connect_timeout, connect_timeout), max_retries=0)
+
+    def judge(self, src, language_config, max_cpu_time, max_memory, **kwargs):
+        data = self._judge_data(src, language_config,
+                                max_cpu_time, max_memory, **kwargs)
         return self._request(self.server_base_url + "/judge", data=data)
 
     def compile_spj(self, src, spj_version, spj_compile_config):
-        data = {"src": src, "spj_version": spj_version,
-                "spj_compile_config": spj_compile_config}
-        return self._request(self.server_base_url + "/compile_spj", data=data)
\ No newline at end of file
+        data = self._compile_spj_data(src, spj_version, spj_compile_config)
+        return self._request(self.server_base_url + "/compile_spj", data=data)
+
+
+class AsyncJudgeServerClient(BaseJudgeServerClient):
+    '''
+        asyncio variant of JudgeServerClient, many judge calls can be in
+        flight on one event loop without a thread per call:
+        >>> async with AsyncJudgeServerClient(token, url) as client:
+        ...     results = await asyncio.gather(*[client.judge(...) for _ in tasks])
+    '''
+
+    def __init__(self, token, server_base_url, **kwargs):
+        super().__init__(token, server_base_url, **kwargs)
+        self.session = None
+
+    def _get_session(self):
+        # ClientSession must be created inside the running event loop
+        if self.session is None or self.session.closed:
+            connect_timeout, read_timeout = self.timeout
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=self.pool_maxsize),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout,
+                                              sock_read=read_timeout))
+        return self.session
+
+    async def _request(self, url, data=None, timeout=None, max_retries=None):
+        kwargs = {}
+        if data:
+            kwargs["data"] = json.dumps(data)
+        if timeout:
+            kwargs["timeout"] = aiohttp.ClientTimeout(sock_connect=timeout[0],
+                                                      sock_read=timeout[1])
+        max_retries = self.max_retries if max_retries is None else max_retries
+        # 记录指标是同步的 redis 调用, 只有几个命令, 不单独放到线程中
+        with JUDGE_REQUEST_SECONDS.time(**self._request_labels(url)):
+            for attempt in range(max_retries + 1):
+                try:
+                    async with self._get_session().post(url, **kwargs) as resp:
+                        return await resp.json(content_type=None)
+                except aiohttp.ServerTimeoutError as e:
+                    # aiohttp 的连接超时和读超时都是 ServerTimeoutError, 连接超时由 asyncio.TimeoutError 引起
+                    if not isinstance(e.__cause__, asyncio.TimeoutError):
+                        raise JudgeServerTimeout(str(e))
+                    if attempt == max_retries:
+                        raise JudgeServerClientError(str(e))
+                    await asyncio.sleep(self._backoff(attempt))
+                except aiohttp.ClientConnectionError as e:
+                    if attempt == max_retries:
+                        raise JudgeServerClientError(str(e))
+                    await asyncio.sleep(self._backoff(attempt))
+                except Exception as e:
+                    raise JudgeServerClientError(str(e))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def ping(self):
+        connect_timeout = self.timeout[0]
+        return await self._request(self.server_base_url + "/ping",
+                                   timeout=(connect_timeout, connect_timeout), max_retries=0)
+
+    async def judge(self, src, language_config, max_cpu_time, max_memory, **kwargs):
+        data = self._judge_data(src, language_config,
+                                max_cpu_time, max_memory, **kwargs)
+        return await self._request(self.server_base_url + "/judge", data=data)
+
+    async def compile_spj(self, src, spj_version, spj_compile_config):
+        data = self._compile_spj_data(src, spj_version, spj_compile_config)
+        return await self._request(self.server_base_url + "/compile_spj", data=data)
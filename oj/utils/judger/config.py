@@ -1,3 +1,5 @@
+from django.conf import settings
+
 default_env = ["LANG=en_US.UTF-8", "LANGUAGE=en_US:en", "LC_ALL=en_US.UTF-8"]
 
 
@@ -48,6 +50,21 @@ cpp_lang_config = {
     }
 }
 
+cpp_lang_spj_compile = {
+    "src_name": "spj-{spj_version}.cpp",
+    "exe_name": "spj-{spj_version}",
+    "max_cpu_time": 10000,
+    "max_real_time": 20000,
+    "max_memory": 1024 * 1024 * 1024,
+    "compile_command": "/usr/bin/g++ -DONLINE_JUDGE -O2 -w -fmax-errors=3 -std=c++11 {src_path} -lm -o {exe_path}"
+}
+
+cpp_lang_spj_config = {
+    "exe_name": "spj-{spj_version}",
+    "command": "{exe_path} {in_file_path} {user_out_file_path}",
+    "seccomp_rule": "c_cpp"
+}
+
 java_lang_config = {
     "name": "java",
     "compile": {
@@ -138,9 +155,28 @@ js_lang_config = {
     }
 }
 
+
+def with_precompiled_headers(lang_config, pch_dir):
+    '''
+        Put `pch_dir` in front of the include path of the compile command.
+        gcc looks for `<header>.gch` in each include directory before the
+        header itself, so `{pch_dir}/bits/stdc++.h.gch` replaces parsing
+        <bits/stdc++.h> on every compile. The .gch must be built with the
+        same flags as the compile command, e.g. for C++:
+        >>> g++ -DONLINE_JUDGE -O2 -w -std=c++11 -x c++-header \\
+        ...     /usr/include/x86_64-linux-gnu/c++/9/bits/stdc++.h -o {pch_dir}/bits/stdc++.h.gch
+    '''
+    if not pch_dir:
+        return lang_config
+    compile_config = lang_config["compile"]
+    compile_command = compile_config["compile_command"].replace(
+        " {src_path}", f" -I{pch_dir} {{src_path}}")
+    return {**lang_config, "compile": {**compile_config, "compile_command": compile_command}}
+
+
 LANGUAGE_CONFIG = {
     "C" : c_lang_config,
-    "C++": cpp_lang_config,
+    "C++": with_precompiled_headers(cpp_lang_config, settings.JUDGE_SERVER_PCH_DIR),
     "Java": java_lang_config,
     "Python2": py2_lang_config,
     "Python3": py3_lang_config,
@@ -148,3 +184,8 @@ LANGUAGE_CONFIG = {
     "PHP": php_lang_config,
     "Javascript": js_lang_config
 }
+
+SPJ_LANGUAGE_CONFIG = {
+    "C": {"compile": c_lang_spj_compile, "config": c_lang_spj_config},
+    "C++": {"compile": cpp_lang_spj_compile, "config": cpp_lang_spj_config},
+}
@@ -5,15 +5,18 @@
 
 import sys
 import os
-import django
-from client import JudgeServerClient
-from config import *
-from django.conf import settings
 
-sys.path.append('../..')
+# 以包的方式导入, 避免本目录下的 queue.py 遮蔽标准库的 queue
+sys.path[0] = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'oj.settings')
+
+import django  # noqa: E402
 django.setup()
 
+from django.conf import settings  # noqa: E402
+from utils.judger.client import JudgeServerClient  # noqa: E402
+from utils.judger.config import *  # noqa: E402, F403
+
 if __name__ == "__main__":
 
     c_src = r"""
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# JudgeServer 的判题结果
+ACCEPTED = 0
+WRONG_ANSWER = -1
+
+
+class FakeJudgeServer(object):
+    '''
+        本地替身评测机, 实现 JudgeServer 的 /ping, /judge 和 /compile_spj 接口,
+        不运行代码, 用于单元测试和压测:
+        >>> with FakeJudgeServer(token, latency=(50, 200), verdicts={0: 0.7, -1: 0.3}) as server:
+        ...     settings.JUDGE_SERVERS = [server.address]
+
+        每个提交按 verdicts 的权重随机给出一个结果, 非 ACCEPTED 时随机选一个测试点
+        失败; compile_error_rate 的提交编译失败. 另外为了让测试结果可预期:
+        源代码中含有 COMPILE_ERROR 时编译失败, 含有 WRONG 时第 2 个测试点答案错误.
+
+        :param latency: (min, max) of the response time of /judge in ms
+        :param test_case_dir: read the test cases of test_case_id from
+            `{test_case_dir}/{test_case_id}`, 1 test case if not found
+    '''
+
+    def __init__(self, token, host="127.0.0.1", port=0, latency=(0, 0), verdicts=None,
+                 compile_error_rate=0, test_case_dir=None, seed=None):
+        self.token = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        self.latency = latency
+        self.verdicts = verdicts or {ACCEPTED: 1}
+        self.compile_error_rate = compile_error_rate
+        self.test_case_dir = test_case_dir
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.task_number = 0
+        self.judge_count = 0
+        self.compile_spj_count = 0
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def address(self):
+        host, port = self.httpd.server_address[:2]
+        return f"{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.headers.get("X-Judge-Server-Token") != server.token:
+                    ret = {"err": "InvalidToken", "data": "invalid token"}
+                elif self.path == "/ping":
+                    ret = server.ping()
+                elif self.path == "/judge":
+                    ret = server.judge(body)
+                elif self.path == "/compile_spj":
+                    ret = server.compile_spj(body)
+                else:
+                    self.send_error(404)
+                    return
+                data = json.dumps(ret).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def _sleep(self):
+        low, high = self.latency
+        with self.lock:
+            delay = self.random.uniform(low, high)
+        if delay:
+            time.sleep(delay / 1000)
+
+    def _expected_outputs(self, body):
+        '''
+            Expected output of every test case, returned as the user output of
+            passed test cases.
+        '''
+        if body.get("test_case"):
+            return [item.get("output", "") for item in body["test_case"]]
+        if self.test_case_dir and body.get("test_case_id"):
+            test_case_dir = os.path.join(self.test_case_dir, body["test_case_id"])
+            try:
+                with open(os.path.join(test_case_dir, "info")) as f:
+                    test_cases = json.load(f)["test_cases"]
+                outputs = []
+                for name in sorted(test_cases, key=int):
+                    output_name = test_cases[name].get("output_name")
+                    if output_name is None:
+                        outputs.append("")
+                        continue
+                    with open(os.path.join(test_case_dir, output_name)) as f:
+                        outputs.append(f.read())
+                return outputs or [""]
+            except (OSError, ValueError, KeyError):
+                pass
+        return [""]
+
+    def ping(self):
+        return {"err": None, "data": {"judger_version": "2.0.1", "hostname": "fake-judge-server",
+                                      "running_task_number": self.task_number, "cpu_core": 1,
+                                      "cpu": min(self.task_number * 25.0, 100.0), "memory": 10.0,
+                                      "action": "pong"}}
+
+    def compile_spj(self, body):
+        self._sleep()
+        with self.lock:
+            self.compile_spj_count += 1
+        if "COMPILE_ERROR" in body.get("src", ""):
+            return {"err": "SPJCompileError", "data": "spj.cpp: error: expected ';'"}
+        return {"err": None, "data": "success"}
+
+    def judge(self, body):
+        with self.lock:
+            self.task_number += 1
+            self.judge_count += 1
+            compile_error = self.random.random() < self.compile_error_rate
+            verdict = self.random.choices(list(self.verdicts), weights=list(self.verdicts.values()))[0]
+        try:
+            self._sleep()
+            src = body.get("src", "")
+            if compile_error or "COMPILE_ERROR" in src:
+                return {"err": "CompileError", "data": "main.cpp: error: expected ';'"}
+
+            outputs = self._expected_outputs(body)
+            count = len(outputs)
+            failed = None
+            if "WRONG" in src and count >= 2:
+                verdict, failed = WRONG_ANSWER, 1
+            elif verdict != ACCEPTED:
+                with self.lock:
+                    failed = self.random.randrange(count)
+
+            results = []
+            for index, expected in enumerate(outputs):
+                results.append({"cpu_time": 1, "real_time": 2, "memory": 1024 * 1024, "signal": 0,
+                                "exit_code": 0, "error": 0,
+                                "result": verdict if index == failed else ACCEPTED,
+                                "test_case": str(index + 1),
+                                "output_md5": hashlib.md5(expected.encode("utf-8")).hexdigest(),
+                                "output": expected if body.get("output") else None})
+            return {"err": None, "data": results}
+        finally:
+            with self.lock:
+                self.task_number -= 1
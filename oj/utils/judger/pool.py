@@ -0,0 +1,239 @@
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django_redis import get_redis_connection
+
+from .client import JudgeServerClient, JudgeServerClientError, JudgeServerTimeout
+
+
+class NoJudgeServerAvailable(JudgeServerClientError):
+    pass
+
+
+class TestCaseNotReady(NoJudgeServerAvailable):
+    '''
+        Judge servers are up but the test case has not been synced to any
+        of them yet.
+    '''
+    pass
+
+
+class TestCaseSyncFailed(Exception):
+    '''
+        The test case failed to sync to every judge server, so it cannot be
+        judged until it is synced again.
+    '''
+    pass
+
+
+class JudgeServerStatus(object):
+    NORMAL = 'normal'
+    ABNORMAL = 'abnormal'
+
+
+class TestCaseSyncStatus(object):
+    PENDING = 'pending'
+    READY = 'ready'
+    FAILED = 'failed'
+    REMOVED = 'removed'
+
+
+class JudgeServer(object):
+    def __init__(self, address, token):
+        # address: "host:port"
+        self.address = address
+        self.host = address.rsplit(':', 1)[0]
+        self.client = JudgeServerClient(
+            token=token, server_base_url=f"http://{address}")
+
+    def __repr__(self):
+        return f"<JudgeServer {self.address}>"
+
+
+class JudgePool(object):
+    '''
+        评测机注册表.
+
+        健康状态, 负载(ping 返回的 cpu/cpu_core)和各评测机上正在进行的任务数
+        保存在 redis 中, 所有 web/worker 进程共享:
+        >>> pool = get_judge_pool()
+        >>> with pool.acquire() as server:
+        ...     server.client.judge(...)
+
+        acquire 会选择健康评测机中负载最低的一台; 判题请求失败时调用
+        mark_abnormal 将其移出轮转, 等待下一次 ping 成功后重新加入. 任务数
+        由 acquire 增减, 每次 ping 时用评测机返回的 running_task_number 修正,
+        worker 崩溃时没有减掉的计数不会一直留下.
+
+        每台评测机上已编译的 spj 版本记录在 judge:server:<address>:spj 集合中.
+
+        测试数据在各评测机上的同步状态记录在 judge:test_case:<test_case_id>
+        中, acquire(test_case_id) 只会选择已同步完成(ready)的评测机. 没有同步
+        记录的测试数据(例如启用同步服务之前上传的)视为在所有评测机上可用.
+    '''
+    key_prefix = "judge:server:"
+    # ping 的间隔, 单位秒
+    heartbeat_interval = 5
+
+    def __init__(self, addresses, token, redis=None):
+        self.servers = [JudgeServer(address, token) for address in addresses]
+        self.redis = redis or get_redis_connection("default")
+
+    def _key(self, server):
+        return f"{self.key_prefix}{server.address}"
+
+    def ping(self, server):
+        key = self._key(server)
+        try:
+            resp = server.client.ping()
+        except JudgeServerClientError:
+            resp = None
+        # 出错时(例如 token 错误) data 是错误信息字符串
+        data = resp.get('data') if isinstance(resp, dict) else None
+        if resp is None or resp.get('err') or not isinstance(data, dict):
+            self.redis.hset(key, mapping={
+                "status": JudgeServerStatus.ABNORMAL,
+                "last_heartbeat": time.time()})
+            return
+        mapping = {"status": JudgeServerStatus.NORMAL,
+                   "hostname": data.get('hostname', ''),
+                   "cpu": data.get('cpu', 0),
+                   "cpu_core": data.get('cpu_core', 1),
+                   "memory": data.get('memory', 0),
+                   "last_heartbeat": time.time()}
+        if 'running_task_number' in data:
+            # 以评测机上实际运行的任务数为准, 修正 worker 崩溃时没有减掉的计数
+            mapping["task_number"] = data['running_task_number']
+        self.redis.hset(key, mapping=mapping)
+
+    def status(self):
+        '''
+            Returns status of every registered judge server, pinging those whose
+            last heartbeat is older than `heartbeat_interval`.
+        '''
+        ret = []
+        now = time.time()
+        for server in self.servers:
+            info = self.redis.hgetall(self._key(server))
+            if now - float(info.get(b"last_heartbeat", 0)) > self.heartbeat_interval:
+                self.ping(server)
+                info = self.redis.hgetall(self._key(server))
+            ret.append({"server": server,
+                        "status": info[b"status"].decode(),
+                        "cpu": float(info.get(b"cpu", 0)),
+                        "cpu_core": int(info.get(b"cpu_core", 1)) or 1,
+                        # 修正后仍在进行的任务结束时会减到负数
+                        "task_number": max(int(info.get(b"task_number", 0)), 0)})
+        return ret
+
+    def choose(self, test_case_id=None):
+        candidates = [item for item in self.status()
+                      if item["status"] == JudgeServerStatus.NORMAL]
+        if not candidates:
+            raise NoJudgeServerAvailable("no judge server available")
+        if test_case_id:
+            candidates = [item for item in candidates
+                          if self.is_test_case_ready(item["server"], test_case_id)]
+            if not candidates:
+                statuses = self.test_case_status(test_case_id)
+                if statuses and all(statuses.get(server.address) == TestCaseSyncStatus.FAILED
+                                    for server in self.servers):
+                    raise TestCaseSyncFailed(f"test case {test_case_id} failed to sync to every judge server")
+                raise TestCaseNotReady(f"test case {test_case_id} is not ready on any judge server")
+        best = min(candidates, key=lambda item: (
+            item["task_number"] / item["cpu_core"], item["cpu"]))
+        return best["server"]
+
+    def mark_abnormal(self, server):
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key(server), mapping={
+            "status": JudgeServerStatus.ABNORMAL,
+            "last_heartbeat": time.time()})
+        # 评测机可能已经重启, 之前编译的 spj 不一定还在
+        pipe.delete(self._spj_key(server))
+        pipe.execute()
+
+    def _spj_key(self, server):
+        return f"{self.key_prefix}{server.address}:spj"
+
+    def has_spj(self, server, spj_version):
+        '''
+            Whether the checker of `spj_version` has been compiled on the server.
+        '''
+        return bool(self.redis.sismember(self._spj_key(server), spj_version))
+
+    def add_spj(self, server, spj_version):
+        self.redis.sadd(self._spj_key(server), spj_version)
+
+    def discard_spj(self, server, spj_version):
+        self.redis.srem(self._spj_key(server), spj_version)
+
+    def _test_case_key(self, test_case_id):
+        return f"judge:test_case:{test_case_id}"
+
+    def test_case_status(self, test_case_id):
+        '''
+            {address: TestCaseSyncStatus} of the servers the test case has
+            been scheduled to sync to, empty if it is not tracked.
+        '''
+        return {address.decode(): status.decode() for address, status in
+                self.redis.hgetall(self._test_case_key(test_case_id)).items()}
+
+    def set_test_case_status(self, test_case_id, status, servers=None):
+        servers = self.servers if servers is None else servers
+        if servers:
+            self.redis.hset(self._test_case_key(test_case_id),
+                            mapping={server.address: status for server in servers})
+
+    def is_test_case_ready(self, server, test_case_id):
+        key = self._test_case_key(test_case_id)
+        status = self.redis.hget(key, server.address)
+        if status is None:
+            return not self.redis.exists(key)
+        return status.decode() == TestCaseSyncStatus.READY
+
+    @contextmanager
+    def acquire(self, test_case_id=None):
+        '''
+            Choose the least-loaded healthy judge server and count the task
+            as in flight on it until the block exits.
+
+            :param test_case_id: only choose servers the test case is ready on
+        '''
+        server = self.choose(test_case_id)
+        key = self._key(server)
+        self.redis.hincrby(key, "task_number", 1)
+        try:
+            yield server
+        except JudgeServerTimeout:
+            # 评测机仍然可用, 只是这次判题超过了读超时
+            raise
+        except JudgeServerClientError:
+            self.mark_abnormal(server)
+            raise
+        finally:
+            self.redis.hincrby(key, "task_number", -1)
+
+
+_pool = None
+
+
+def get_judge_pool():
+    '''
+        进程内共享的 JudgePool, 评测机列表来自 settings.JUDGE_SERVERS.
+    '''
+    global _pool
+    if _pool is None:
+        _pool = JudgePool(settings.JUDGE_SERVERS, settings.JUDGE_SERVER_TOKEN)
+    return _pool
+
+
+@receiver(setting_changed)
+def reset_judge_pool(setting, **kwargs):
+    # override_settings 修改评测机配置后重新创建
+    global _pool
+    if setting in ('JUDGE_SERVERS', 'JUDGE_SERVER_TOKEN'):
+        _pool = None
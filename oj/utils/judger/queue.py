@@ -0,0 +1,267 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from django_redis import get_redis_connection
+
+
+class JudgePriority(object):
+    # 比赛提交
+    CONTEST = 'contest'
+    # 练习提交
+    PRACTICE = 'practice'
+    # 自定义输入运行
+    DEBUG = 'debug'
+    # 后台重判
+    REJUDGE = 'rejudge'
+
+
+class JudgeQueue(object):
+    '''
+        Redis 判题队列, 复用 settings.CACHES 中 default 的 redis 连接.
+
+        每个优先级一个 redis list. Web 进程只负责 push, 判题由独立的 judge_worker
+        进程 pop 后完成:
+        >>> queue = JudgeQueue()
+        >>> queue.push(submission.id, priority=JudgePriority.CONTEST)
+        >>> queue.pop(timeout=5)
+        {'submission_id': 1, 'priority': 'contest', 'enqueue_time': 1700000000.0}
+
+        pop 在非空的队列之间按 weights 做平滑加权轮询, 比赛提交获得大部分判题机时,
+        重判只在空闲时消耗剩余的判题能力. 任何队列中等待超过 max_wait 秒的任务
+        会被优先取出, 避免低优先级任务饿死.
+
+        指定 worker_id 时, pop 用 LMOVE/BLMOVE 把任务原子地移入该 worker 的
+        处理中列表 judge:processing:<worker_id>, 处理完成后调用 ack 删除.
+        worker 通过 heartbeat 续期, 处理任务期间由 keep_alive 在后台线程中续期;
+        worker 崩溃后心跳过期, reap 会把它处理中的任务放回原来的队列:
+        >>> queue = JudgeQueue(worker_id="host:1234")
+        >>> task = queue.pop(timeout=5)
+        >>> with queue.keep_alive():
+        ...     ...
+        >>> queue.ack(task)
+
+        暂时无法判题的任务(例如没有可用评测机)用 push_delayed 放入
+        judge:delayed 有序集合, 按到期时间排序, pop 时把到期的任务移回原来的
+        队列, worker 不需要 sleep 等待.
+    '''
+    key_prefix = "judge:queue:"
+    weights = {JudgePriority.CONTEST: 6,
+               JudgePriority.PRACTICE: 3,
+               JudgePriority.DEBUG: 2,
+               JudgePriority.REJUDGE: 1}
+    # 单位秒
+    max_wait = 60
+    processing_prefix = "judge:processing:"
+    heartbeat_prefix = "judge:worker:"
+    # 单位秒, worker 超过该时间没有心跳视为已崩溃
+    worker_timeout = 300
+    # 单位秒, 所有队列为空时在每个队列上阻塞等待的时间
+    block_slice = 0.1
+    delayed_key = "judge:delayed"
+    # 把到期的延迟任务移回各自的队列, 每次最多 100 个
+    promote_script = """
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 100)
+for _, item in ipairs(items) do
+    redis.call('ZREM', KEYS[1], item)
+    redis.call('LPUSH', ARGV[2] .. cjson.decode(item)['priority'], item)
+end
+return #items
+"""
+
+    def __init__(self, redis=None, lanes=None, worker_id=None):
+        self.redis = redis or get_redis_connection("default")
+        # 按优先级从高到低排列
+        self.lanes = lanes or list(self.weights)
+        self.current_weights = {lane: 0 for lane in self.lanes}
+        self.worker_id = worker_id
+
+    def _key(self, lane):
+        return f"{self.key_prefix}{lane}"
+
+    @property
+    def processing_key(self):
+        return f"{self.processing_prefix}{self.worker_id}"
+
+    def heartbeat(self):
+        if self.worker_id:
+            self.redis.set(f"{self.heartbeat_prefix}{self.worker_id}", time.time(),
+                           ex=self.worker_timeout)
+
+    @contextmanager
+    def keep_alive(self, interval=None):
+        '''
+            Refresh the heartbeat every `interval` seconds (a third of
+            worker_timeout by default) while the block runs, so a judge that
+            takes longer than worker_timeout is not reaped.
+        '''
+        if not self.worker_id:
+            yield
+            return
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval or self.worker_timeout / 3):
+                self.heartbeat()
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def push(self, submission_id, priority=JudgePriority.PRACTICE, enqueue_time=None, **extra):
+        '''
+            `enqueue_time` is kept when a task is put back, so it keeps its age.
+        '''
+        task = {"submission_id": submission_id, "priority": priority,
+                "enqueue_time": enqueue_time or time.time(), **extra}
+        self.redis.lpush(self._key(priority), json.dumps(task))
+
+    def push_delayed(self, delay, submission_id, priority=JudgePriority.PRACTICE,
+                     enqueue_time=None, **extra):
+        '''
+            Push the task to its lane after `delay` seconds.
+        '''
+        task = {"submission_id": submission_id, "priority": priority,
+                "enqueue_time": enqueue_time or time.time(), **extra}
+        self.redis.zadd(self.delayed_key, {json.dumps(task): time.time() + delay})
+
+    def _promote(self):
+        return self.redis.eval(self.promote_script, 1, self.delayed_key, time.time(), self.key_prefix)
+
+    def _next_delayed(self):
+        '''
+            Seconds until the next delayed task is due, None if there is none.
+        '''
+        item = self.redis.zrange(self.delayed_key, 0, 0, withscores=True)
+        return max(item[0][1] - time.time(), 0) if item else None
+
+    def _choose(self):
+        '''
+            Choose the lane to pop from, None if all lanes are empty.
+        '''
+        pipe = self.redis.pipeline()
+        for lane in self.lanes:
+            pipe.llen(self._key(lane))
+            # 最早入队的任务在 list 的右端
+            pipe.lindex(self._key(lane), -1)
+        result = pipe.execute()
+        lengths = dict(zip(self.lanes, result[::2]))
+        oldest = dict(zip(self.lanes, result[1::2]))
+
+        active = [lane for lane in self.lanes if lengths[lane]]
+        if not active:
+            return None
+
+        now = time.time()
+        ages = {lane: now - json.loads(oldest[lane])["enqueue_time"]
+                for lane in active if oldest[lane]}
+        starving = [lane for lane in active if ages.get(lane, 0) > self.max_wait]
+        if starving:
+            return max(starving, key=ages.get)
+
+        # smooth weighted round-robin
+        total = 0
+        for lane in active:
+            self.current_weights[lane] += self.weights[lane]
+            total += self.weights[lane]
+        lane = max(active, key=lambda item: self.current_weights[item])
+        self.current_weights[lane] -= total
+        return lane
+
+    def pop(self, timeout=0):
+        '''
+            Block until a task is available, `timeout` in seconds (0 for forever).
+            Returns None on timeout.
+        '''
+        if self.worker_id:
+            self.heartbeat()
+            return self._pop_reliable(timeout)
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            self._promote()
+            lane = self._choose()
+            if lane is None:
+                # 全部为空时阻塞等待, BRPOP 按参数顺序检查, 即按优先级.
+                # 有延迟任务时只等到它到期, 0 表示一直等待
+                waits = [wait for wait in (self._next_delayed(),
+                                           deadline and deadline - time.time()) if wait is not None]
+                wait = max(min(waits), 0.01) if waits else 0
+                item = self.redis.brpop([self._key(lane) for lane in self.lanes], timeout=wait)
+                if item is not None:
+                    return json.loads(item[1])
+                if deadline is not None and time.time() >= deadline:
+                    return None
+                continue
+            item = self.redis.rpop(self._key(lane))
+            # 可能已被其它 worker 取走
+            if item is not None:
+                return json.loads(item)
+
+    def _pop_reliable(self, timeout):
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            self._promote()
+            lane = self._choose()
+            if lane is not None:
+                item = self.redis.lmove(self._key(lane), self.processing_key, "RIGHT", "LEFT")
+                if item is not None:
+                    return json.loads(item)
+                continue
+            # BLMOVE 只能等待一个 list, 全部为空时按优先级依次在每个队列上短暂阻塞
+            for lane in self.lanes:
+                item = self.redis.blmove(self._key(lane), self.processing_key,
+                                         self.block_slice, "RIGHT", "LEFT")
+                if item is not None:
+                    return json.loads(item)
+            if deadline is not None and time.time() >= deadline:
+                return None
+            self.heartbeat()
+
+    def ack(self, task):
+        '''
+            Remove a task popped by this worker from its processing list.
+        '''
+        if self.worker_id:
+            self.redis.lrem(self.processing_key, 1, json.dumps(task))
+
+    def reap(self):
+        '''
+            Put the tasks of workers whose heartbeat expired back to the right
+            end of their lanes, so they are judged next. Returns the tasks.
+        '''
+        tasks = []
+        # 同一时间只有一个 worker 在 reap
+        if not self.redis.set("judge:reap:lock", 1, nx=True, ex=60):
+            return tasks
+        try:
+            for key in self._stale_processing_keys():
+                while True:
+                    item = self.redis.lindex(key, -1)
+                    if item is None:
+                        break
+                    task = json.loads(item)
+                    if self.redis.lmove(key, self._key(task["priority"]), "RIGHT", "RIGHT") is not None:
+                        tasks.append(task)
+        finally:
+            self.redis.delete("judge:reap:lock")
+        return tasks
+
+    def _stale_processing_keys(self):
+        for key in self.redis.scan_iter(match=f"{self.processing_prefix}*"):
+            worker_id = key.decode()[len(self.processing_prefix):]
+            if not self.redis.exists(f"{self.heartbeat_prefix}{worker_id}"):
+                yield key
+
+    def depth(self, lanes=None):
+        pipe = self.redis.pipeline()
+        for lane in lanes or self.lanes:
+            pipe.llen(self._key(lane))
+        return sum(pipe.execute())
+
+    def __len__(self):
+        return self.depth()
@@ -0,0 +1,131 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+
+logger = logging.getLogger(__name__)
+
+
+def _format_labels(labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return ",".join(f'{name}="{escape(value)}"' for name, value in sorted(labels.items()))
+
+
+class Histogram(object):
+    '''
+        保存在 redis 中的 Prometheus histogram, web 和 judge worker 的多个进程
+        共同累加, 由 /metrics 导出:
+        >>> with JUDGE_REQUEST_SECONDS.time(server="127.0.0.1:12358", endpoint="judge"):
+        ...     client.judge(...)
+
+        每个 histogram 一个 redis hash, field 为 "标签|桶上界", 另有 "标签|sum" 和
+        "标签|count". 写入失败只记录日志, 不影响判题.
+    '''
+    key_prefix = "metrics:"
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    registry = {}
+
+    def __init__(self, name, documentation, buckets=None):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets or self.default_buckets)
+        Histogram.registry[name] = self
+
+    @property
+    def key(self):
+        return f"{self.key_prefix}{self.name}"
+
+    def observe(self, value, **labels):
+        self.observe_many([value], **labels)
+
+    def observe_many(self, values, **labels):
+        '''
+            Observe several values with the same labels in one round trip.
+        '''
+        if not values:
+            return
+        label_str = _format_labels(labels)
+        try:
+            pipe = get_redis_connection("default").pipeline(transaction=False)
+            for value in values:
+                # 只记录落入的最小的桶, 导出时再累加
+                bucket = next((str(bucket) for bucket in self.buckets if value <= bucket), "+Inf")
+                pipe.hincrby(self.key, f"{label_str}|{bucket}", 1)
+            pipe.hincrbyfloat(self.key, f"{label_str}|sum", sum(values))
+            pipe.hincrby(self.key, f"{label_str}|count", len(values))
+            pipe.execute()
+        except RedisError as e:
+            logger.warning(f"failed to record metric {self.name}: {e}")
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+            Observe the duration of the block in seconds. Labels can be added
+            to the yielded dict inside the block.
+        '''
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        series = {}
+        for field, value in get_redis_connection("default").hgetall(self.key).items():
+            label_str, bucket = field.decode().rsplit("|", 1)
+            series.setdefault(label_str, {})[bucket] = float(value)
+
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_str, values in sorted(series.items()):
+            prefix = f"{label_str}," if label_str else ""
+            cumulative = 0
+            for bucket in [*map(str, self.buckets), "+Inf"]:
+                cumulative += values.get(bucket, 0)
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bucket}"}} {int(cumulative)}')
+            suffix = f"{{{label_str}}}" if label_str else ""
+            lines.append(f"{self.name}_sum{suffix} {values.get('sum', 0)}")
+            lines.append(f"{self.name}_count{suffix} {int(values.get('count', 0))}")
+        return "\n".join(lines)
+
+    def clear(self):
+        get_redis_connection("default").delete(self.key)
+
+
+def render_metrics():
+    '''
+        All registered histograms in the Prometheus text exposition format.
+    '''
+    return "\n".join(histogram.render() for histogram in Histogram.registry.values()) + "\n"
+
+
+def metrics(request):
+    '''
+        Prometheus scrape endpoint. Requires `Authorization: Bearer <METRICS_TOKEN>`
+        when settings.METRICS_TOKEN is set.
+    '''
+    if settings.METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {settings.METRICS_TOKEN}":
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# 提交接口: 整个请求, 以及写入 submission 表
+SUBMISSION_CREATE_SECONDS = Histogram(
+    "oj_submission_create_seconds", "Time spent in MakeSubmissionAPI.")
+SUBMISSION_DB_WRITE_SECONDS = Histogram(
+    "oj_submission_db_write_seconds", "Time spent writing the submission row.")
+# 判题: 排队, 评测机 HTTP 请求, 单个测试点的运行时间, 以及 worker 处理一个提交的总时间
+JUDGE_QUEUE_WAIT_SECONDS = Histogram(
+    "oj_judge_queue_wait_seconds", "Time a task waited in the judge queue.")
+JUDGE_REQUEST_SECONDS = Histogram(
+    "oj_judge_request_seconds", "Time of HTTP requests to judge servers.")
+JUDGE_CASE_REAL_TIME_SECONDS = Histogram(
+    "oj_judge_case_real_time_seconds", "Real time of a test case reported by the judge server.",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10))
+JUDGE_TOTAL_SECONDS = Histogram(
+    "oj_judge_total_seconds", "Time to judge a submission in the judge worker.")
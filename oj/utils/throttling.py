@@ -0,0 +1,90 @@
+import math
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+
+def client_ip(request):
+    '''
+        IP of the client behind settings.TRUSTED_PROXY_COUNT reverse proxies.
+
+        Each proxy appends the address it received the request from to
+        X-Forwarded-For, so the client is the entry added by the outermost
+        trusted proxy; entries to its left come from the client and can be
+        spoofed.
+    '''
+    count = settings.TRUSTED_PROXY_COUNT
+    if count:
+        forwarded = [ip.strip() for ip in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+        forwarded = [ip for ip in forwarded if ip]
+        if len(forwarded) >= count:
+            return forwarded[-count]
+    return request.META.get('REMOTE_ADDR')
+
+
+class TokenBucket(object):
+    '''
+        Redis 令牌桶, 以 `rate` 个/秒的速度补充令牌, 最多积攒 `capacity` 个:
+        >>> allowed, retry_after = TokenBucket("submit:user:1", rate=0.2, capacity=10).consume()
+
+        同时受多个桶限制时用 consume_all, 只有所有桶都有足够的令牌时才扣减:
+        >>> allowed, retry_after = TokenBucket.consume_all([user_bucket, ip_bucket])
+
+        扣减在 lua 脚本中完成, 多个 web 进程之间是原子的.
+    '''
+    key_prefix = "throttle:"
+    script = """
+local now = tonumber(ARGV[1])
+local requested = tonumber(ARGV[2])
+local tokens = {}
+local allowed = 1
+local retry_after = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i + 1])
+    local capacity = tonumber(ARGV[2 * i + 2])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens[i] = math.min(capacity, available + math.max(0, now - ts) * rate)
+    if tokens[i] < requested then
+        allowed = 0
+        retry_after = math.max(retry_after, (requested - tokens[i]) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i + 1])
+    local capacity = tonumber(ARGV[2 * i + 2])
+    if allowed == 1 then
+        tokens[i] = tokens[i] - requested
+    end
+    redis.call('HSET', key, 'tokens', tokens[i], 'ts', now)
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return {allowed, tostring(retry_after)}
+"""
+
+    def __init__(self, key, rate, capacity, redis=None):
+        self.key = f"{self.key_prefix}{key}"
+        self.rate = rate
+        self.capacity = capacity
+        self.redis = redis or get_redis_connection("default")
+
+    def consume(self, tokens=1):
+        '''
+            Returns (allowed, seconds to wait before retrying).
+        '''
+        return self.consume_all([self], tokens)
+
+    @classmethod
+    def consume_all(cls, buckets, tokens=1):
+        '''
+            Take `tokens` from every bucket, or from none of them if any is
+            short. Returns (allowed, seconds to wait before retrying).
+        '''
+        args = [time.time(), tokens]
+        for bucket in buckets:
+            args += [bucket.rate, bucket.capacity]
+        allowed, retry_after = buckets[0].redis.eval(
+            cls.script, len(buckets), *[bucket.key for bucket in buckets], *args)
+        return bool(allowed), math.ceil(float(retry_after))